@@ -0,0 +1,150 @@
+"""
+Archives the status of all nodes to daily files of typed columns, replacing repeated
+redis-cli dumps with hera_node_data_dump.py.
+
+The status:history:node:x streams kept by the receiver, for every node in the node registry,
+are read with blocking XREADs and buffered in growable typed arrays. Every --flush-interval seconds the
+buffer is appended as one compressed chunk to the day's status_YYYYMMDD.npz file in --dir, and the last
+stream ID archived for each node is saved in redis, so that a restarted archiver carries on
+where it left off. A sample can be archived twice if the archiver dies between writing a chunk
+and saving the stream IDs, but is never lost as long as it's still in the stream.
+
+Each append rewrites the zip file's central directory, which grows with the number of chunks,
+so chunks are appended every 10 minutes by default. The history streams must hold at least
+that long. Once a day is over, its file is compacted into hourly chunks and given a time index;
+days left unfinished by an earlier run, found from the files in --dir without an index, are
+finished the same way.
+
+Archives are read with nodeControl.StatusArchive.
+"""
+
+import argparse
+import datetime
+import os
+import socket
+import sys
+import time
+import numpy as np
+import redis
+import nodeControl
+from udpSender import __version__, __package__
+from udpSender.archive import ArchiveWriter, ColumnBuffer, stream_columns
+from udpSender.history import HISTORY_KEY
+
+hostname = socket.gethostname()
+script_redis_key = "status:script:%s:%s" % (hostname, __file__)
+version_key = "version:%s:%s" % (__package__, os.path.basename(__file__))
+# Hash of node ID -> ID of the last history stream entry archived
+cursor_key = "archive:cursor:%s" % hostname
+
+parser = argparse.ArgumentParser(description = 'Archive the status history of all nodes to daily compressed files',
+                                    formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-r', dest='redishost', type=str, default='redishost', help = 'IP or hostname string of host running the monitor redis server.')
+parser.add_argument('--dir', dest='directory', type=str, default='.', help = 'Directory to write the daily archive files in')
+parser.add_argument('--flush-interval', dest='flush_interval', type=float, default=600.0,
+                    help = 'Time, in seconds, between appending the buffered samples to the archive')
+parser.add_argument('--refresh-interval', dest='refresh_interval', type=float, default=10.0,
+                    help = 'Time, in seconds, between checks of the node registry for new nodes')
+parser.add_argument('--no-compress', dest='compress', action='store_false', default=True,
+                    help = 'Store the archive uncompressed, so that it can be memory-mapped by readers')
+args = parser.parse_args()
+
+r = redis.StrictRedis(host=args.redishost)
+registry = nodeControl.NodeRegistry(redis_conn=r).load()
+writer = ArchiveWriter(args.directory, args.compress)
+
+cursors = {int(node): entry_id.decode() for node, entry_id in r.hgetall(cursor_key).items()}
+print("Resuming from stream IDs %s" % cursors, file=sys.stderr)
+
+
+def flush(buffer, read_cursors):
+    """
+    Append the buffered samples to the archive, then save the stream IDs they were read up to.
+    """
+    writer.write(buffer.columns())
+    pipe = r.pipeline(transaction=False)
+    if read_cursors:
+        pipe.hset(cursor_key, mapping=read_cursors)
+    pipe.set(script_redis_key, "alive", ex=max(60, int(3 * args.flush_interval)))
+    pipe.hset(version_key, mapping={"version": __version__, "timestamp": datetime.datetime.now().isoformat()})
+    pipe.execute()
+
+
+# Samples read since the last flush
+buffer = ColumnBuffer()
+# Days with samples archived, whose time index is still to be written, including those left
+# unfinished by an earlier run
+open_days = set(writer.unfinished_days())
+if open_days:
+    print("Unfinished archive days %s" % sorted(str(day) for day in open_days), file=sys.stderr)
+last_flush_time = time.time()
+last_refresh_time = 0
+# Whether the missing history streams have been reported, so the error is printed once each time they go missing
+reported_no_history = False
+
+try:
+    while True:
+        now = time.time()
+        if now > last_refresh_time + args.refresh_interval:
+            last_refresh_time = now
+            try:
+                registry.refresh()
+                # The receiver only keeps history streams with --history-maxlen or --history-retention
+                nstreams = r.exists(*[HISTORY_KEY % node for node in registry]) if len(registry) else None
+            except redis.exceptions.RedisError as e:
+                print('Failed to refresh the node registry: %s' % e, file=sys.stderr)
+                nstreams = None
+            for node in registry:
+                cursors.setdefault(node, '0')
+            if nstreams == 0:
+                if not reported_no_history:
+                    print('No status:history:node:x streams found, so nothing is being archived. Run '
+                          'hera_node_receiver.py with --history-maxlen or --history-retention.', file=sys.stderr)
+                    reported_no_history = True
+            elif nstreams:
+                reported_no_history = False
+
+        block_ms = int(max(last_flush_time + args.flush_interval - now, 0) * 1000) + 1
+        if not cursors:
+            time.sleep(block_ms / 1000.)
+            continue
+        try:
+            reply = r.xread({HISTORY_KEY % node: entry_id for node, entry_id in cursors.items()},
+                            count=1000, block=block_ms)
+        except redis.exceptions.RedisError as e:
+            print('Failed to read status history: %s' % e, file=sys.stderr)
+            time.sleep(1)
+            continue
+        for key, entries in reply or []:
+            node = int(key.rsplit(b':', 1)[1])
+            buffer.extend(stream_columns(node, entries))
+            cursors[node] = entries[-1][0].decode()
+
+        now = time.time()
+        if now < last_flush_time + args.flush_interval:
+            continue
+        open_days.update(datetime.datetime.fromtimestamp(t, datetime.timezone.utc).date()
+                         for t in np.unique(buffer.columns()['time'] // 86400) * 86400)
+        try:
+            flush(buffer, dict(cursors))
+        except (redis.exceptions.RedisError, OSError) as e:
+            # Keep the buffer, and try again at the next flush
+            print('Failed to archive samples: %s' % e, file=sys.stderr)
+            last_flush_time = now
+            continue
+        buffer.clear()
+        last_flush_time = now
+        # Samples arrive within a couple of flushes, so a day well past is complete
+        today = datetime.datetime.fromtimestamp(now - 2 * args.flush_interval - 60, datetime.timezone.utc).date()
+        for day in sorted(d for d in open_days if d < today):
+            writer.finish_day(day)
+            open_days.discard(day)
+            print("Finished archive %s" % writer.path(day), file=sys.stderr)
+
+except KeyboardInterrupt:
+    try:
+        flush(buffer, dict(cursors))
+    except (redis.exceptions.RedisError, OSError) as e:
+        print('Failed to archive samples: %s' % e, file=sys.stderr)
+    print('Interrupted', file=sys.stderr)
+    sys.exit(0)
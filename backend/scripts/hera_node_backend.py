@@ -0,0 +1,67 @@
+"""
+Runs the node backend (status receiver, keep-alive poker and command checker) in a single
+asyncio process. Replaces running hera_node_receiver.py, hera_node_keep_alive.py and
+hera_node_cmd_check.py separately; don't run it alongside them.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import udpSender
+import udpSender.aio
+
+parser = argparse.ArgumentParser(description = 'Receive node statuses, keep nodes alive and forward commands to them',
+                                    formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-r', dest='redishost', type=str, default='redishost', help = 'IP or hostname string of host running the monitor redis server.')
+parser.add_argument('-p', dest='redisport', type=int, default=6379, help = 'Port of the monitor redis server.')
+parser.add_argument('--poke-time', dest='poke_time_sec', type=float, default=1.0,
+                    help = 'Time, in seconds, between keep-alive pokes')
+parser.add_argument('--cmd-check-time', dest='cmd_check_sec', type=float, default=0.05,
+                    help = 'Time, in seconds, between checks for new commands')
+parser.add_argument('--cmd-time', dest='cmd_time_sec', type=float, default=2.0,
+                    help = 'Minimum time, in seconds, between commands sent to one node')
+parser.add_argument('--flush-interval', dest='flush_interval', type=float, default=0.1,
+                    help = 'Time, in seconds, between writes of received statuses to redis')
+parser.add_argument('--legacy', action='store_true', default=False,
+                    help = 'Poll the command triggers of every node instead of waiting on the command queues')
+parser.add_argument('--history-maxlen', dest='history_maxlen', type=int, default=0,
+                    help = 'Approximate number of status samples kept in each node\'s history stream, '
+                           'about 100 bytes of redis memory each. 0 to keep no history unless --history-retention is set.')
+parser.add_argument('--history-retention', dest='history_retention', type=float, default=None,
+                    help = 'Keep the status samples from about this many seconds, instead of a fixed number (needs redis 6.2). '
+                           'Each node sends a status about every second, so a day is about 8.6MB of redis memory per node.')
+parser.add_argument('--no-rollup', dest='rollup', action='store_false', default=True,
+                    help = 'Don\'t keep the 1 minute, 10 minute and 1 hour sensor rollups')
+parser.add_argument('--no-publish', dest='publish', action='store_false', default=True,
+                    help = 'Don\'t publish statuses to the status:updates and status:changes channels')
+parser.add_argument('--delta', action='store_true', default=False,
+                    help = 'Only write the fields of each node\'s status:node:x hash which have changed')
+parser.add_argument('--temp-deadband', dest='temp_deadband', type=float, default=0.0,
+                    help = 'With --delta, smallest temperature change, in degrees C, written to redis')
+parser.add_argument('--humid-deadband', dest='humid_deadband', type=float, default=0.0,
+                    help = 'With --delta, smallest relative humidity change, in percent, written to redis')
+args = parser.parse_args()
+
+try:
+    asyncio.run(udpSender.aio.run_backend(
+        redishost=args.redishost,
+        redisport=args.redisport,
+        script_name=os.path.basename(__file__),
+        version=udpSender.__version__,
+        poke_time_sec=args.poke_time_sec,
+        cmd_check_sec=args.cmd_check_sec,
+        cmd_time_sec=args.cmd_time_sec,
+        flush_interval=args.flush_interval,
+        legacy_commands=args.legacy,
+        history_maxlen=args.history_maxlen,
+        history_retention=args.history_retention,
+        rollups=args.rollup,
+        publish=args.publish,
+        delta=args.delta,
+        temp_deadband=args.temp_deadband,
+        humid_deadband=args.humid_deadband,
+    ))
+except KeyboardInterrupt:
+    print('Interrupted', file=sys.stderr)
+    sys.exit(0)
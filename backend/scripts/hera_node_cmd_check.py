@@ -1,14 +1,25 @@
 """
 Checks Redis for commands sent by the monitor-control user.
 Makes sure commands are spaced out properly to prevent rapid power cycling and
-turning everything on at once. Uses throttle:node:x flag to enforce a 2 second delay
-between commands. Checks for command triggers inside the commands:status:node key.
+turning everything on at once. Enforces a 2 second delay between commands to each node,
+recorded in the throttle:node:x hash, with a scheduler that throttles every node
+independently, so waiting on one node never holds up commands to the others.
+
+Commands queued with an ID by nodeControl are tracked until the node's status:node:x hash
+reports the power bit they should set. Commands which aren't confirmed are resent with backoff,
+and the outcome and end-to-end latency of each is recorded in its commands:status:<id> hash.
+
+By default, waits for commands to be pushed onto the commands:queue:node:x lists with BLPOP,
+so no Redis requests are made while there is nothing to do. Command triggers set inside the
+commands:node:x hash by older clients are still picked up by a sweep every node_refresh_sec.
+With --legacy, polls the command triggers of every node instead.
 """
 
 
 import redis
 import argparse
 import udpSender
+import nodeControl
 import time
 import sys
 import os
@@ -16,33 +27,33 @@ import datetime
 import socket
 
 
-def refresh_node_list(curr_nodes, redis_conn):
+def refresh_node_list(curr_nodes, redis_conn, registry):
+    registry.refresh()
     new_node_list = {}
-    for key in redis_conn.scan_iter("status:node:*"):
-        try:
-            node_id = int(r.hget(key, 'node_ID').decode())
-        except ValueError:
+    for node_id in registry:
+        ip = registry.ip(node_id)
+        if ip is None:
             continue
-        ip = r.hget(key, 'ip').decode()
         if node_id in list(curr_nodes.keys()):
-            if ip == curr_nodes[node_id].arduinoAddress:
-                new_node_list[node_id] = curr_nodes[node_id]
-            else:
-                new_node_list[node_id] = udpSender.UdpSender(ip)
+            if ip != curr_nodes[node_id]:
                 print("Updating IP address of node %d to %s" % (node_id, ip), file=sys.stderr)
         else:
-            new_node_list[node_id] = udpSender.UdpSender(ip)
             print("Adding node %d with ip %s" % (node_id, ip), file=sys.stderr)
-            # If this is a new node, default all the command triggers to idle
-            r.hset('commands:node:%d'%node_id, 'power_snap_relay_ctrl_trig', 'False')
-            r.hset('commands:node:%d'%node_id, 'power_snap_0_ctrl_trig', 'False')
-            r.hset('commands:node:%d'%node_id, 'power_snap_1_ctrl_trig', 'False')
-            r.hset('commands:node:%d'%node_id, 'power_snap_2_ctrl_trig', 'False')
-            r.hset('commands:node:%d'%node_id, 'power_snap_3_ctrl_trig', 'False')
-            r.hset('commands:node:%d'%node_id, 'power_fem_ctrl_trig', 'False')
-            r.hset('commands:node:%d'%node_id, 'power_pam_ctrl_trig', 'False')
-            r.hset('commands:node:%d'%node_id, 'reset', 'False')
-            r.hset('throttle:node:%d'%node_id, 'last_command_sec', '0')
+            # If this is a new node, default any missing command triggers to idle. Triggers
+            # already set, e.g. by commands queued before this script started, are left alone.
+            pipe = redis_conn.pipeline(transaction=False)
+            for control in udpSender.POWER_CONTROLS:
+                pipe.hsetnx('commands:node:%d'%node_id, '%s_ctrl_trig' % control, 'False')
+            pipe.hsetnx('commands:node:%d'%node_id, 'reset', 'False')
+            pipe.hsetnx('throttle:node:%d'%node_id, 'last_command_sec', '0')
+            pipe.hget('throttle:node:%d'%node_id, 'last_command_sec')
+            last_command_sec = pipe.execute()[-1]
+            # Carry on the throttle from commands sent before this script started
+            try:
+                scheduler.set_last_run(node_id, float(last_command_sec))
+            except (TypeError, ValueError):
+                pass
+        new_node_list[node_id] = ip
     return new_node_list
 
 hostname = socket.gethostname()
@@ -50,6 +61,8 @@ script_redis_key = "status:script:%s:%s" % (hostname, __file__)
 
 parser = argparse.ArgumentParser(description = 'Script to watch redis for commands and send them on to nodes',
                                     formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--legacy', action='store_true', default=False,
+                    help = 'Poll the command triggers of every node instead of waiting on the command queues')
 args = parser.parse_args()
 
 # Instantiate redis object connected to redis server running on serverAddress
@@ -61,17 +74,180 @@ cmd_check_sec = 0.05
 cmd_time_sec = 2
 # Time between checks for new / changed nodes
 node_refresh_sec = 10
+# Maximum time to block waiting for queued commands
+queue_wait_sec = 1
+# Shortest time to block waiting for queued commands
+min_block_sec = 0.01
+# Key of each node's command queue
+command_queue_key = "commands:queue:node:%d"
+# Time between checks of node status for confirmation of sent commands
+ack_check_sec = 0.25
 
-# Define a dict of udpSender objects to send commands to Arduinos.
-# If nodes to check and throttle are specified, use those values.
-# If not, use all the nodes that have Redis entries.
-nodes = refresh_node_list({}, r)
-last_node_refresh_time = time.time()
-print("Using nodes %s:" % (list(nodes.keys())), file=sys.stderr)
+# Index of nodes kept by the receiver, read incrementally on each node refresh
+registry = nodeControl.NodeRegistry(redis_conn=r).load()
 
-# Check command keys for triggers and command sent, throttle those commands to
-# not exceed the cmd_time_sec
-try:
+# Sends commands to every Arduino from one socket, without waiting after each command
+pool = udpSender.UdpSenderPool()
+
+# Sends each node's commands once its throttle allows, without holding up other nodes
+scheduler = udpSender.CommandScheduler(cmd_time_sec)
+# Commands sent, waiting for confirmation from node status
+tracker = udpSender.AckTracker()
+# Dictionary of (node ID, control) -> list of (command ID, time queued) for scheduled commands
+pending_ids = {}
+
+def track_command(node_id, control, command, ids):
+    """
+    Start tracking the command IDs in `ids`, now that `command` has been sent for `control`.
+    Requests for a different command than the one sent have been overridden by a later request.
+    """
+    pipe = r.pipeline(transaction=False)
+    for cmd_id, _ in ids:
+        pipe.hget(udpSender.acks.COMMAND_STATUS_KEY % cmd_id, 'value')
+    values = pipe.execute()
+    sent_ids = []
+    for (cmd_id, queued_time), value in zip(ids, values):
+        if value is not None and value.decode() != command:
+            udpSender.acks.record_state(pipe, [(cmd_id, queued_time)], 'superseded')
+        else:
+            sent_ids.append((cmd_id, queued_time))
+    if sent_ids:
+        udpSender.acks.record_state(pipe, sent_ids, 'pending', node=node_id, control=control,
+                                    value=command, attempts=1)
+    replaced = tracker.track(node_id, control, command, sent_ids)
+    if replaced is not None:
+        udpSender.acks.record_state(pipe, replaced.ids, 'superseded')
+    pipe.execute()
+
+def fire_command(node_id, control):
+    """
+    Send the current command for the power control `control` to a node and clear its trigger.
+    Called by the scheduler once the node's throttle has expired. Does nothing if the trigger
+    has been cleared in the meantime.
+    """
+    ids = pending_ids.pop((node_id, control), [])
+    ip = nodes.get(node_id)
+    if ip is None:
+        return
+    trig, command = r.hmget('commands:node:%d'%node_id, '%s_ctrl_trig' % control, '%s_cmd' % control)
+    command = 'on' if command == b'on' else 'off'
+    if trig == b'True':
+        pool.command(ip, control, command)
+        pipe = r.pipeline(transaction=False)
+        pipe.hset('commands:node:%d'%node_id, '%s_ctrl_trig' % control, 'False')
+        # reset the last command flag
+        pipe.hset('throttle:node:%d'%node_id,'last_command_sec',time.time())
+        pipe.execute()
+    elif not ids:
+        return
+    # Queued commands whose trigger was already cleared were sent by an earlier
+    # command or sweep, and are confirmed the same way
+    track_command(node_id, control, command, ids)
+
+def resend_command(cmd):
+    """
+    Send an unconfirmed command again. Called by the scheduler, so retries respect the throttle.
+    Gives up on the command if a different one has been requested since.
+    """
+    ip = nodes.get(cmd.node)
+    current = r.hget('commands:node:%d'%cmd.node, '%s_cmd' % cmd.control)
+    if ip is None or current is None or current.decode() != cmd.value:
+        tracker.abandon(cmd)
+        pipe = r.pipeline(transaction=False)
+        udpSender.acks.record_state(pipe, cmd.ids, 'superseded')
+        pipe.execute()
+        return
+    pool.command(ip, cmd.control, cmd.value)
+    tracker.retried(cmd)
+    pipe = r.pipeline(transaction=False)
+    pipe.hset('throttle:node:%d'%cmd.node,'last_command_sec',time.time())
+    udpSender.acks.record_state(pipe, cmd.ids, 'pending', attempts=cmd.attempts)
+    pipe.execute()
+    print("Resending %s %s to node %d, attempt %d" % (cmd.control, cmd.value, cmd.node, cmd.attempts), file=sys.stderr)
+
+def check_acks():
+    """
+    Read the power state of every node with unconfirmed commands in one pipeline, record the
+    commands which are now confirmed, and schedule retries of those which have timed out.
+    """
+    if not tracker:
+        return
+    node_ids = sorted(tracker.nodes())
+    pipe = r.pipeline(transaction=False)
+    for node_id in node_ids:
+        pipe.hmget('status:node:%d'%node_id, udpSender.POWER_CONTROLS)
+    states = pipe.execute()
+    pipe = r.pipeline(transaction=False)
+    for node_id, values in zip(node_ids, states):
+        for cmd in tracker.check(node_id, udpSender.acks.parse_power(values, udpSender.POWER_CONTROLS)):
+            udpSender.acks.record_state(pipe, cmd.ids, 'acked', attempts=cmd.attempts)
+    retry, failed = tracker.expired()
+    for cmd in failed:
+        udpSender.acks.record_state(pipe, cmd.ids, 'failed', attempts=cmd.attempts)
+        print("Node %d did not confirm %s %s after %d attempts" % (cmd.node, cmd.control, cmd.value, cmd.attempts), file=sys.stderr)
+    pipe.execute()
+    for cmd in retry:
+        # Push the deadline back now, so the retry isn't scheduled again while it waits for the throttle
+        cmd.deadline = float('inf')
+        scheduler.submit(cmd.node, cmd.control, lambda cmd=cmd: resend_command(cmd))
+
+def send_command(node_id, ip, control, ids=()):
+    """
+    Schedule the command for the power control `control` to be sent to a node once the node's
+    throttle allows. `control` may also be 'reset', which is sent immediately.
+
+    :param ids: List of (command ID, time queued) tuples of the requests for this command
+    """
+    if control == 'reset':
+        pool.reset(ip)
+        pipe = r.pipeline(transaction=False)
+        pipe.hset('commands:node:%d'%node_id, 'reset', 'False')
+        # Nothing in the node status confirms a reset
+        udpSender.acks.record_state(pipe, ids, 'sent', node=node_id, control=control)
+        pipe.execute()
+        return
+    if ids:
+        pending_ids.setdefault((node_id, control), []).extend(ids)
+    scheduler.submit(node_id, control, lambda: fire_command(node_id, control))
+
+def check_triggers(node_id, ip):
+    """
+    Schedule every command whose trigger is set in the node's commands:node:x hash,
+    with "off" commands before "on" commands, each in the order it's safe to send them.
+    """
+    controls = list(udpSender.POWER_CONTROLS)
+    fields = ['%s_ctrl_trig' % control for control in controls] + ['%s_cmd' % control for control in controls]
+    values = r.hmget('commands:node:%d'%node_id, fields + ['reset'])
+    triggered = [control for control, trig in zip(controls, values) if trig == b'True']
+    commands = {control: cmd.decode() for control, cmd in zip(controls, values[len(controls):]) if cmd is not None}
+    for control in udpSender.sweep_order(triggered, commands):
+        send_command(node_id, ip, control)
+    if values[-1] == b'True':
+        send_command(node_id, ip, 'reset')
+
+def handle_queued(node_id, ip, payload):
+    """
+    Schedule a command popped from the node's command queue. Its trigger is checked
+    when it is sent, so commands already sent are skipped.
+    """
+    control, ids = udpSender.acks.parse_queued(payload)
+    if control == 'reset':
+        if r.hget('commands:node:%d'%node_id, 'reset') == b'True':
+            send_command(node_id, ip, control, ids)
+        elif ids:
+            # Already sent by the trigger sweep
+            pipe = r.pipeline(transaction=False)
+            udpSender.acks.record_state(pipe, ids, 'sent', node=node_id, control=control)
+            pipe.execute()
+    else:
+        send_command(node_id, ip, control, ids)
+
+def run_legacy():
+    """
+    Poll every node's command triggers every cmd_check_sec.
+    """
+    global nodes
+    last_node_refresh_time = time.time()
     while True:
         r.hmset("version:%s:%s" % (udpSender.__package__, os.path.basename(__file__)), {
             "version" : udpSender.__version__,
@@ -79,101 +255,74 @@ try:
         })
         r.set(script_redis_key, "alive", ex=60)
 
-        for node_id, node in nodes.items():
-            if ((r.hget('commands:node:%d'%node_id, 'power_snap_relay_ctrl_trig').decode()) == 'True'):
-                while ((time.time() - float(r.hget('throttle:node:%d'%node_id,'last_command_sec').decode())) < cmd_time_sec):
-                    #print('Command sent too soon, waiting 100ms and trying again...')
-                    time.sleep(.1)
-                #print("Sent!")
-                if ((r.hget('commands:node:%d'%node_id, 'power_snap_relay_cmd').decode()) == 'on'):
-                    node.power_snap_relay('on')
-                else:
-                    node.power_snap_relay('off')
-                r.hset('commands:node:%d'%node_id, 'power_snap_relay_ctrl_trig', 'False')
-                # reset the last command flag
-                r.hset('throttle:node:%d'%node_id,'last_command_sec',time.time())
-
-            if ((r.hget('commands:node:%d'%node_id, 'power_snap_0_ctrl_trig').decode()) == 'True'):
-                while ((time.time() - float(r.hget('throttle:node:%d'%node_id,'last_command_sec').decode())) < cmd_time_sec):
-                    #print('Command sent too soon, waiting 100ms and trying again...')
-                    time.sleep(.1)
-                #print("Sent!")
-                if (r.hget('commands:node:%d'%node_id, 'power_snap_0_cmd').decode() == 'on'):
-                    node.power_snap_0('on')
-                else:
-                    node.power_snap_0('off')
-                r.hset('commands:node:%d'%node_id, 'power_snap_0_ctrl_trig', 'False')
-                r.hset('throttle:node:%d'%node_id,'last_command_sec',time.time())
-
-            if ((r.hget('commands:node:%d'%node_id, 'power_snap_1_ctrl_trig').decode()) == 'True'):
-                while ((time.time() - float(r.hget('throttle:node:%d'%node_id,'last_command_sec').decode())) < cmd_time_sec):
-                    #print('Command sent too soon, waiting 100ms and trying again...')
-                    time.sleep(.1)
-                #print("Sent!")
-                if (r.hget('commands:node:%d'%node_id, 'power_snap_1_cmd').decode() == 'on'):
-                    node.power_snap_1('on')
-                else:
-                    node.power_snap_1('off')
-                r.hset('commands:node:%d'%node_id, 'power_snap_1_ctrl_trig', 'False')
-                r.hset('throttle:node:%d'%node_id,'last_command_sec',time.time())
-
-            if ((r.hget('commands:node:%d'%node_id, 'power_snap_2_ctrl_trig').decode()) == 'True'):
-                while ((time.time() - float(r.hget('throttle:node:%d'%node_id,'last_command_sec').decode())) < cmd_time_sec):
-                    #print('Command sent too soon, waiting 100ms and trying again...')
-                    time.sleep(.1)
-                #print("Sent!")
-                if (r.hget('commands:node:%d'%node_id, 'power_snap_2_cmd').decode() == 'on'):
-                    node.power_snap_2('on')
-                else:
-                    node.power_snap_2('off')
-                r.hset('commands:node:%d'%node_id, 'power_snap_2_ctrl_trig', 'False')
-                r.hset('throttle:node:%d'%node_id,'last_command_sec',time.time())
-
-            if ((r.hget('commands:node:%d'%node_id, 'power_snap_3_ctrl_trig').decode()) == 'True'):
-                while ((time.time() - float(r.hget('throttle:node:%d'%node_id,'last_command_sec').decode())) < cmd_time_sec):
-                    #print('Command sent too soon, waiting 100ms and trying again...')
-                    time.sleep(.1)
-                #print("Sent!")
-                if (r.hget('commands:node:%d'%node_id, 'power_snap_3_cmd').decode() == 'on'):
-                    node.power_snap_3('on')
-                else:
-                    node.power_snap_3('off')
-                r.hset('commands:node:%d'%node_id, 'power_snap_3_ctrl_trig', 'False')
-                r.hset('throttle:node:%d'%node_id,'last_command_sec',time.time())
-
-            if (r.hget('commands:node:%d'%node_id, 'power_fem_ctrl_trig').decode() == 'True'):
-                while ((time.time() - float(r.hget('throttle:node:%d'%node_id,'last_command_sec').decode())) < cmd_time_sec):
-                    #print('Command sent too soon, waiting 100ms and trying again...')
-                    time.sleep(.1)
-                #print("Sent!")
-                if (r.hget('commands:node:%d'%node_id, 'power_fem_cmd').decode() == 'on'):
-                    node.power_fem('on')
-                else:
-                    node.power_fem('off')
-                r.hset('commands:node:%d'%node_id, 'power_fem_ctrl_trig', 'False')
-                r.hset('throttle:node:%d'%node_id,'last_command_sec',time.time())
-
-            if (r.hget('commands:node:%d'%node_id, 'power_pam_ctrl_trig').decode() == 'True'):
-                while ((time.time() - float(r.hget('throttle:node:%d'%node_id,'last_command_sec').decode())) < cmd_time_sec):
-                    #print('Command sent too soon, waiting 100ms and trying again...')
-                    time.sleep(.1)
-                #print("Sent!")
-                if (r.hget('commands:node:%d'%node_id, 'power_pam_cmd').decode() == 'on'):
-                    node.power_pam('on')
-                else:
-                    node.power_pam('off')
-                r.hset('commands:node:%d'%node_id, 'power_pam_ctrl_trig', 'False')
-                r.hset('throttle:node:%d'%node_id,'last_command_sec',time.time())
-
-            if (r.hget('commands:node:%d'%node_id, 'reset').decode() == 'True'):
-                node.reset()
-                r.hset('commands:node:%d'%node_id, 'reset', 'False')
+        for node_id, ip in nodes.items():
+            check_triggers(node_id, ip)
+            scheduler.run_pending()
+            check_acks()
 
             if (time.time() > last_node_refresh_time + node_refresh_sec):
-                nodes = refresh_node_list(nodes, r)
+                nodes = refresh_node_list(nodes, r, registry)
                 last_node_refresh_time = time.time()
             time.sleep(cmd_check_sec)
 
+def run_queued():
+    """
+    Block on the command queues of all nodes, sending commands as soon as they are pushed.
+    """
+    global nodes
+    last_node_refresh_time = time.time()
+    last_alive_time = 0
+    last_ack_check_time = 0
+    while True:
+        if time.time() > last_alive_time + queue_wait_sec:
+            r.hmset("version:%s:%s" % (udpSender.__package__, os.path.basename(__file__)), {
+                "version" : udpSender.__version__,
+                "timestamp" : datetime.datetime.now().isoformat(),
+            })
+            r.set(script_redis_key, "alive", ex=60)
+            last_alive_time = time.time()
+
+        # Block until a command is queued, or until a scheduled command is due
+        wait = scheduler.time_until_next()
+        timeout = queue_wait_sec if wait is None else min(queue_wait_sec, wait)
+        if tracker:
+            timeout = min(timeout, max(last_ack_check_time + ack_check_sec - time.time(), 0))
+        queue_keys = {command_queue_key % node_id: node_id for node_id in nodes.keys()}
+        item = None
+        if queue_keys and timeout >= min_block_sec:
+            item = r.blpop(list(queue_keys.keys()), timeout=timeout)
+        else:
+            # A BLPOP timeout of 0 would block forever
+            time.sleep(timeout)
+        if item is not None:
+            node_id = queue_keys[item[0].decode()]
+            handle_queued(node_id, nodes[node_id], item[1])
+        scheduler.run_pending()
+        if tracker and time.time() >= last_ack_check_time + ack_check_sec:
+            check_acks()
+            last_ack_check_time = time.time()
+
+        if (time.time() > last_node_refresh_time + node_refresh_sec):
+            nodes = refresh_node_list(nodes, r, registry)
+            # Sweep for triggers set without queueing a command, e.g. by older versions of nodeControl
+            for node_id, ip in nodes.items():
+                check_triggers(node_id, ip)
+            last_node_refresh_time = time.time()
+
+# Define a dict of node ID -> Arduino IP address to send commands to.
+# If nodes to check and throttle are specified, use those values.
+# If not, use all the nodes that have Redis entries.
+nodes = refresh_node_list({}, r, registry)
+print("Using nodes %s:" % (list(nodes.keys())), file=sys.stderr)
+
+# Check command keys for triggers and command sent, throttle those commands to
+# not exceed the cmd_time_sec
+try:
+    if args.legacy:
+        run_legacy()
+    else:
+        run_queued()
+
 except KeyboardInterrupt:
     print("Interrupted", file=sys.stderr)
     sys.exit(0)
@@ -1,75 +1,106 @@
 """
 Pokes Arduinos to ensure Arduino's connectivity to the server.
 It pokes either specified nodes with the -n argument or
-the nodes that have Redis status keys i.e. status:node:x where x is the node ID
-set by the I2C digital I/O cards plugged into PCBs.
+the nodes listed in the node registry kept by the receiver, i.e. the nodes that report
+status under the node ID set by the I2C digital I/O cards plugged into PCBs.
+
+All nodes are poked in one burst per tick, on a fixed-rate schedule. Poke times, the node
+list refresh and the liveness keys are handled by a separate redis thread, so a slow redis
+server never delays the pokes.
 """
 
 import time
 import redis
 import udpSender
+import nodeControl
 import os
 import sys
 import argparse
 import datetime
 import socket
+import threading
+from udpSender.keepalive import KeepAliveEngine, PokeRecorder
 
 
-def refresh_node_list(curr_nodes, redis_conn):
+def refresh_node_list(curr_nodes, registry):
+    registry.refresh()
     new_node_list = {}
-    for key in redis_conn.scan_iter("status:node:*"):
-        try:
-            node_id = int(r.hget(key, 'node_ID'))
-        except ValueError:
+    for node_id in registry:
+        ip = registry.ip(node_id)
+        if ip is None:
             continue
-        ip = r.hget(key, 'ip')
         if node_id in list(curr_nodes.keys()):
-            if ip == curr_nodes[node_id].arduinoAddress:
-                new_node_list[node_id] = curr_nodes[node_id]
-            else:
-                new_node_list[node_id] = udpSender.UdpSender(ip)
+            if ip != curr_nodes[node_id]:
                 print("Updating IP address of node %d to %s" % (node_id, ip), file=sys.stderr)
         else:
-            new_node_list[node_id] = udpSender.UdpSender(ip)
             print("Adding node %d with ip %s" % (node_id, ip), file=sys.stderr)
+        new_node_list[node_id] = ip
     return new_node_list
 
 hostname = socket.gethostname()
 script_redis_key = "status:script:%s:%s" % (hostname, __file__)
+version_key = "version:%s:%s" % (udpSender.__package__, os.path.basename(__file__))
+stats_key = "stats:keep_alive:%s" % hostname
 
 parser = argparse.ArgumentParser(description = 'Send keepalive pokes to all nodes with a status entry in redis', formatter_class = argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('-r', dest='redishost', type=str, default='redishost', help = 'IP or hostname string of host running the monitor redis server.')
+parser.add_argument('--period', type=float, default=1.0, help = 'Time, in seconds, between pokes to each node')
+parser.add_argument('--refresh-interval', dest='refresh_interval', type=float, default=1.0,
+                    help = 'Time, in seconds, between checks of the node registry for new or changed nodes')
+parser.add_argument('--stats-interval', dest='stats_interval', type=float, default=10.0,
+                    help = 'Time, in seconds, between publishing poke timing statistics')
 args = parser.parse_args()
 
 r = redis.StrictRedis(host=args.redishost)
+# Index of nodes kept by the receiver, read incrementally on each refresh
+registry = nodeControl.NodeRegistry(redis_conn=r).load()
 
-# Time to wait between pokes
-poke_time_sec = 1
+# Sends pokes to every Arduino from one socket
+pool = udpSender.UdpSenderPool()
+engine = KeepAliveEngine(pool.sock, args.period)
+recorder = PokeRecorder(r)
 
-# Define a dict of udpSender objects to send commands to Arduinos.
+# Define a dict of node ID -> Arduino IP address to poke.
 # If nodes to check and throttle are specified, use those values.
 # If not, poke all the nodes that have Redis status:node:x keys.
-nodes = refresh_node_list({}, r)
+nodes = refresh_node_list({}, registry)
+engine.set_nodes(nodes)
 print("Using nodes %s:" % (list(nodes.keys())), file=sys.stderr)
 
+last_refresh_time = time.time()
+last_stats_time = time.time()
+
+def housekeeping(pipe):
+    """
+    Queue the liveness, version and statistics keys on the poke recorder's pipeline, and
+    refresh the node list. Runs on the redis thread.
+    """
+    global nodes, last_refresh_time, last_stats_time
+    pipe.set(script_redis_key, "alive", ex=60)
+    pipe.hset(version_key, mapping={
+        "version" : udpSender.__version__,
+        "timestamp" : datetime.datetime.now().isoformat(),
+    })
+    now = time.time()
+    if now > last_stats_time + args.stats_interval:
+        stats = engine.take_stats()
+        stats['coalesced'] = recorder.coalesced
+        stats['nodes'] = len(nodes)
+        stats['timestamp'] = datetime.datetime.now().isoformat()
+        pipe.hset(stats_key, mapping=stats)
+        last_stats_time = now
+    if now > last_refresh_time + args.refresh_interval:
+        nodes = refresh_node_list(nodes, registry)
+        engine.set_nodes(nodes)
+        last_refresh_time = now
+
+writer_thread = threading.Thread(target=recorder.loop, name='redis-writer', args=(housekeeping,))
+writer_thread.daemon = True
+writer_thread.start()
+
 # Sends poke signal to Arduinos inside the nodes
 try:
-    while True:
-        r.set(script_redis_key, "alive", ex=60)
-        start_poke_time = time.time()
-        nodes = refresh_node_list(nodes, r)
-        r.hmset("version:%s:%s" % (udpSender.__package__, os.path.basename(__file__)), {
-            "version" : udpSender.__version__,
-            "timestamp" : datetime.datetime.now().isoformat(),
-        })
-        for node_id, node in nodes.items():
-            #print("Poking node %d"%node)
-            node.poke()
-            r.hset('throttle:node:%d'%node_id,'last_poke_sec',time.time())
-        end_poke_time = time.time()
-        time_to_poke = end_poke_time - start_poke_time
-        if time_to_poke < poke_time_sec:
-            time.sleep(poke_time_sec - time_to_poke)
+    engine.run(recorder.record)
 
 except KeyboardInterrupt:
     print('Interrupted', file=sys.stderr)
@@ -1,118 +1,283 @@
 """
-Receives UDP packets from all active Arduinos containing sensor data and status information and 
-pushes it up to Redis with status:node:x hash key. 
-"""
+Receives UDP packets from all active Arduinos containing sensor data and status information and
+pushes it up to Redis with status:node:x hash key.
 
+In batch mode, every datagram waiting in the socket is drained at once and the whole
+batch is written to Redis in one pipeline, keeping only the latest status of each node.
+In threaded mode, Redis writes are made by a separate writer thread, so the socket keeps
+being drained while Redis is slow.
+With --workers N, N receiver processes share the port using SO_REUSEPORT, and this
+process restarts any worker which dies and publishes their summed statistics.
 
+Each status is aggregated into the node's 1 minute, 10 minute and 1 hour
+status:rollup:<seconds>:node:x buckets. With --history-maxlen or --history-retention, it's also
+added to the node's status:history:node:x stream, capped at about that many samples or seconds.
+History is off by default, since it's held in redis memory at about 100 bytes per sample: 350 nodes
+with 100000 samples each is 35 million samples, several GB. It's published
+to the status:updates:node:x channel too, and to status:changes:node:x if it differs from the
+node's last status, for NodeControl.watch.
 
-def noneify(v, noneval=-99.0):
-    """
-    Return None if v==noneval. Else return v.
-    """
-    if v == noneval:
-        return 'None'
-    else:
-        return v
+With --delta, only the fields of each status:node:x hash which have changed are written, plus
+the timestamp and uptime, with optional deadbands on the sensors. In this mode the liveness and
+version keys are also written every 10 seconds rather than with every packet.
+"""
 
+import argparse
 import datetime
-import struct
+import multiprocessing
+import multiprocessing.connection
+import time
 import redis
 import socket
 import sys
 import os
-from udpSender import __version__, __package__
+import threading
+from udpSender import __version__, __package__, packet, StatusPacket, STATUS_PACKET_SIZE
+from udpSender import receiver
+from udpSender.history import HistoryWriter
+from udpSender.rollup import RollupWriter
+from udpSender.publish import StatusPublisher
 
 hostname = socket.gethostname()
 script_redis_key = "status:script:%s:%s" % (hostname, __file__)
+version_key = "version:%s:%s" % (__package__, os.path.basename(__file__))
+stats_key = "stats:receiver:%s" % hostname
 
-# Define rcvPort for socket creation
-rcvPort = 8889
-serverAddress = '0.0.0.0'
-redisAddress = 'redishost'
-redisPort = 6379
-# define socket for binding; necessary for receiving data from Arduino 
-localSocket = (serverAddress, rcvPort)
+parser = argparse.ArgumentParser(description = 'Receive status packets from all nodes and write them to redis',
+                                    formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-r', dest='redishost', type=str, default='redishost', help = 'IP or hostname string of host running the monitor redis server.')
+parser.add_argument('-p', dest='redisport', type=int, default=6379, help = 'Port of the monitor redis server.')
+parser.add_argument('--batch', action='store_true', default=False,
+                    help = 'Drain all waiting packets and write them to redis in one pipeline')
+parser.add_argument('--batch-size', dest='batch_size', type=int, default=512,
+                    help = 'Maximum number of packets per redis pipeline in batch mode')
+parser.add_argument('--flush-interval', dest='flush_interval', type=float, default=0.2,
+                    help = 'Maximum time, in seconds, a packet waits before being written to redis in batch mode')
+parser.add_argument('--threaded', action='store_true', default=False,
+                    help = 'Write to redis from a separate thread, keeping only the latest pending status of each node')
+parser.add_argument('--max-pending', dest='max_pending', type=int, default=1024,
+                    help = 'Maximum number of nodes with a status waiting to be written in threaded mode')
+parser.add_argument('--stats-interval', dest='stats_interval', type=float, default=10.0,
+                    help = 'Time, in seconds, between publishing receiver statistics')
+parser.add_argument('--rcvbuf', type=int, default=None,
+                    help = 'Kernel receive buffer size to request for the socket, in bytes')
+parser.add_argument('--workers', type=int, default=1,
+                    help = 'Number of receiver processes sharing the port with SO_REUSEPORT')
+parser.add_argument('--history-maxlen', dest='history_maxlen', type=int, default=0,
+                    help = 'Approximate number of status samples kept in each node\'s history stream, '
+                           'about 100 bytes of redis memory each. 0 to keep no history unless --history-retention is set.')
+parser.add_argument('--history-retention', dest='history_retention', type=float, default=None,
+                    help = 'Keep the status samples from about this many seconds, instead of a fixed number (needs redis 6.2). '
+                           'Each node sends a status about every second, so a day is about 8.6MB of redis memory per node.')
+parser.add_argument('--no-rollup', dest='rollup', action='store_false', default=True,
+                    help = 'Don\'t keep the 1 minute, 10 minute and 1 hour sensor rollups')
+parser.add_argument('--no-publish', dest='publish', action='store_false', default=True,
+                    help = 'Don\'t publish statuses to the status:updates and status:changes channels')
+parser.add_argument('--delta', action='store_true', default=False,
+                    help = 'Only write the fields of each node\'s status:node:x hash which have changed')
+parser.add_argument('--temp-deadband', dest='temp_deadband', type=float, default=0.0,
+                    help = 'With --delta, smallest temperature change, in degrees C, written to redis')
+parser.add_argument('--humid-deadband', dest='humid_deadband', type=float, default=0.0,
+                    help = 'With --delta, smallest relative humidity change, in percent, written to redis')
+args = parser.parse_args()
 
-unpacked_mac = ["" for x in range(6)]
+def stats_dict(stats):
+    """
+    Convert a sequence of counters ordered like receiver.STAT_FIELDS into a dictionary.
+    """
+    d = dict(zip(receiver.STAT_FIELDS, stats))
+    d['timestamp'] = datetime.datetime.now().isoformat()
+    return d
 
-# Instantiate redis object connected to redis server running on localhost
-r = redis.StrictRedis(host=redisAddress, port=redisPort)
+def make_history():
+    """
+    Return the HistoryWriter configured on the command line, or None if history is disabled.
+    """
+    if args.history_maxlen <= 0 and args.history_retention is None:
+        return None
+    return HistoryWriter(args.history_maxlen, args.history_retention)
 
+def make_rollup():
+    """
+    Return a RollupWriter, or None if rollups are disabled on the command line.
+    """
+    return RollupWriter() if args.rollup else None
 
-# Create a UDP socket
-try:
-    client_socket= socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # Set these options so multiple processes can connect to this socket
-    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    print("Socket created", file=sys.stderr)
-except socket.error as msg:
-    print('Failed to create socket. Error Code : ' + str(msg[0]) + ' Message ' + str(msg[1]), file=sys.stderr)
-    sys.exit()
-
-# Bind socket to local host and port
-try:
-    client_socket.bind(localSocket)
-    print('Bound socket', file=sys.stderr)
-except socket.error as msg:
-    print('Bind failed. Error Code : ' + str(msg[0]) + ' Message ' + msg[1], file=sys.stderr)
-    sys.exit()
+def make_delta():
+    """
+    Return a StatusDelta with the deadbands given on the command line, or None if delta mode is off.
+    """
+    if not args.delta:
+        return None
+    return receiver.StatusDelta(receiver.sensor_deadbands(args.temp_deadband, args.humid_deadband))
 
-try:
+def make_publisher():
+    """
+    Return a StatusPublisher, or None if publishing is disabled on the command line.
+    """
+    return StatusPublisher() if args.publish else None
+
+def run_batched(client_socket, r, stats, publish_stats=True):
+    """
+    Drain the socket into batches and write each batch to redis with one round trip,
+    along with the receiver statistics every --stats-interval seconds.
+    """
+    batch = receiver.PacketBatch(max_packets=args.batch_size)
+    writer = receiver.StatusWriter(r, script_redis_key, version_key, __version__, make_history(), make_rollup(),
+                                   make_publisher(), make_delta())
+    next_flush = time.time() + args.flush_interval
+    next_stats = 0
+    while True:
+        batch.drain(client_socket, next_flush - time.time())
+        now = time.time()
+        if batch.full() or now >= next_flush:
+            stats[0:2] = [batch.received, batch.short]
+            try:
+                if publish_stats and now >= next_stats:
+                    writer.write(batch.statuses, stats_key, stats_dict(stats))
+                    next_stats = now + args.stats_interval
+                else:
+                    writer.write(batch.statuses)
+            except redis.exceptions.RedisError as e:
+                # Drop the batch, the nodes send a fresh status every second
+                print('Failed to write %d statuses to redis: %s' % (len(batch.statuses), e), file=sys.stderr)
+            batch.clear()
+            next_flush = now + args.flush_interval
+
+def run_threaded(client_socket, r, stats, publish_stats=True):
+    """
+    Drain the socket on this thread and hand statuses to a redis writer thread.
+    """
+    batch = receiver.PacketBatch(max_packets=args.batch_size)
+    queue = receiver.LatestStatusQueue(max_nodes=args.max_pending)
+    writer = receiver.StatusWriter(r, script_redis_key, version_key, __version__, make_history(), make_rollup(),
+                                   make_publisher(), make_delta())
+
+    writer_thread = threading.Thread(target=receiver.writer_loop, name='redis-writer',
+                                     args=(queue, writer, stats_key if publish_stats else None,
+                                           lambda: stats_dict(stats), args.stats_interval))
+    writer_thread.daemon = True
+    writer_thread.start()
+    while True:
+        batch.drain(client_socket, 1.0)
+        queue.put_many(batch.statuses)
+        batch.clear()
+        stats[:] = [batch.received, batch.short, queue.coalesced, queue.dropped]
+
+def run_unbatched(client_socket, r, stats):
+    """
+    Write each packet to redis as soon as it is received.
+    """
+    # Receive buffer and status record, reused for every packet
+    data = bytearray(1024)
+    data_view = memoryview(data)
+    status = StatusPacket()
+    writer = receiver.StatusWriter(r, script_redis_key, version_key, __version__, make_history(), make_rollup(),
+                                   make_publisher(), make_delta())
     while True:
-        r.set(script_redis_key, "alive", ex=60)
         # Receive data continuously from the server (Arduino in this case)
-        data, addr =  client_socket.recvfrom(1024)
-        # Arduino sends a Struct via UDP so unpacking is needed 
-        # struct.unpack returns a tuple with one element
-        unpacked_cpu_uptime = struct.unpack('=L',data[0:4])[0]
-        unpacked_mcptemp_top = noneify(round(struct.unpack('=f',data[4:8])[0], 2))
-        unpacked_mcptemp_mid = noneify(round(struct.unpack('=f',data[8:12])[0], 2))
-        unpacked_mcptemp_bot = noneify(round(struct.unpack('=f',data[12:16])[0], 2))
-        unpacked_htutemp     = noneify(round(struct.unpack('=f',data[16:20])[0], 2))
-        unpacked_htuhumid    = noneify(round(struct.unpack('=f',data[20:24])[0], 2))
-        unpacked_snap_relay  = int(struct.unpack('=?',data[24:25])[0])
-        unpacked_fem         = int(struct.unpack('=?',data[25:26])[0])
-        unpacked_pam         = int(struct.unpack('=?',data[26:27])[0])
-        unpacked_snapv2_0    = int(struct.unpack('=?',data[27:28])[0])
-        unpacked_snapv2_1    = int(struct.unpack('=?',data[28:29])[0])
-        unpacked_snapv2_2    = int(struct.unpack('=?',data[29:30])[0])
-        unpacked_snapv2_3    = int(struct.unpack('=?',data[30:31])[0])
-        unpacked_mac[0]=hex(ord(struct.unpack('=s',data[31:32])[0]))
-        unpacked_mac[1]=hex(ord(struct.unpack('=s',data[32:33])[0]))
-        unpacked_mac[2]=hex(ord(struct.unpack('=s',data[33:34])[0]))
-        unpacked_mac[3]=hex(ord(struct.unpack('=s',data[34:35])[0]))
-        unpacked_mac[4]=hex(ord(struct.unpack('=s',data[35:36])[0]))
-        unpacked_mac[5]=hex(ord(struct.unpack('=s',data[36:37])[0]))
-        unpacked_nodeID = struct.unpack('=B',data[37:38])
-        unpacked_nodeID_metadata = struct.unpack('=B',data[38:39])[0]
-        
-        node = unpacked_nodeID[0]
-        mac_str = ':'.join((unpacked_mac[i][2:]).zfill(2) for i in range(len(unpacked_mac))) 
-        data_dict = {'mac':mac_str,
-        'ip':addr[0],
-        'node_ID':node,
-        'node_ID_metadata':unpacked_nodeID_metadata,
-        'temp_top': unpacked_mcptemp_top,
-        'temp_mid': unpacked_mcptemp_mid,
-        'temp_bot': unpacked_mcptemp_bot,
-        'temp_humid': unpacked_htutemp,
-        'humid': unpacked_htuhumid,
-        'power_snap_relay': unpacked_snap_relay,
-        'power_fem': unpacked_fem,
-        'power_pam': unpacked_pam,
-        'power_snap_0': unpacked_snapv2_0,
-        'power_snap_1': unpacked_snapv2_1,
-        'power_snap_2': unpacked_snapv2_2,
-        'power_snap_3': unpacked_snapv2_3,
-        'cpu_uptime_ms': unpacked_cpu_uptime,
-        'timestamp':str(datetime.datetime.now()),
-        }
-
-        r.hmset('status:node:%d'%node, data_dict)
-        # Write the version of this software to redis
-        r.hmset("version:%s:%s" % (__package__, os.path.basename(__file__)), {"version":__version__, "timestamp":datetime.datetime.now().isoformat()})
-
-        #print(r.hgetall('status:node:%d'%node))
+        nbytes, addr = client_socket.recvfrom_into(data)
+        stats[0] += 1
+        if nbytes < STATUS_PACKET_SIZE:
+            stats[1] += 1
+            print('Ignoring %d byte packet from %s' % (nbytes, addr[0]), file=sys.stderr)
+            continue
+        # Arduino sends its status struct via UDP, decode it in place
+        packet.decode_into(status, data_view)
+        data_dict = status.to_status_dict(addr[0], time.time())
+        try:
+            writer.write({status.node_ID: data_dict})
+        except redis.exceptions.RedisError as e:
+            print('Failed to write status of node %d to redis: %s' % (status.node_ID, e), file=sys.stderr)
+
+def run_receiver(stats, reuseport=False, publish_stats=True):
+    """
+    Bind the receive socket, connect to redis and receive packets forever, using the
+    mode chosen on the command line. Counters ordered like receiver.STAT_FIELDS are kept in `stats`.
+    """
+    # Instantiate redis object connected to redis server running on localhost
+    r = redis.StrictRedis(host=args.redishost, port=args.redisport)
+
+    # Create a UDP socket and bind it to local host and port
+    try:
+        client_socket = receiver.create_socket(rcvbuf=args.rcvbuf, blocking=not (args.batch or args.threaded),
+                                               reuseport=reuseport)
+        print('Bound socket', file=sys.stderr)
+    except socket.error as msg:
+        print('Failed to create socket: %s' % msg, file=sys.stderr)
+        sys.exit(1)
+
+    if args.threaded:
+        run_threaded(client_socket, r, stats, publish_stats)
+    elif args.batch:
+        run_batched(client_socket, r, stats, publish_stats)
+    else:
+        run_unbatched(client_socket, r, stats)
+
+def run_worker(worker_id, stats):
+    """
+    Entry point of a forked receiver process.
+    """
+    try:
+        run_receiver(stats, reuseport=True, publish_stats=False)
+    except KeyboardInterrupt:
+        pass
+
+def supervise(nworkers):
+    """
+    Fork `nworkers` receiver processes, restart any that exit, and publish
+    their summed statistics to redis.
+    """
+    ctx = multiprocessing.get_context('fork')
+    r = redis.StrictRedis(host=args.redishost, port=args.redisport)
+    workers = [None] * nworkers
+    worker_stats = [None] * nworkers
+    # Counts accumulated by workers which have since exited
+    retired_stats = [0] * len(receiver.STAT_FIELDS)
+    restarts = 0
+    next_stats = 0
+    try:
+        while True:
+            for i in range(nworkers):
+                if workers[i] is not None and workers[i].is_alive():
+                    continue
+                if workers[i] is not None:
+                    print('Receiver worker %d exited with code %s, restarting' % (i, workers[i].exitcode), file=sys.stderr)
+                    retired_stats = [a + b for a, b in zip(retired_stats, worker_stats[i])]
+                    restarts += 1
+                    # Don't spin if workers die straight away, e.g. because redis is down
+                    time.sleep(1)
+                worker_stats[i] = ctx.Array('q', len(receiver.STAT_FIELDS), lock=False)
+                workers[i] = ctx.Process(target=run_worker, args=(i, worker_stats[i]), name='receiver-%d' % i)
+                workers[i].daemon = True
+                workers[i].start()
+
+            now = time.time()
+            if now >= next_stats:
+                totals = list(retired_stats)
+                for s in worker_stats:
+                    totals = [a + b for a, b in zip(totals, s)]
+                stats = stats_dict(totals)
+                stats['workers'] = nworkers
+                stats['restarts'] = restarts
+                try:
+                    r.hset(stats_key, mapping=stats)
+                except redis.exceptions.RedisError as e:
+                    print('Failed to publish receiver stats: %s' % e, file=sys.stderr)
+                next_stats = now + args.stats_interval
+
+            # Wake up as soon as a worker exits, or when stats are next due
+            multiprocessing.connection.wait([w.sentinel for w in workers], timeout=max(next_stats - time.time(), 0))
+    finally:
+        for w in workers:
+            if w is not None and w.is_alive():
+                w.terminate()
+
+try:
+    if args.workers > 1:
+        supervise(args.workers)
+    else:
+        run_receiver([0] * len(receiver.STAT_FIELDS))
 
 except KeyboardInterrupt:
     print('Interrupted', file=sys.stderr)
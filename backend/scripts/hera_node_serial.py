@@ -1,42 +1,117 @@
 """
-This class is used for receiving debug messages on port 8890 from all the active Arduinos.
+Receives the debug messages all the active Arduinos send to port 8890, and logs them.
+
+Each datagram is timestamped on arrival and attributed to a node by looking its source
+address up in the node registry kept by the receiver. It's appended to that node's log
+file in --dir, serial_node_<id>.log, or serial_<ip>.log for an unknown address. Logs are
+rotated at --max-bytes and each has a time index, so hera_node_serial_dump.py can find
+the messages from a node in a time window without reading whole logs.
+
+The number of messages and bytes from each node, and its message rate over the last
+--stats-interval seconds, are published in the stats:serial:node:<id> hashes.
 """
 
+import argparse
 import datetime
+import os
+import select
 import socket
 import sys
+import time
+import redis
+import nodeControl
+from udpSender import __version__, __package__
+from udpSender.receiver import create_socket
+from udpSender.seriallog import serialPort, SerialLogWriter, SERIAL_STATS_KEY
 
-# Define PORT for socket creation
-serialPort = 8890
-serverAddress = '10.80.2.1'
+hostname = socket.gethostname()
+script_redis_key = "status:script:%s:%s" % (hostname, __file__)
+version_key = "version:%s:%s" % (__package__, os.path.basename(__file__))
 
-# define socket address for binding; necessary for receiving data from Arduino 
-localSocket = (serverAddress, serialPort)
+parser = argparse.ArgumentParser(description = 'Log the debug messages of all nodes to per-node files',
+                                    formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-r', dest='redishost', type=str, default='redishost', help = 'IP or hostname string of host running the monitor redis server.')
+parser.add_argument('-a', dest='address', type=str, default='0.0.0.0', help = 'Local address to receive debug messages on')
+parser.add_argument('--dir', dest='directory', type=str, default='.', help = 'Directory to write the log files in')
+parser.add_argument('--max-bytes', dest='max_bytes', type=int, default=64 * 1024 * 1024,
+                    help = 'Size, in bytes, at which each node\'s log is rotated')
+parser.add_argument('--backups', type=int, default=10, help = 'Number of rotated logs kept for each node')
+parser.add_argument('--flush-interval', dest='flush_interval', type=float, default=1.0,
+                    help = 'Maximum time, in seconds, a message waits before being written to its log file')
+parser.add_argument('--refresh-interval', dest='refresh_interval', type=float, default=10.0,
+                    help = 'Time, in seconds, between checks of the node registry for new or changed nodes')
+parser.add_argument('--stats-interval', dest='stats_interval', type=float, default=10.0,
+                    help = 'Time, in seconds, between publishing message counters')
+args = parser.parse_args()
+
+r = redis.StrictRedis(host=args.redishost)
+registry = nodeControl.NodeRegistry(redis_conn=r)
+writer = SerialLogWriter(args.directory, args.max_bytes, args.backups)
+# Dictionary of IP address -> node ID
+sources = {}
+
+
+def refresh_sources():
+    global sources
+    try:
+        registry.refresh()
+    except redis.exceptions.RedisError as e:
+        print('Failed to read the node registry: %s' % e, file=sys.stderr)
+        return
+    sources = {registry.ip(node): node for node in registry if registry.ip(node) is not None}
+
+
+def publish_stats(interval, previous):
+    """
+    Publish the counters of every source, and their message rates since `previous`, the
+    message counts at the last call.
+    """
+    pipe = r.pipeline(transaction=False)
+    for source, (messages, nbytes, last_time) in writer.counts.items():
+        pipe.hset(SERIAL_STATS_KEY % source, mapping={
+            "messages": messages,
+            "bytes": nbytes,
+            "rate": round((messages - previous.get(source, 0)) / interval, 3),
+            "last_message": datetime.datetime.fromtimestamp(last_time).isoformat(),
+        })
+    pipe.set(script_redis_key, "alive", ex=60)
+    pipe.hset(version_key, mapping={"version": __version__, "timestamp": datetime.datetime.now().isoformat()})
+    pipe.execute()
 
-# Create a UDP socket
-try:
-    client_socket= socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # Set these options so multiple processes can connect to this socket
-    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    print('Socket created')
-except socket.error as msg:
-    print(('Failed to create socket. Error Code : ' + str(msg[0]) + ' Message ' + str(msg[1])))
-    sys.exit()
 
-# Bind socket to local host and port
 try:
-    client_socket.bind(localSocket)
-    print('Bound socket')
+    sock = create_socket(args.address, serialPort)
 except socket.error as msg:
-    print(('Bind failed. Error Code : ' + str(msg[0]) + ' Message ' + msg[1]))
-    sys.exit()
+    print('Failed to bind %s:%d: %s' % (args.address, serialPort, msg), file=sys.stderr)
+    sys.exit(1)
+
+refresh_sources()
+last_flush_time = last_refresh_time = last_stats_time = time.time()
+last_counts = {}
 
 try:
     while True:
-        # Receive data continuously from all active Arduinos
-        data, addr =  client_socket.recvfrom(2048)
-        print(data)
-        print((datetime.datetime.now()))
+        readable, _, _ = select.select([sock], [], [], args.flush_interval)
+        if readable:
+            data, addr = sock.recvfrom(2048)
+            writer.write(sources.get(addr[0], addr[0]), time.time(), data)
+
+        now = time.time()
+        if now > last_flush_time + args.flush_interval:
+            writer.flush()
+            last_flush_time = now
+        if now > last_refresh_time + args.refresh_interval:
+            refresh_sources()
+            last_refresh_time = now
+        if now > last_stats_time + args.stats_interval:
+            try:
+                publish_stats(now - last_stats_time, last_counts)
+            except redis.exceptions.RedisError as e:
+                print('Failed to publish message counters: %s' % e, file=sys.stderr)
+            last_counts = {source: counts[0] for source, counts in writer.counts.items()}
+            last_stats_time = now
+
 except KeyboardInterrupt:
-    print('Interrupted')
+    writer.close()
+    print('Interrupted', file=sys.stderr)
     sys.exit(0)
@@ -1,21 +1,35 @@
-import os 
-import time
+"""
+Prints the debug messages logged by hera_node_serial.py from one node in a time window,
+using the time index of each log file rather than reading whole logs.
+"""
+
 import argparse
 import sys
+import time
+import dateutil.parser
+from udpSender.seriallog import read_messages
 
-parser = argparse.ArgumentParser(description = 'This scripts dumps the serial output of all of the Arduinos into a text file every x seconds - default is 300.',
-                                    formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('file_name', action = 'store', help = 'Specify the file name to dump Redis data to i.e. datasetMMDDYY.txt')
-parser.add_argument('-t', action = 'store', dest = 'interval', default = 300, help = 'Specify the time interval, in seconds, for data collection')
 
+def parse_time(s):
+    if s is None:
+        return None
+    return time.mktime(dateutil.parser.parse(s).timetuple())
+
+
+parser = argparse.ArgumentParser(description = 'Print the debug messages logged from a node between two times',
+                                    formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('node', action = 'store', help = 'Node ID, or IP address of a node not in the node registry')
+parser.add_argument('--dir', dest='directory', type=str, default='.', help = 'Directory of the log files written by hera_node_serial.py')
+parser.add_argument('--start', type=str, default=None, help = 'Local date and time of the first message, e.g. "2018-07-04 12:00". Defaults to the oldest message.')
+parser.add_argument('--end', type=str, default=None, help = 'Local date and time of the last message. Defaults to the newest message.')
+parser.add_argument('--backups', type=int, default=10, help = 'Number of rotated logs kept by hera_node_serial.py')
 args = parser.parse_args()
 
-try:
-    while True:
-        os.system("python hera_node_serial.py >> %s"%args.file_name)
-        time.sleep(float(args.interval))
+source = int(args.node) if args.node.isdigit() else args.node
 
+try:
+    for t, message in read_messages(args.directory, source, parse_time(args.start), parse_time(args.end), args.backups):
+        print('%s %s' % (t.isoformat(), message))
 except KeyboardInterrupt:
-    print('Interrupted')
+    print('Interrupted', file=sys.stderr)
     sys.exit(0)
-
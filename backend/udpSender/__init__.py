@@ -1,2 +1,8 @@
 from .__version__ import __version__
 from .udpSender import *
+from . import packet
+from .packet import StatusPacket, STATUS_PACKET_SIZE
+from .scheduler import CommandScheduler
+from . import acks
+from .acks import AckTracker
+from . import registry
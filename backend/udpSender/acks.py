@@ -0,0 +1,197 @@
+"""
+Tracking of sent commands until the node's status confirms them.
+
+nodeControl gives each command an ID, which travels with it through the node's command
+queue. Once a command is sent, the dispatcher tracks it here and watches the node's
+status:node:x hash for the power bit the command should set. Commands which aren't
+confirmed in time are retried with backoff, and every outcome is recorded in redis.
+"""
+
+import json
+import time
+
+# Hash describing each command, written by nodeControl and updated by the dispatcher
+COMMAND_STATUS_KEY = "commands:status:%s"
+# List pushed to once a command reaches a final state, for nodeControl to BLPOP on
+COMMAND_DONE_KEY = "commands:done:%s"
+# Hash of outcome counters, summed over all commands
+COMMAND_STATS_KEY = "stats:commands"
+# List of recent end-to-end command latencies, in seconds
+COMMAND_LATENCY_KEY = "stats:commands:latency"
+# Number of latencies kept in COMMAND_LATENCY_KEY
+COMMAND_LATENCY_LEN = 1000
+# Time, in seconds, command records are kept in redis
+COMMAND_RECORD_TTL = 3600
+
+
+class TrackedCommand(object):
+    """
+    A command sent to a node, waiting for the node's status to confirm it. Several
+    requests for the same command which were sent together share one TrackedCommand.
+    """
+
+    __slots__ = ('node', 'control', 'value', 'ids', 'attempts', 'sent_time', 'deadline')
+
+    def __init__(self, node, control, value, ids, sent_time, deadline):
+        self.node = node
+        self.control = control
+        self.value = value
+        # List of (command ID, time queued) tuples
+        self.ids = ids
+        self.attempts = 1
+        self.sent_time = sent_time
+        self.deadline = deadline
+
+
+class AckTracker(object):
+    """
+    Keeps the commands which have been sent but not yet confirmed by node status, and
+    decides when they should be retried or given up on.
+    """
+
+    def __init__(self, ack_timeout=5.0, max_attempts=3, backoff=2.0, clock=time.time):
+        """
+        :param ack_timeout: Time, in seconds, to wait for confirmation of the first attempt.
+                            Nodes report their status about every second.
+        :param max_attempts: Number of times a command is sent before it is declared failed
+        :param backoff: Factor by which the wait grows for each retry
+        :param clock: Function returning the current time, in seconds
+        """
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.clock = clock
+        # Dictionary of (node, control) -> TrackedCommand
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def nodes(self):
+        """
+        Return the set of nodes with commands waiting for confirmation.
+        """
+        return set(node for node, _ in self.pending.keys())
+
+    def track(self, node, control, value, ids):
+        """
+        Start tracking a command which has just been sent.
+
+        :param node: Node ID
+        :param control: Power control name, e.g. 'power_pam'
+        :param value: 'on' or 'off'
+        :param ids: List of (command ID, time queued) tuples of the requests this command satisfies
+        :return: The TrackedCommand this replaces, if any, else None
+        """
+        now = self.clock()
+        replaced = self.pending.pop((node, control), None)
+        if replaced is not None and replaced.value == value:
+            # Same command sent again; the earlier requests are confirmed by the same bit
+            ids = replaced.ids + ids
+            replaced = None
+        self.pending[(node, control)] = TrackedCommand(node, control, value, ids, now, now + self.ack_timeout)
+        return replaced
+
+    def check(self, node, power):
+        """
+        Check a node's reported power state against its pending commands.
+
+        :param node: Node ID
+        :param power: Dictionary of power control name -> bool
+        :return: List of TrackedCommand instances which are now confirmed
+        """
+        acked = []
+        for (n, control), cmd in list(self.pending.items()):
+            if n == node and control in power and power[control] == (cmd.value == 'on'):
+                acked.append(self.pending.pop((n, control)))
+        return acked
+
+    def expired(self):
+        """
+        Find the pending commands whose wait for confirmation has run out.
+
+        :return: Tuple `(retry, failed)` of lists of TrackedCommand instances. Commands in `retry`
+                 should be sent again, and `retried` called for each. Commands in `failed`
+                 have used up their attempts and are no longer tracked.
+        """
+        now = self.clock()
+        retry = []
+        failed = []
+        for key, cmd in list(self.pending.items()):
+            if cmd.deadline > now:
+                continue
+            if cmd.attempts >= self.max_attempts:
+                failed.append(self.pending.pop(key))
+            else:
+                retry.append(cmd)
+        return retry, failed
+
+    def retried(self, cmd):
+        """
+        Record that `cmd` has been sent again.
+        """
+        now = self.clock()
+        cmd.attempts += 1
+        cmd.sent_time = now
+        cmd.deadline = now + self.ack_timeout * self.backoff ** (cmd.attempts - 1)
+
+    def abandon(self, cmd):
+        """
+        Stop tracking `cmd`, e.g. because it has been superseded by a different command.
+        """
+        if self.pending.get((cmd.node, cmd.control)) is cmd:
+            del self.pending[(cmd.node, cmd.control)]
+
+
+def parse_power(values, controls):
+    """
+    Convert the raw values of `controls` read from a status:node:x hash with HMGET into
+    a dictionary of control -> bool, omitting missing values.
+    """
+    return {c: v in (b'1', '1') for c, v in zip(controls, values) if v is not None}
+
+
+def record_state(pipe, ids, state, node=None, control=None, value=None, attempts=None):
+    """
+    Queue redis commands on `pipe` recording the state of each command in `ids`,
+    a list of (command ID, time queued) tuples. States 'acked', 'failed', 'superseded'
+    and 'sent' (for commands which can't be confirmed, like reset) are final: they are pushed
+    to the command's done list, counted in the command statistics, and, for 'acked', the
+    end-to-end latency is recorded.
+    """
+    now = time.time()
+    final = state in ('acked', 'failed', 'superseded', 'sent')
+    for cmd_id, queued_time in ids:
+        key = COMMAND_STATUS_KEY % cmd_id
+        record = {'state': state, '%s_time' % state: now}
+        if node is not None:
+            record['node'] = node
+        if control is not None:
+            record['cmd'] = control
+        if value is not None:
+            record['value'] = value
+        if attempts is not None:
+            record['attempts'] = attempts
+        if state == 'acked' and queued_time:
+            record['latency_sec'] = now - queued_time
+            pipe.lpush(COMMAND_LATENCY_KEY, now - queued_time)
+            pipe.ltrim(COMMAND_LATENCY_KEY, 0, COMMAND_LATENCY_LEN - 1)
+        pipe.hset(key, mapping=record)
+        pipe.expire(key, COMMAND_RECORD_TTL)
+        if final:
+            pipe.rpush(COMMAND_DONE_KEY % cmd_id, json.dumps(record))
+            pipe.expire(COMMAND_DONE_KEY % cmd_id, COMMAND_RECORD_TTL)
+            pipe.hincrby(COMMAND_STATS_KEY, state, 1)
+
+
+def parse_queued(payload):
+    """
+    Decode a command popped from a commands:queue:node:x list.
+
+    :return: Tuple `(control, ids)`, where `ids` is a list of one (command ID, time queued) tuple,
+             or empty if the command was queued without an ID.
+    """
+    cmd = json.loads(payload)
+    if cmd.get('id') is None:
+        return cmd['cmd'], []
+    return cmd['cmd'], [(cmd['id'], cmd.get('time', 0))]
@@ -0,0 +1,10 @@
+"""
+asyncio implementation of the node backend daemons: the status receiver, keep-alive poker
+and command dispatcher, running on one event loop with a shared redis client and node table.
+"""
+
+from .nodes import NodeTable, NodeEntry
+from .receiver import StatusProtocol, write_statuses
+from .keepalive import keep_alive
+from .dispatch import CommandDispatcher
+from .backend import run_backend
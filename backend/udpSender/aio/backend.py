@@ -0,0 +1,81 @@
+"""
+Runs the status receiver, keep-alive poker and command dispatcher together on one event loop.
+"""
+
+import asyncio
+import socket
+
+import redis.asyncio
+
+from .. import receiver as sync_receiver
+from ..history import HistoryWriter
+from ..rollup import RollupWriter
+from ..publish import StatusPublisher
+from ..udpSender import sendPort, serverAddress
+from .nodes import NodeTable
+from .receiver import StatusProtocol, write_statuses
+from .keepalive import keep_alive
+from .dispatch import CommandDispatcher
+
+
+async def run_backend(redishost='redishost', redisport=6379, script_name='hera_node_backend.py', version='',
+                      poke_time_sec=1.0, cmd_check_sec=0.05, cmd_time_sec=2.0, flush_interval=0.1,
+                      legacy_commands=False, history_maxlen=0, history_retention=None, rollups=True,
+                      publish=True, delta=False, temp_deadband=0.0, humid_deadband=0.0):
+    """
+    Run the node backend until cancelled.
+
+    :param redishost: Hostname or IP address of the monitor redis server
+    :param redisport: Port of the monitor redis server
+    :param script_name: Name under which the backend's liveness and version keys are written
+    :param version: Version string written to the version key
+    :param poke_time_sec: Time between keep-alive pokes, in seconds
+    :param cmd_check_sec: Time between checks for new commands, in seconds
+    :param cmd_time_sec: Minimum time between commands sent to one node, in seconds
+    :param flush_interval: Time between writes of received statuses to redis, in seconds
+    :param legacy_commands: If True, poll the command triggers instead of waiting on the command queues
+    :param history_maxlen: Approximate number of status samples kept in each node's history stream.
+                           0 to keep no history.
+    :param history_retention: If not None, keep the samples from about the last `history_retention`
+                              seconds instead
+    :param rollups: If True, keep the 1 minute, 10 minute and 1 hour sensor rollups of each node
+    :param publish: If True, publish each status to the node's updates and changes channels
+    :param delta: If True, only write the fields of each node's status which have changed
+    :param temp_deadband: In delta mode, smallest temperature change written, in degrees C
+    :param humid_deadband: In delta mode, smallest relative humidity change written, in percent
+    """
+    hostname = socket.gethostname()
+    script_redis_key = "status:script:%s:%s" % (hostname, script_name)
+    version_key = "version:%s:%s" % (__package__.split('.')[0], script_name)
+    stats_key = "stats:receiver:%s" % hostname
+
+    r = redis.asyncio.Redis(host=redishost, port=redisport)
+    nodes = NodeTable()
+    await nodes.load(r)
+
+    loop = asyncio.get_running_loop()
+    status_sock = sync_receiver.create_socket(blocking=False)
+    _, protocol = await loop.create_datagram_endpoint(lambda: StatusProtocol(nodes), sock=status_sock)
+    # Commands and pokes go out from the same port as the UdpSender class uses
+    cmd_sock = sync_receiver.create_socket(serverAddress, sendPort, blocking=False)
+    cmd_transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, sock=cmd_sock)
+
+    history = None
+    if history_maxlen > 0 or history_retention is not None:
+        history = HistoryWriter(history_maxlen, history_retention)
+
+    status_delta = None
+    if delta:
+        status_delta = sync_receiver.StatusDelta(sync_receiver.sensor_deadbands(temp_deadband, humid_deadband))
+
+    dispatcher = CommandDispatcher(r, cmd_transport, nodes, cmd_check_sec, cmd_time_sec, legacy=legacy_commands)
+    try:
+        await asyncio.gather(
+            write_statuses(r, protocol, script_redis_key, version_key, version, stats_key, flush_interval,
+                           history=history, rollup=RollupWriter() if rollups else None,
+                           publisher=StatusPublisher() if publish else None, delta=status_delta),
+            keep_alive(r, cmd_transport, nodes, poke_time_sec),
+            dispatcher.run(),
+        )
+    finally:
+        await r.aclose()
@@ -0,0 +1,294 @@
+"""
+asyncio implementation of the command checker, which forwards commands
+set in the commands:node:x redis hashes to the Arduinos, and tracks queued commands
+until node status confirms them.
+"""
+
+# Key of each node's command queue, which nodeControl pushes commands onto
+COMMAND_QUEUE_KEY = "commands:queue:node:%d"
+
+import asyncio
+import sys
+import time
+
+import redis
+
+from ..udpSender import sendPort, POWER_CONTROLS, COMMAND_PAYLOADS, sweep_order
+from .. import acks
+
+
+class CommandDispatcher(object):
+    """
+    Waits for commands to be pushed onto the nodes' command queues, or in legacy mode checks
+    redis for command triggers on all nodes with one pipeline per check, and sends the commands,
+    spaced by at least `cmd_time_sec` on each node. Nodes are throttled independently, so a node
+    waiting out its throttle doesn't hold up the others. Queued commands are sent in the order
+    they were queued, and any others in the order given by `sweep_order`.
+    """
+
+    def __init__(self, redis_conn, transport, nodes, cmd_check_sec=0.05, cmd_time_sec=2.0,
+                 legacy=False, sweep_sec=10.0, ack_check_sec=0.25):
+        """
+        :param redis_conn: redis.asyncio.Redis instance
+        :param transport: asyncio datagram transport to send commands from
+        :param nodes: NodeTable instance
+        :param cmd_check_sec: Time between checks for new commands, in seconds
+        :param cmd_time_sec: Minimum time between commands sent to one node, in seconds
+        :param legacy: If True, poll the command triggers instead of waiting on the command queues
+        :param sweep_sec: Time between sweeps for triggers set without queueing a command, in seconds
+        :param ack_check_sec: Time between checks of node status for confirmation of sent commands, in seconds
+        """
+        self.r = redis_conn
+        self.transport = transport
+        self.nodes = nodes
+        self.cmd_check_sec = cmd_check_sec
+        self.cmd_time_sec = cmd_time_sec
+        self.legacy = legacy
+        self.sweep_sec = sweep_sec
+        self.ack_check_sec = ack_check_sec
+        # Commands sent, waiting for confirmation from node status
+        self.tracker = acks.AckTracker()
+        # Dictionary of (node ID, control) -> list of (command ID, time queued) for commands not yet sent
+        self.pending_ids = {}
+        # Dictionary of node ID -> list of power controls popped from the node's command queue
+        # and not yet sent, in the order they were queued
+        self.queued = {}
+        # References to running dispatch tasks, so they aren't garbage collected
+        self.tasks = set()
+
+    def send(self, entry, payload):
+        self.transport.sendto(payload, (entry.ip, sendPort))
+
+    async def check(self, entries=None):
+        """
+        Read the command hashes of idle nodes, and start a dispatch task for each one with triggers set.
+
+        :param entries: NodeEntry instances of the nodes to check. Defaults to all nodes.
+        """
+        entries = [entry for entry in (self.nodes if entries is None else entries) if not entry.busy]
+        if not entries:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        for entry in entries:
+            pipe.hgetall('commands:node:%d' % entry.node)
+        for entry, cmds in zip(entries, await pipe.execute()):
+            cmds = {key.decode(): val.decode() for key, val in cmds.items()}
+            if cmds.get('reset') == 'True':
+                self.send(entry, b'reset')
+                await self.r.hset('commands:node:%d' % entry.node, 'reset', 'False')
+            controls = self.order_controls(entry.node, cmds)
+            if controls:
+                entry.busy = True
+                task = asyncio.ensure_future(self.dispatch(entry))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    def order_controls(self, node, cmds):
+        """
+        Return the power controls with triggers set in the node's decoded commands:node:x hash
+        `cmds`, in the order to send them: those popped from the node's command queue first,
+        in the order they were queued, then the rest in `sweep_order`.
+        """
+        triggered = [c for c in POWER_CONTROLS if cmds.get('%s_ctrl_trig' % c) == 'True']
+        # Controls whose trigger has been cleared were sent by an earlier sweep
+        queued = [c for c in self.queued.pop(node, ()) if c in triggered]
+        if queued:
+            self.queued[node] = queued
+        commands = {c: cmds.get('%s_cmd' % c) for c in triggered}
+        return queued + [c for c in sweep_order(triggered, commands) if c not in queued]
+
+    async def dispatch(self, entry):
+        """
+        Send the triggered commands to the node described by `entry`, one at a time, waiting out
+        the node's throttle before each one. Commands triggered in the meantime are sent before
+        the task finishes.
+        """
+        key = 'commands:node:%d' % entry.node
+        try:
+            while True:
+                wait = entry.last_command + self.cmd_time_sec - time.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                # Pick the next command after waiting, so commands queued in the meantime take their
+                # place in line, and changes to the commands are seen
+                cmds = await self.r.hgetall(key)
+                cmds = {k.decode(): v.decode() for k, v in cmds.items()}
+                controls = self.order_controls(entry.node, cmds)
+                if not controls:
+                    break
+                await self.dispatch_one(entry, key, controls[0], cmds.get('%s_cmd' % controls[0]))
+        except redis.exceptions.RedisError as e:
+            print('Failed to dispatch commands to node %d: %s' % (entry.node, e), file=sys.stderr)
+        finally:
+            entry.busy = False
+
+    async def dispatch_one(self, entry, key, control, command):
+        """
+        Send `command`, 'on' or 'off', for `control` to a node, and clear its trigger.
+        """
+        command = 'on' if command == 'on' else 'off'
+        self.send(entry, COMMAND_PAYLOADS[(control, command)])
+        entry.last_command = time.time()
+        queued = self.queued.get(entry.node)
+        if queued and control in queued:
+            queued.remove(control)
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hset(key, '%s_ctrl_trig' % control, 'False')
+        pipe.hset('throttle:node:%d' % entry.node, 'last_command_sec', entry.last_command)
+        await pipe.execute()
+        ids = self.pending_ids.pop((entry.node, control), None)
+        if ids:
+            await self.track(entry, control, command, ids)
+
+    async def track(self, entry, control, command, ids):
+        """
+        Start tracking the command IDs in `ids`, now that `command` has been sent for `control`.
+        Requests for a different command than the one sent have been overridden by a later request.
+        """
+        pipe = self.r.pipeline(transaction=False)
+        for cmd_id, _ in ids:
+            pipe.hget(acks.COMMAND_STATUS_KEY % cmd_id, 'value')
+        values = await pipe.execute()
+        pipe = self.r.pipeline(transaction=False)
+        sent_ids = []
+        for (cmd_id, queued_time), value in zip(ids, values):
+            if value is not None and value.decode() != command:
+                acks.record_state(pipe, [(cmd_id, queued_time)], 'superseded')
+            else:
+                sent_ids.append((cmd_id, queued_time))
+        if sent_ids:
+            acks.record_state(pipe, sent_ids, 'pending', node=entry.node, control=control,
+                              value=command, attempts=1)
+        replaced = self.tracker.track(entry.node, control, command, sent_ids)
+        if replaced is not None:
+            acks.record_state(pipe, replaced.ids, 'superseded')
+        await pipe.execute()
+
+    async def retry(self, entry, cmd):
+        """
+        Send an unconfirmed command again, once the node's throttle has expired.
+        Gives up on the command if a different one has been requested since.
+        """
+        key = 'commands:node:%d' % entry.node
+        try:
+            wait = entry.last_command + self.cmd_time_sec - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            current = await self.r.hget(key, '%s_cmd' % cmd.control)
+            pipe = self.r.pipeline(transaction=False)
+            if current is None or current.decode() != cmd.value:
+                self.tracker.abandon(cmd)
+                acks.record_state(pipe, cmd.ids, 'superseded')
+            else:
+                self.send(entry, COMMAND_PAYLOADS[(cmd.control, cmd.value)])
+                entry.last_command = time.time()
+                self.tracker.retried(cmd)
+                pipe.hset('throttle:node:%d' % entry.node, 'last_command_sec', entry.last_command)
+                acks.record_state(pipe, cmd.ids, 'pending', attempts=cmd.attempts)
+            await pipe.execute()
+        except redis.exceptions.RedisError as e:
+            print('Failed to resend command to node %d: %s' % (entry.node, e), file=sys.stderr)
+        finally:
+            entry.busy = False
+
+    async def check_acks(self):
+        """
+        Read the power state of every node with unconfirmed commands in one pipeline, record the
+        commands which are now confirmed, and start retries of those which have timed out.
+        """
+        node_ids = sorted(self.tracker.nodes())
+        pipe = self.r.pipeline(transaction=False)
+        for node in node_ids:
+            pipe.hmget('status:node:%d' % node, POWER_CONTROLS)
+        states = await pipe.execute()
+        pipe = self.r.pipeline(transaction=False)
+        for node, values in zip(node_ids, states):
+            for cmd in self.tracker.check(node, acks.parse_power(values, POWER_CONTROLS)):
+                acks.record_state(pipe, cmd.ids, 'acked', attempts=cmd.attempts)
+        retry, failed = self.tracker.expired()
+        for cmd in failed:
+            acks.record_state(pipe, cmd.ids, 'failed', attempts=cmd.attempts)
+            print('Node %d did not confirm %s %s after %d attempts' % (cmd.node, cmd.control, cmd.value, cmd.attempts),
+                  file=sys.stderr)
+        await pipe.execute()
+        for cmd in retry:
+            if cmd.node not in self.nodes:
+                self.tracker.abandon(cmd)
+                continue
+            entry = self.nodes[cmd.node]
+            if entry.busy:
+                # Try again on a later check, once the node's other commands are sent
+                continue
+            entry.busy = True
+            task = asyncio.ensure_future(self.retry(entry, cmd))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def ack_loop(self):
+        """
+        Check for confirmation of sent commands every `ack_check_sec` seconds.
+        """
+        while True:
+            await asyncio.sleep(self.ack_check_sec)
+            if not self.tracker:
+                continue
+            try:
+                await self.check_acks()
+            except redis.exceptions.RedisError as e:
+                print('Failed to check command confirmations: %s' % e, file=sys.stderr)
+
+    async def wait_queued(self):
+        """
+        Wait up to a second for a command to be pushed onto any node's command queue,
+        and check the triggers of the node it was pushed for.
+        """
+        queue_keys = {COMMAND_QUEUE_KEY % entry.node: entry for entry in self.nodes}
+        if not queue_keys:
+            await asyncio.sleep(1)
+            return
+        item = await self.r.blpop(list(queue_keys.keys()), timeout=1)
+        if item is None:
+            return
+        entry = queue_keys[item[0].decode()]
+        control, ids = acks.parse_queued(item[1])
+        if control != 'reset':
+            queued = self.queued.setdefault(entry.node, [])
+            if control not in queued:
+                queued.append(control)
+        if ids and control != 'reset':
+            self.pending_ids.setdefault((entry.node, control), []).extend(ids)
+        await self.check([entry])
+        if ids and control == 'reset':
+            # Nothing in the node status confirms a reset
+            pipe = self.r.pipeline(transaction=False)
+            acks.record_state(pipe, ids, 'sent', node=entry.node, control=control)
+            await pipe.execute()
+        elif ids and not entry.busy:
+            # The trigger was already cleared, so the command was sent by an earlier command or sweep
+            ids = self.pending_ids.pop((entry.node, control), None)
+            if ids:
+                command = await self.r.hget('commands:node:%d' % entry.node, '%s_cmd' % control)
+                await self.track(entry, control, 'on' if command == b'on' else 'off', ids)
+
+    async def run(self):
+        """
+        Dispatch commands forever. In legacy mode, check for commands every `cmd_check_sec`
+        seconds. Otherwise wait on the command queues, and sweep all nodes' triggers every `sweep_sec`
+        seconds to pick up commands from clients which don't queue them.
+        """
+        loop = asyncio.get_running_loop()
+        next_sweep = 0
+        ack_task = asyncio.ensure_future(self.ack_loop())
+        self.tasks.add(ack_task)
+        while True:
+            try:
+                if self.legacy or loop.time() >= next_sweep:
+                    await self.check()
+                    next_sweep = loop.time() + self.sweep_sec
+                if self.legacy:
+                    await asyncio.sleep(self.cmd_check_sec)
+                else:
+                    await self.wait_queued()
+            except redis.exceptions.RedisError as e:
+                print('Failed to check for commands: %s' % e, file=sys.stderr)
+                await asyncio.sleep(1)
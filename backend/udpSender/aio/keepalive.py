@@ -0,0 +1,76 @@
+"""
+asyncio implementation of the keep-alive poker.
+"""
+
+import asyncio
+import sys
+import time
+
+import redis
+
+from ..udpSender import sendPort
+
+
+async def record_pokes(redis_conn, latest, ready, retry_sec=1.0):
+    """
+    Write poke times to the throttle:node:x hashes as keep_alive records them, with one pipeline
+    per tick. Only the latest tick is kept, so if redis falls behind, intermediate ticks are
+    skipped rather than queued up.
+
+    :param redis_conn: redis.asyncio.Redis instance
+    :param latest: List holding the latest unwritten `(node IDs, poke time)` tuple, or None
+    :param ready: asyncio.Event set when a tick is recorded
+    :param retry_sec: Time to wait after a failed write, in seconds
+    """
+    while True:
+        await ready.wait()
+        ready.clear()
+        nodes, poke_time = latest[0]
+        latest[0] = None
+        pipe = redis_conn.pipeline(transaction=False)
+        for node in nodes:
+            pipe.hset('throttle:node:%d' % node, 'last_poke_sec', poke_time)
+        try:
+            await pipe.execute()
+        except redis.exceptions.RedisError as e:
+            print('Failed to record poke times in redis: %s' % e, file=sys.stderr)
+            await asyncio.sleep(retry_sec)
+
+
+async def keep_alive(redis_conn, transport, nodes, poke_time_sec=1.0):
+    """
+    Poke every node in `nodes` each `poke_time_sec` seconds, so the Arduinos don't reset.
+    Ticks are scheduled at fixed multiples of `poke_time_sec`, and whole ticks which were missed,
+    e.g. because the event loop was blocked, are skipped rather than sent in a burst. Poke times
+    are written to the throttle:node:x hashes by a separate task, so redis never delays a poke.
+
+    :param redis_conn: redis.asyncio.Redis instance
+    :param transport: asyncio datagram transport to send pokes from
+    :param nodes: NodeTable instance
+    :param poke_time_sec: Time between pokes, in seconds
+    """
+    loop = asyncio.get_running_loop()
+    latest = [None]
+    ready = asyncio.Event()
+    recorder = asyncio.ensure_future(record_pokes(redis_conn, latest, ready))
+    try:
+        start = loop.time()
+        n = 0
+        while True:
+            due = start + n * poke_time_sec
+            now = loop.time()
+            if now < due:
+                await asyncio.sleep(due - now)
+                now = loop.time()
+            if now - due >= poke_time_sec:
+                # Missed whole ticks; realign to the schedule instead of catching up
+                n += int((now - due) // poke_time_sec)
+            poke_time = time.time()
+            entries = list(nodes)
+            for entry in entries:
+                transport.sendto(b'poke', (entry.ip, sendPort))
+            latest[0] = ([entry.node for entry in entries], poke_time)
+            ready.set()
+            n += 1
+    finally:
+        recorder.cancel()
@@ -0,0 +1,126 @@
+"""
+In-memory table of the nodes known to the asyncio backend. It is shared by the
+receiver, keep-alive and command dispatch tasks, so none of them has to scan redis
+for nodes.
+"""
+
+import json
+import sys
+import time
+
+from .. import registry
+
+
+class NodeEntry(object):
+    """
+    What the backend knows about one node.
+    """
+
+    __slots__ = ('node', 'ip', 'mac', 'last_seen', 'last_command', 'busy')
+
+    def __init__(self, node, ip, mac=None, last_seen=0.0):
+        self.node = node
+        self.ip = ip
+        self.mac = mac
+        # Time the last status packet was received from this node
+        self.last_seen = last_seen
+        # Time the last power command was sent to this node, loaded from its throttle:node:x hash
+        self.last_command = 0.0
+        # True while a command dispatch task is running for this node
+        self.busy = False
+
+
+class NodeTable(object):
+    """
+    Dictionary-like table of NodeEntry instances, keyed by node ID.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(list(self.nodes.values()))
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def __getitem__(self, node):
+        return self.nodes[node]
+
+    def update(self, node, ip, mac=None, last_seen=None):
+        """
+        Record that `node` has IP address `ip`, adding it to the table if necessary.
+
+        :return: The node's NodeEntry
+        """
+        entry = self.nodes.get(node)
+        if entry is None:
+            entry = self.nodes[node] = NodeEntry(node, ip, mac)
+            print("Adding node %d with ip %s" % (node, ip), file=sys.stderr)
+        elif entry.ip != ip:
+            print("Updating IP address of node %d to %s" % (node, ip), file=sys.stderr)
+            entry.ip = ip
+        if mac is not None:
+            entry.mac = mac
+        entry.last_seen = time.time() if last_seen is None else last_seen
+        return entry
+
+    async def load(self, redis_conn):
+        """
+        Seed the table from the node registry kept by the receiver, so that nodes can be
+        poked and commanded before their next status packet arrives. Falls back to the
+        status:node:x hashes if there is no registry. The time each node was last sent a command
+        is read from its throttle:node:x hash, so the command throttle carries on across restarts.
+
+        :param redis_conn: redis.asyncio.Redis instance
+        """
+        pipe = redis_conn.pipeline(transaction=False)
+        pipe.hgetall(registry.REGISTRY_KEY)
+        pipe.zrange(registry.LAST_SEEN_KEY, 0, -1, withscores=True)
+        entries, last_seen = await pipe.execute()
+        if entries:
+            last_seen = {int(node): t for node, t in last_seen}
+            for node, entry in entries.items():
+                try:
+                    node = int(node)
+                    entry = json.loads(entry)
+                except ValueError:
+                    continue
+                if entry.get('ip') is None:
+                    continue
+                self.update(node, entry['ip'], entry.get('mac'), last_seen=last_seen.get(node, 0.0))
+            await self.load_throttles(redis_conn)
+            return
+        keys = [key async for key in redis_conn.scan_iter("status:node:*")]
+        pipe = redis_conn.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, 'node_ID', 'ip', 'mac')
+        for node_id, ip, mac in await pipe.execute():
+            try:
+                node = int(node_id)
+            except (TypeError, ValueError):
+                continue
+            if ip is None:
+                continue
+            self.update(node, ip.decode(), None if mac is None else mac.decode(), last_seen=0.0)
+        await self.load_throttles(redis_conn)
+
+    async def load_throttles(self, redis_conn):
+        """
+        Set the last command time of every node from its throttle:node:x hash, written when
+        commands were sent, e.g. before the backend was restarted.
+
+        :param redis_conn: redis.asyncio.Redis instance
+        """
+        entries = list(self.nodes.values())
+        pipe = redis_conn.pipeline(transaction=False)
+        for entry in entries:
+            pipe.hget('throttle:node:%d' % entry.node, 'last_command_sec')
+        for entry, value in zip(entries, await pipe.execute()):
+            try:
+                entry.last_command = max(entry.last_command, float(value))
+            except (TypeError, ValueError):
+                pass
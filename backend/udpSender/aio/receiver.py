@@ -0,0 +1,97 @@
+"""
+asyncio implementation of the status packet receiver.
+"""
+
+import asyncio
+import datetime
+import sys
+import time
+
+import redis
+
+from ..packet import StatusPacket, STATUS_PACKET_SIZE, decode_into
+from ..receiver import StatusWriter
+
+
+class StatusProtocol(asyncio.DatagramProtocol):
+    """
+    Decodes Arduino status packets as they arrive, updating the node table and
+    keeping the latest status of each node until it is written to redis.
+    """
+
+    def __init__(self, nodes):
+        """
+        :param nodes: NodeTable instance shared with the other backend tasks
+        """
+        self.nodes = nodes
+        self.status = StatusPacket()
+        # Dictionary of node ID -> status:node:x hash fields waiting to be written
+        self.pending = {}
+        self.received = 0
+        self.short = 0
+        self.coalesced = 0
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        if len(data) < STATUS_PACKET_SIZE:
+            self.short += 1
+            print('Ignoring %d byte packet from %s' % (len(data), addr[0]), file=sys.stderr)
+            return
+        status = decode_into(self.status, data)
+        self.nodes.update(status.node_ID, addr[0], status.mac)
+        data_dict = status.to_status_dict(addr[0], time.time())
+        if status.node_ID in self.pending:
+            self.coalesced += 1
+        self.pending[status.node_ID] = data_dict
+
+    def take(self):
+        """
+        Remove and return all pending statuses.
+        """
+        pending = self.pending
+        self.pending = {}
+        return pending
+
+
+async def write_statuses(redis_conn, protocol, script_redis_key, version_key, version, stats_key,
+                         flush_interval=0.1, liveness_sec=10.0, history=None, rollup=None, publisher=None,
+                         delta=None):
+    """
+    Write the statuses collected by `protocol` to redis every `flush_interval` seconds,
+    with one pipeline per flush, built by the same StatusWriter as the threaded receiver.
+    The backend's liveness, version and statistics keys are written every `liveness_sec` seconds.
+
+    :param redis_conn: redis.asyncio.Redis instance
+    :param protocol: StatusProtocol instance
+    :param history: HistoryWriter instance to add each status to the node's history stream,
+                    or None to keep no history
+    :param rollup: RollupWriter instance to aggregate each status into the node's rollup buckets,
+                   or None to keep no rollups
+    :param publisher: StatusPublisher instance to publish each status to watchers, or None
+    :param delta: StatusDelta instance to only write the fields of each status which changed,
+                  or None to write every field
+    """
+    writer = StatusWriter(redis_conn, script_redis_key, version_key, version, history, rollup,
+                          publisher, delta, liveness_sec)
+    while True:
+        statuses = protocol.take()
+        now = time.time()
+        pipe = redis_conn.pipeline(transaction=False)
+        if now >= writer.next_liveness:
+            writer.queue(pipe, statuses, now, stats_key, {
+                'received': protocol.received,
+                'short': protocol.short,
+                'coalesced': protocol.coalesced,
+                'timestamp': datetime.datetime.now().isoformat(),
+            })
+        else:
+            writer.queue(pipe, statuses, now)
+        try:
+            await pipe.execute()
+        except redis.exceptions.RedisError as e:
+            print('Failed to write %d statuses to redis: %s' % (len(statuses), e), file=sys.stderr)
+            writer.forget(statuses.keys())
+            # Put back statuses which haven't been superseded while we were waiting
+            for node, data_dict in statuses.items():
+                protocol.pending.setdefault(node, data_dict)
+        await asyncio.sleep(flush_interval)
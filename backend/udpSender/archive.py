@@ -0,0 +1,246 @@
+"""
+Writer of the daily status archive files made by the hera_node_archiver script.
+
+Each UTC day's samples, from all nodes, go in one zip file, `status_YYYYMMDD.npz`, readable
+with numpy.load or nodeControl.StatusArchive. Samples are appended in chunks; chunk N is
+stored as one .npy member per column, `chunkNNNNNN/<column>.npy`, plus a small
+`chunk_index/NNNNNN.npy` member holding [first time, last time, rows]. Once a day is over,
+the file is compacted into one chunk per hour, plus one `index.npy` member, an array of
+(chunk, first time, last time, rows) rows, so readers can pick the chunks covering a time
+window without touching the others.
+"""
+
+import datetime
+import os
+import zipfile
+
+import numpy as np
+
+from .packet import SENSOR_FIELDS, POWER_FIELDS
+
+# Columns of each chunk, and their types. Times are in seconds since the epoch.
+ARCHIVE_COLUMNS = ((('time', 'f8'), ('node', 'i2')) +
+                   tuple((field, 'f4') for field in SENSOR_FIELDS) +
+                   (('cpu_uptime_ms', 'u4'),) +
+                   tuple((field, '?') for field in POWER_FIELDS))
+ARCHIVE_FILE = "status_%Y%m%d.npz"
+CHUNK_MEMBER = "chunk%06d/%s.npy"
+CHUNK_INDEX_MEMBER = "chunk_index/%06d.npy"
+INDEX_MEMBER = "index.npy"
+INDEX_DTYPE = np.dtype([('chunk', 'i4'), ('start', 'f8'), ('end', 'f8'), ('rows', 'i8')])
+
+
+def _to_float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def stream_columns(node, entries):
+    """
+    Convert entries read from a node's status:history:node:x stream into archive columns.
+
+    :param node: Node ID
+    :param entries: List of (entry ID, fields) pairs, as returned by XRANGE or XREAD
+    :return: Dictionary of column name -> list of values
+    """
+    columns = {name: [] for name, _ in ARCHIVE_COLUMNS}
+    for entry_id, sample in entries:
+        columns['time'].append(int(entry_id.split(b'-')[0]) / 1000.0)
+        columns['node'].append(node)
+        for field in SENSOR_FIELDS:
+            columns[field].append(_to_float(sample.get(field.encode())))
+        uptime = _to_float(sample.get(b'cpu_uptime_ms'))
+        columns['cpu_uptime_ms'].append(0 if np.isnan(uptime) else int(uptime))
+        for field in POWER_FIELDS:
+            columns[field].append(sample.get(field.encode()) == b'1')
+    return columns
+
+
+class ColumnBuffer(object):
+    """
+    Growable typed arrays holding the archive columns of samples waiting to be written.
+    Each sample takes only the bytes of its typed values, rather than a python object per value.
+    """
+
+    def __init__(self, capacity=4096):
+        """
+        :param capacity: Initial number of samples the arrays have room for. Doubled as needed.
+        """
+        self.arrays = {name: np.empty(capacity, dtype=dtype) for name, dtype in ARCHIVE_COLUMNS}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, columns):
+        """
+        Append samples to the buffer.
+
+        :param columns: Dictionary of column name -> list of values, as returned by `stream_columns`
+        """
+        n = len(columns['time'])
+        capacity = len(self.arrays['time'])
+        if self.size + n > capacity:
+            while self.size + n > capacity:
+                capacity *= 2
+            for name, a in self.arrays.items():
+                grown = np.empty(capacity, dtype=a.dtype)
+                grown[:self.size] = a[:self.size]
+                self.arrays[name] = grown
+        for name, a in self.arrays.items():
+            a[self.size:self.size + n] = columns[name]
+        self.size += n
+
+    def columns(self):
+        """
+        Return a dictionary of column name -> numpy array of the buffered samples.
+        """
+        return {name: a[:self.size] for name, a in self.arrays.items()}
+
+    def clear(self):
+        self.size = 0
+
+
+class ArchiveWriter(object):
+    """
+    Appends chunks of samples to the daily archive files in `directory`.
+    """
+
+    def __init__(self, directory, compress=True):
+        """
+        :param directory: Directory to write the archive files in
+        :param compress: If True, deflate each member. Uncompressed archives are larger, but
+                         can be memory-mapped by the reader.
+        """
+        self.directory = directory
+        self.compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        # Dictionary of file path -> list of (first time, last time, rows) of its chunks
+        self.chunks = {}
+
+    def path(self, day):
+        """
+        Return the path of the archive file of `day`, a datetime.date.
+        """
+        return os.path.join(self.directory, day.strftime(ARCHIVE_FILE))
+
+    def unfinished_days(self):
+        """
+        Return the days whose archive files in the directory have no time index yet, i.e. which
+        haven't been finished with `finish_day`, e.g. because the archiver was restarted.
+
+        :return: Sorted list of datetime.date
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        days = []
+        for name in os.listdir(self.directory):
+            try:
+                day = datetime.datetime.strptime(name, ARCHIVE_FILE).date()
+            except ValueError:
+                continue
+            try:
+                with zipfile.ZipFile(os.path.join(self.directory, name)) as zf:
+                    if INDEX_MEMBER in zf.namelist():
+                        continue
+            except zipfile.BadZipFile:
+                continue
+            days.append(day)
+        return sorted(days)
+
+    def _load_chunks(self, path):
+        chunks = self.chunks.get(path)
+        if chunks is not None:
+            return chunks
+        chunks = self.chunks[path] = []
+        if os.path.exists(path):
+            with zipfile.ZipFile(path) as zf:
+                names = sorted(n for n in zf.namelist() if n.startswith('chunk_index/'))
+                for name in names:
+                    with zf.open(name) as fh:
+                        chunks.append(tuple(np.lib.format.read_array(fh)))
+        return chunks
+
+    def write(self, columns):
+        """
+        Append rows to the archive, as one chunk per day they span.
+
+        :param columns: Dictionary of column name -> sequence of values, as returned by `stream_columns`
+        :return: Number of rows written
+        """
+        arrays = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in ARCHIVE_COLUMNS}
+        if len(arrays['time']) == 0:
+            return 0
+        order = np.argsort(arrays['time'], kind='stable')
+        arrays = {name: a[order] for name, a in arrays.items()}
+        days = arrays['time'] // 86400
+        for day in np.unique(days):
+            sel = days == day
+            date = datetime.datetime.fromtimestamp(day * 86400, datetime.timezone.utc).date()
+            self._write_chunk(self.path(date), {name: a[sel] for name, a in arrays.items()})
+        return len(order)
+
+    def _write_chunk(self, path, arrays):
+        chunks = self._load_chunks(path)
+        n = len(chunks)
+        times = arrays['time']
+        entry = np.array([times[0], times[-1], len(times)], dtype='f8')
+        with zipfile.ZipFile(path, 'a', compression=self.compression) as zf:
+            for name, a in arrays.items():
+                with zf.open(CHUNK_MEMBER % (n, name), 'w') as fh:
+                    np.lib.format.write_array(fh, a, allow_pickle=False)
+            with zf.open(CHUNK_INDEX_MEMBER % n, 'w') as fh:
+                np.lib.format.write_array(fh, entry, allow_pickle=False)
+        chunks.append(tuple(entry))
+
+    def _read_column(self, zf, chunk, name):
+        with zf.open(CHUNK_MEMBER % (chunk, name)) as fh:
+            return np.lib.format.read_array(fh)
+
+    def finish_day(self, day, compact_sec=3600):
+        """
+        Compact the archive file of `day`, a datetime.date, into one chunk per `compact_sec`
+        seconds, and write its consolidated time index. Call once no more samples from that
+        day will be written.
+
+        Reading a day from a few large chunks is much faster than from the many small ones
+        appended through the day, so the file is rewritten, one time slice at a time to keep
+        memory use down, and then swapped in place of the original.
+        """
+        path = self.path(day)
+        if not os.path.exists(path):
+            return
+        chunks = self._load_chunks(path)
+        starts = np.array([c[0] for c in chunks])
+        ends = np.array([c[1] for c in chunks])
+        day_start = (datetime.datetime(day.year, day.month, day.day) - datetime.datetime(1970, 1, 1)).total_seconds()
+        tmp_path = path + '.tmp'
+        index = []
+        with zipfile.ZipFile(path) as src, zipfile.ZipFile(tmp_path, 'w', compression=self.compression) as dst:
+            for t0 in np.arange(day_start, day_start + 86400, compact_sec):
+                t1 = t0 + compact_sec
+                overlapping = np.flatnonzero((ends >= t0) & (starts < t1))
+                if len(overlapping) == 0:
+                    continue
+                arrays = {name: [] for name, _ in ARCHIVE_COLUMNS}
+                for chunk in overlapping:
+                    times = self._read_column(src, chunk, 'time')
+                    sel = (times >= t0) & (times < t1)
+                    for name, _ in ARCHIVE_COLUMNS:
+                        arrays[name].append(self._read_column(src, chunk, name)[sel])
+                arrays = {name: np.concatenate(a) for name, a in arrays.items()}
+                order = np.argsort(arrays['time'], kind='stable')
+                n = len(index)
+                for name, a in arrays.items():
+                    with dst.open(CHUNK_MEMBER % (n, name), 'w') as fh:
+                        np.lib.format.write_array(fh, a[order], allow_pickle=False)
+                times = arrays['time'][order]
+                entry = np.array([times[0], times[-1], len(times)], dtype='f8')
+                with dst.open(CHUNK_INDEX_MEMBER % n, 'w') as fh:
+                    np.lib.format.write_array(fh, entry, allow_pickle=False)
+                index.append((n,) + tuple(entry))
+            with dst.open(INDEX_MEMBER, 'w') as fh:
+                np.lib.format.write_array(fh, np.array(index, dtype=INDEX_DTYPE), allow_pickle=False)
+        os.replace(tmp_path, path)
+        self.chunks.pop(path, None)
@@ -0,0 +1,44 @@
+"""
+Time-series history of node status, kept by the receiver in one capped redis stream per node.
+"""
+
+from .packet import SENSOR_FIELDS, POWER_FIELDS
+
+# Stream of status samples of each node. Entry IDs are the redis server time, in milliseconds.
+HISTORY_KEY = "status:history:node:%d"
+# Status fields stored with each sample
+HISTORY_FIELDS = SENSOR_FIELDS + POWER_FIELDS + ('cpu_uptime_ms',)
+
+
+class HistoryWriter(object):
+    """
+    Queues an XADD of each node status to the node's history stream. Streams are trimmed
+    either to about `maxlen` entries, or to about the last `retention_sec` seconds, using
+    redis's approximate trimming so that trimming happens a whole macro node at a time.
+    Samples take about 100 bytes of redis memory each, so size `maxlen` or `retention_sec`
+    for the number of nodes: 350 nodes with 100000 samples each is several GB.
+    """
+
+    def __init__(self, maxlen=100000, retention_sec=None):
+        """
+        :param maxlen: Approximate number of samples kept per node. Ignored if `retention_sec` is set.
+        :param retention_sec: If not None, keep samples from about the last `retention_sec` seconds
+                              instead, with XADD MINID. Needs redis 6.2 or later.
+        """
+        self.maxlen = maxlen
+        self.retention_sec = retention_sec
+
+    def add(self, pipe, statuses, now):
+        """
+        Queue a history sample for each node in `statuses` on the redis pipeline `pipe`.
+
+        :param statuses: Dictionary of node ID -> status:node:x hash fields
+        :param now: Current time, in seconds since the epoch, used for MINID trimming
+        """
+        for node, data_dict in statuses.items():
+            sample = {field: data_dict[field] for field in HISTORY_FIELDS if field in data_dict}
+            if self.retention_sec is not None:
+                pipe.xadd(HISTORY_KEY % node, sample, minid=int((now - self.retention_sec) * 1000),
+                          approximate=True)
+            else:
+                pipe.xadd(HISTORY_KEY % node, sample, maxlen=self.maxlen, approximate=True)
@@ -0,0 +1,177 @@
+"""
+Keep-alive engine for the hera_node_keep_alive script. Pokes every node in one burst per tick,
+on a fixed-rate schedule, and leaves all redis traffic to a separate thread so that a slow
+redis server never delays a poke.
+"""
+
+import sys
+import threading
+import time
+
+import redis
+
+from .udpSender import sendPort, POKE_PAYLOAD
+
+# Keep-alive statistics, in the order they are published
+STAT_FIELDS = ('ticks', 'skipped', 'max_late_ms', 'max_burst_ms', 'send_errors')
+
+
+class KeepAliveEngine(object):
+    """
+    Sends a poke to every node each `period` seconds. Ticks are scheduled at fixed multiples of
+    `period` on the monotonic clock, so the cadence doesn't drift with the time taken by each
+    burst. If a tick is missed entirely, e.g. because the process was suspended, the schedule
+    skips ahead rather than sending a flurry of catch-up bursts.
+    """
+
+    def __init__(self, sock, period=1.0, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param sock: UDP socket to send pokes from
+        :param period: Time between pokes to each node, in seconds
+        :param clock: Monotonic clock function, in seconds
+        :param sleep: Function to sleep for a number of seconds
+        """
+        self.sock = sock
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        # List of node IDs, and the (address, port) destination of each one's pokes
+        self.nodes = []
+        self.destinations = []
+        self.stats = dict.fromkeys(STAT_FIELDS, 0)
+
+    def set_nodes(self, nodes):
+        """
+        Replace the set of nodes to poke.
+
+        :param nodes: Dictionary of node ID -> Arduino IP address
+        """
+        node_ids = sorted(nodes.keys())
+        # Swap both lists in at once, so a burst in progress on another thread sees a consistent pair
+        self.nodes, self.destinations = node_ids, [(nodes[node], sendPort) for node in node_ids]
+
+    def burst(self):
+        """
+        Poke every node, as quickly as possible.
+
+        :return: List of the node IDs poked
+        """
+        nodes, destinations = self.nodes, self.destinations
+        sendto = self.sock.sendto
+        poked = []
+        # Python has no sendmmsg, so this is a tight loop of sendto calls with everything prepared in advance
+        for node, destination in zip(nodes, destinations):
+            try:
+                sendto(POKE_PAYLOAD, destination)
+            except OSError:
+                self.stats['send_errors'] += 1
+                continue
+            poked.append(node)
+        return poked
+
+    def run(self, on_tick, ticks=None):
+        """
+        Poke every node each `period` seconds, forever or for `ticks` ticks.
+
+        :param on_tick: Function called after each burst with the list of node IDs poked
+                        and the wall clock time of the burst. It must not block.
+        """
+        start = self.clock()
+        n = 0
+        while ticks is None or n < ticks:
+            due = start + n * self.period
+            now = self.clock()
+            if now < due:
+                self.sleep(due - now)
+                now = self.clock()
+            elif now - due >= self.period:
+                # Missed whole ticks; realign to the schedule instead of catching up
+                missed = int((now - due) // self.period)
+                self.stats['skipped'] += missed
+                n += missed
+                due = start + n * self.period
+            wall_time = time.time()
+            poked = self.burst()
+            burst_time = self.clock() - now
+            self.stats['ticks'] += 1
+            self.stats['max_late_ms'] = max(self.stats['max_late_ms'], (now - due) * 1000)
+            self.stats['max_burst_ms'] = max(self.stats['max_burst_ms'], burst_time * 1000)
+            on_tick(poked, wall_time)
+            n += 1
+
+    def take_stats(self):
+        """
+        Return the statistics gathered since the last call, and reset the maxima.
+        """
+        stats = dict(self.stats)
+        self.stats['max_late_ms'] = 0
+        self.stats['max_burst_ms'] = 0
+        return stats
+
+
+class PokeRecorder(object):
+    """
+    Records poke times in the throttle:node:x hashes from a separate thread, with one pipeline
+    per tick. Only the latest tick is kept, so if redis falls behind, intermediate ticks are
+    skipped rather than queued up.
+    """
+
+    def __init__(self, redis_conn):
+        """
+        :param redis_conn: redis.StrictRedis instance
+        """
+        self.r = redis_conn
+        self.cond = threading.Condition()
+        self.latest = None
+        # Number of ticks replaced by a newer one before being written
+        self.coalesced = 0
+
+    def record(self, nodes, poke_time):
+        """
+        Hand over the node IDs poked at `poke_time`. Never blocks on redis.
+        """
+        with self.cond:
+            if self.latest is not None:
+                self.coalesced += 1
+            self.latest = (nodes, poke_time)
+            self.cond.notify()
+
+    def take(self, timeout):
+        """
+        Wait up to `timeout` seconds for a tick to write.
+
+        :return: Tuple `(nodes, poke_time)`, or None if there was no tick
+        """
+        with self.cond:
+            if self.latest is None:
+                self.cond.wait(timeout)
+            latest, self.latest = self.latest, None
+            return latest
+
+    def write(self, nodes, poke_time, extra=None):
+        """
+        Write the poke time of every node in `nodes` with one pipeline.
+
+        :param extra: If not None, function called with the pipeline to queue further commands on it
+        """
+        pipe = self.r.pipeline(transaction=False)
+        for node in nodes:
+            pipe.hset('throttle:node:%d' % node, 'last_poke_sec', poke_time)
+        if extra is not None:
+            extra(pipe)
+        pipe.execute()
+
+    def loop(self, extra=None, retry_sec=1.0):
+        """
+        Write ticks as they are recorded, until the process exits.
+
+        :param extra: As for `write`. Also called every second when there are no ticks.
+        """
+        while True:
+            latest = self.take(1.0)
+            nodes, poke_time = latest if latest is not None else ([], None)
+            try:
+                self.write(nodes, poke_time, extra)
+            except redis.exceptions.RedisError as e:
+                print('Failed to record pokes in redis: %s' % e, file=sys.stderr)
+                time.sleep(retry_sec)
@@ -0,0 +1,154 @@
+"""
+Encoding and decoding of the status packets the Arduinos send to port 8889.
+
+The Arduino sends its `status` struct (see arduino-mk/mc_arduino/mc_arduino.ino)
+verbatim, so a whole packet is decoded with a single call to one precompiled
+`struct.Struct`.
+"""
+
+import datetime
+import struct
+
+# Layout of the Arduino status struct. AVR is little-endian and the struct has no padding:
+# uptime, 5 sensor floats, 7 power bools, 6 byte MAC, node ID, node ID metadata.
+STATUS_STRUCT = struct.Struct('<L5f7?6sBB')
+STATUS_PACKET_SIZE = STATUS_STRUCT.size
+
+# Value the Arduino reports for a sensor it could not read
+SENSOR_NONE_VALUE = -99.0
+
+SENSOR_FIELDS = ('temp_top', 'temp_mid', 'temp_bot', 'temp_humid', 'humid')
+POWER_FIELDS = ('power_snap_relay', 'power_fem', 'power_pam',
+                'power_snap_0', 'power_snap_1', 'power_snap_2', 'power_snap_3')
+STATUS_FIELDS = ('cpu_uptime_ms',) + SENSOR_FIELDS + POWER_FIELDS + ('mac', 'node_ID', 'node_ID_metadata')
+
+
+def _sensor_value(v):
+    """
+    Round a raw sensor float to 2 decimal places, returning None if the
+    Arduino flagged the sensor as unavailable.
+    """
+    v = round(v, 2)
+    if v == SENSOR_NONE_VALUE:
+        return None
+    return v
+
+
+class StatusPacket(object):
+    """
+    A decoded Arduino status packet. Sensor values are floats, or None if the sensor
+    could not be read. Power states are the integers 0 or 1.
+    """
+
+    __slots__ = STATUS_FIELDS
+
+    def __init__(self, **kwargs):
+        self.cpu_uptime_ms = 0
+        for key in SENSOR_FIELDS:
+            setattr(self, key, None)
+        for key in POWER_FIELDS:
+            setattr(self, key, 0)
+        self.mac = '00:00:00:00:00:00'
+        self.node_ID = 0
+        self.node_ID_metadata = 0
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+    def __repr__(self):
+        return 'StatusPacket(%s)' % ', '.join('%s=%r' % (key, getattr(self, key)) for key in STATUS_FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, StatusPacket):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in STATUS_FIELDS)
+
+    def to_status_dict(self, ip, now=None):
+        """
+        Return the packet contents as the field mapping stored in the status:node:x
+        redis hash. Unavailable sensors are stored as the string 'None'.
+
+        :param ip: IP address the packet was received from
+        :type ip: String
+        :param now: If not None, time the packet was received, in seconds since the epoch. It's
+                    stored as the integer microseconds since the epoch `timestamp_us`, which
+                    clients read without any date parsing, and as the local time `timestamp`
+                    string read by older clients.
+        :type now: Float
+        :return: Dictionary of redis hash fields
+        """
+        data_dict = {
+            'mac': self.mac,
+            'ip': ip,
+            'node_ID': self.node_ID,
+            'node_ID_metadata': self.node_ID_metadata,
+            'temp_top': 'None' if self.temp_top is None else self.temp_top,
+            'temp_mid': 'None' if self.temp_mid is None else self.temp_mid,
+            'temp_bot': 'None' if self.temp_bot is None else self.temp_bot,
+            'temp_humid': 'None' if self.temp_humid is None else self.temp_humid,
+            'humid': 'None' if self.humid is None else self.humid,
+            'power_snap_relay': self.power_snap_relay,
+            'power_fem': self.power_fem,
+            'power_pam': self.power_pam,
+            'power_snap_0': self.power_snap_0,
+            'power_snap_1': self.power_snap_1,
+            'power_snap_2': self.power_snap_2,
+            'power_snap_3': self.power_snap_3,
+            'cpu_uptime_ms': self.cpu_uptime_ms,
+        }
+        if now is not None:
+            data_dict['timestamp'] = str(datetime.datetime.fromtimestamp(now))
+            data_dict['timestamp_us'] = int(now * 1000000)
+        return data_dict
+
+
+def decode_into(packet, buf, offset=0):
+    """
+    Decode a raw status packet into an existing StatusPacket, without copying `buf`.
+
+    :param packet: StatusPacket instance to fill in
+    :param buf: bytes, bytearray or memoryview holding the raw packet
+    :param offset: Byte offset of the packet within `buf`
+    :return: `packet`
+    """
+    (packet.cpu_uptime_ms, top, mid, bot, htu_temp, htu_humid,
+     relay, fem, pam, snap0, snap1, snap2, snap3,
+     mac, packet.node_ID, packet.node_ID_metadata) = STATUS_STRUCT.unpack_from(buf, offset)
+    packet.temp_top = _sensor_value(top)
+    packet.temp_mid = _sensor_value(mid)
+    packet.temp_bot = _sensor_value(bot)
+    packet.temp_humid = _sensor_value(htu_temp)
+    packet.humid = _sensor_value(htu_humid)
+    packet.power_snap_relay = int(relay)
+    packet.power_fem = int(fem)
+    packet.power_pam = int(pam)
+    packet.power_snap_0 = int(snap0)
+    packet.power_snap_1 = int(snap1)
+    packet.power_snap_2 = int(snap2)
+    packet.power_snap_3 = int(snap3)
+    packet.mac = '%02x:%02x:%02x:%02x:%02x:%02x' % tuple(mac)
+    return packet
+
+
+def unpack_from(buf, offset=0):
+    """
+    Decode a raw status packet held in `buf` into a new StatusPacket.
+
+    :param buf: bytes, bytearray or memoryview holding the raw packet
+    :param offset: Byte offset of the packet within `buf`
+    :return: StatusPacket instance
+    """
+    return decode_into(StatusPacket.__new__(StatusPacket), buf, offset)
+
+
+def encode(packet):
+    """
+    Encode a StatusPacket into the raw bytes an Arduino would send.
+    Intended for test tooling and packet simulators.
+
+    :param packet: StatusPacket instance
+    :return: bytes of length STATUS_PACKET_SIZE
+    """
+    sensors = [SENSOR_NONE_VALUE if getattr(packet, key) is None else getattr(packet, key) for key in SENSOR_FIELDS]
+    power = [bool(getattr(packet, key)) for key in POWER_FIELDS]
+    mac = bytes(int(octet, 16) for octet in packet.mac.split(':'))
+    return STATUS_STRUCT.pack(packet.cpu_uptime_ms, *(sensors + power + [mac, packet.node_ID, packet.node_ID_metadata]))
@@ -0,0 +1,63 @@
+"""
+Publishing of node statuses to redis pub/sub channels by the receiver, so that clients
+(NodeControl.watch and NodeControlArray.watch) see updates as they arrive instead of polling.
+"""
+
+import json
+
+# Channel every status of a node is published to, as JSON of its status:node:x hash fields and "node"
+UPDATES_CHANNEL = "status:updates:node:%d"
+# Channel a node's status is published to when any field besides VOLATILE_FIELDS has changed,
+# as for UPDATES_CHANNEL with a "changed" list of the fields which changed
+CHANGES_CHANNEL = "status:changes:node:%d"
+# Fields which change with every packet, so don't count as changes
+VOLATILE_FIELDS = ('timestamp', 'timestamp_us', 'cpu_uptime_ms')
+
+
+class StatusPublisher(object):
+    """
+    Queues a PUBLISH of each node status on the receiver's write pipeline, so watchers get it
+    in the same round trip as the status:node:x hash is written.
+    """
+
+    def __init__(self, updates=True, changes=True):
+        """
+        :param updates: If True, publish every status to the node's updates channel
+        :param changes: If True, publish statuses which differ from the node's last one to its changes channel
+        """
+        self.updates = updates
+        self.changes = changes
+        # Dictionary of node ID -> last status published, for change detection
+        self.last = {}
+
+    def add(self, pipe, statuses, now):
+        """
+        Queue the messages for each node in `statuses` on the redis pipeline `pipe`.
+
+        :param statuses: Dictionary of node ID -> status:node:x hash fields
+        :param now: Current time, in seconds since the epoch
+        """
+        for node, data_dict in statuses.items():
+            message = dict(data_dict, node=node)
+            if self.updates:
+                pipe.publish(UPDATES_CHANNEL % node, json.dumps(message, separators=(',', ':')))
+            if not self.changes:
+                continue
+            last = self.last.get(node)
+            self.last[node] = data_dict
+            if last is None:
+                changed = [field for field in data_dict if field not in VOLATILE_FIELDS]
+            else:
+                changed = [field for field, value in data_dict.items()
+                           if field not in VOLATILE_FIELDS and last.get(field) != value]
+            if changed:
+                message['changed'] = changed
+                pipe.publish(CHANGES_CHANNEL % node, json.dumps(message, separators=(',', ':')))
+
+    def forget(self, nodes):
+        """
+        Forget the last status of `nodes`, e.g. because the pipeline publishing it failed,
+        so that their next status is published as a change.
+        """
+        for node in nodes:
+            self.last.pop(node, None)
@@ -0,0 +1,398 @@
+"""
+Building blocks for the hera_node_receiver script, which receives status packets
+from the Arduinos and writes them to the status:node:x redis hashes.
+"""
+
+import datetime
+import select
+import socket
+import sys
+import threading
+import time
+
+import redis
+
+from .packet import StatusPacket, STATUS_PACKET_SIZE, SENSOR_FIELDS, decode_into
+from .registry import RegistryWriter
+
+# Define rcvPort for socket creation
+rcvPort = 8889
+# Define IP address on which to receive status packets
+serverAddress = '0.0.0.0'
+
+# Receiver statistics, in the order they are stored in a worker's shared statistics array
+STAT_FIELDS = ('received', 'short', 'coalesced', 'dropped')
+
+
+def create_socket(address=serverAddress, port=rcvPort, rcvbuf=None, blocking=True, reuseport=False):
+    """
+    Create a UDP socket bound to `address`:`port` for receiving Arduino status packets.
+    With `reuseport`, several processes can bind the same port and the kernel spreads
+    packets across them by source address.
+
+    :param address: Local address to bind to
+    :type address: String
+    :param port: Local port to bind to
+    :type port: Integer
+    :param rcvbuf: If not None, the kernel receive buffer size to request, in bytes
+    :type rcvbuf: Integer
+    :param blocking: Set to False to create a non-blocking socket
+    :type blocking: Boolean
+    :param reuseport: Set to True to share the port between processes with SO_REUSEPORT
+    :type reuseport: Boolean
+    :return: socket.socket instance
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Set these options so multiple processes can connect to this socket
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.bind((address, port))
+    sock.setblocking(blocking)
+    return sock
+
+
+class PacketBatch(object):
+    """
+    Collects the status packets waiting in a non-blocking socket, keeping only
+    the most recent status of each node.
+    """
+
+    def __init__(self, max_packets=256, bufsize=1024):
+        """
+        :param max_packets: Maximum number of datagrams to receive before the batch is full
+        :type max_packets: Integer
+        :param bufsize: Size of the receive buffer, in bytes
+        :type bufsize: Integer
+        """
+        self.max_packets = max_packets
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+        self.status = StatusPacket()
+        # Dictionary of node ID -> status:node:x hash fields
+        self.statuses = {}
+        # Number of datagrams received into this batch
+        self.count = 0
+        # Total number of datagrams received
+        self.received = 0
+        # Number of datagrams too short to be status packets
+        self.short = 0
+
+    def full(self):
+        return self.count >= self.max_packets
+
+    def clear(self):
+        self.statuses = {}
+        self.count = 0
+
+    def add(self, nbytes, ip):
+        """
+        Decode the packet of length `nbytes` sitting in the receive buffer, which was sent from `ip`.
+        """
+        self.count += 1
+        self.received += 1
+        if nbytes < STATUS_PACKET_SIZE:
+            self.short += 1
+            print('Ignoring %d byte packet from %s' % (nbytes, ip), file=sys.stderr)
+            return
+        decode_into(self.status, self.view)
+        data_dict = self.status.to_status_dict(ip, time.time())
+        self.statuses[self.status.node_ID] = data_dict
+
+    def drain(self, sock, timeout):
+        """
+        Wait up to `timeout` seconds for `sock` to become readable, then receive every
+        datagram waiting in it, until it is empty or the batch is full.
+
+        :param sock: Non-blocking UDP socket
+        :param timeout: Maximum time to wait for the first datagram, in seconds
+        :type timeout: Float
+        :return: Number of datagrams received
+        """
+        start_count = self.count
+        if self.full():
+            return 0
+        readable, _, _ = select.select([sock], [], [], max(timeout, 0))
+        if not readable:
+            return 0
+        while not self.full():
+            try:
+                nbytes, addr = sock.recvfrom_into(self.buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            self.add(nbytes, addr[0])
+        return self.count - start_count
+
+
+def sensor_deadbands(temp=0.0, humid=0.0):
+    """
+    Return the deadbands dictionary for a StatusDelta with the same deadband for every temperature.
+
+    :param temp: Smallest temperature change written, in degrees C
+    :param humid: Smallest relative humidity change written, in percent
+    """
+    deadbands = {field: temp for field in SENSOR_FIELDS if field.startswith('temp')}
+    deadbands['humid'] = humid
+    return deadbands
+
+
+class StatusDelta(object):
+    """
+    Keeps the last status written for each node, and picks out the fields of a new status
+    which need writing to its status:node:x hash: the timestamp and uptime, which change with
+    every packet, and any other field which has changed. Sensors only count as changed once
+    they have moved by more than their deadband from the value last written.
+
+    Every `refresh_sec` seconds a node's whole status is written, so that a hash which was
+    deleted or changed by something else is repaired.
+    """
+
+    # Fields written with every status
+    ALWAYS = ('timestamp', 'timestamp_us', 'cpu_uptime_ms')
+
+    def __init__(self, deadbands=None, refresh_sec=60.0):
+        """
+        :param deadbands: Dictionary of sensor field -> smallest change written. Sensors without
+                          a deadband are written whenever they change.
+        :param refresh_sec: Time, in seconds, between writes of each node's whole status
+        """
+        self.deadbands = deadbands or {}
+        self.refresh_sec = refresh_sec
+        # Dictionary of node ID -> (time last written in full, fields as last written)
+        self.last = {}
+        # Numbers of fields written and skipped
+        self.written = 0
+        self.skipped = 0
+
+    def fields(self, node, data_dict, now):
+        """
+        Return the fields of `data_dict`, the new status of `node`, which need writing.
+        """
+        last = self.last.get(node)
+        if last is None or now >= last[0] + self.refresh_sec:
+            self.last[node] = (now, dict(data_dict))
+            self.written += len(data_dict)
+            return data_dict
+        last_fields = last[1]
+        changed = {}
+        for field, value in data_dict.items():
+            old = last_fields.get(field)
+            if field not in self.ALWAYS:
+                if value == old:
+                    continue
+                deadband = self.deadbands.get(field)
+                if (deadband is not None and isinstance(value, float) and isinstance(old, float)
+                        and abs(value - old) < deadband):
+                    continue
+            changed[field] = value
+            last_fields[field] = value
+        self.written += len(changed)
+        self.skipped += len(data_dict) - len(changed)
+        return changed
+
+    def forget(self, nodes):
+        """
+        Forget what was last written for `nodes`, e.g. because the write failed, so that
+        their next status is written in full.
+        """
+        for node in nodes:
+            self.last.pop(node, None)
+
+
+class StatusWriter(object):
+    """
+    Writes node statuses, along with the node registry, the status history and rollups and the
+    messages to status watchers, to redis in a single pipeline. The receiver's liveness and
+    version keys are written in the same pipeline, with every write or, in delta mode, at most
+    every `liveness_sec` seconds.
+    """
+
+    def __init__(self, redis_conn, script_redis_key, version_key, version, history=None, rollup=None,
+                 publisher=None, delta=None, liveness_sec=None):
+        """
+        :param redis_conn: redis.StrictRedis instance
+        :param script_redis_key: Key used to flag that the receiver script is alive
+        :param version_key: Key of the hash recording the receiver software version
+        :param version: Version string of the receiver software
+        :param history: HistoryWriter instance to add each status to the node's history stream,
+                        or None to keep no history
+        :param rollup: RollupWriter instance to aggregate each status into the node's rollup buckets,
+                       or None to keep no rollups
+        :param publisher: StatusPublisher instance to publish each status to watchers, or None
+        :param delta: StatusDelta instance to only write the fields of each status which changed,
+                      or None to write every field
+        :param liveness_sec: Time, in seconds, between writes of the liveness and version keys.
+                             Defaults to 10 with `delta`, and 0, i.e. with every write, without.
+        """
+        self.r = redis_conn
+        self.script_redis_key = script_redis_key
+        self.version_key = version_key
+        self.version = version
+        self.registry = RegistryWriter()
+        self.history = history
+        self.rollup = rollup
+        self.publisher = publisher
+        self.delta = delta
+        if liveness_sec is None:
+            liveness_sec = 10.0 if delta is not None else 0.0
+        self.liveness_sec = liveness_sec
+        self.next_liveness = 0
+
+    def queue(self, pipe, statuses, now, stats_key=None, stats=None):
+        """
+        Add the commands writing `statuses` to the redis pipeline `pipe`, without executing it.
+        Shared by `write` and the asyncio receiver, whose pipelines are executed by an event loop.
+
+        :param pipe: redis.client.Pipeline or redis.asyncio.client.Pipeline instance
+        :param statuses: Dictionary of node ID -> status:node:x hash fields
+        :param now: Time the statuses are written, in seconds since the epoch
+        :param stats_key: If not None, key of a hash to write `stats` to in the same round trip
+        :param stats: Dictionary of receiver statistics
+        """
+        for node, data_dict in statuses.items():
+            if self.delta is not None:
+                data_dict = self.delta.fields(node, data_dict, now)
+                if not data_dict:
+                    continue
+            pipe.hset('status:node:%d' % node, mapping=data_dict)
+        self.registry.update(pipe, statuses, now)
+        if self.history is not None:
+            self.history.add(pipe, statuses, now)
+        if self.rollup is not None:
+            self.rollup.add(pipe, statuses, now)
+        if self.publisher is not None:
+            self.publisher.add(pipe, statuses, now)
+        if now >= self.next_liveness:
+            pipe.set(self.script_redis_key, "alive", ex=60)
+            # Write the version of this software to redis
+            pipe.hset(self.version_key,
+                      mapping={"version": self.version, "timestamp": datetime.datetime.now().isoformat()})
+            self.next_liveness = now + self.liveness_sec
+        if stats_key is not None:
+            pipe.hset(stats_key, mapping=stats)
+
+    def forget(self, nodes):
+        """
+        Forget what was last written for `nodes` after a pipeline from `queue` failed, so that
+        their next statuses are written in full, and rewrite the liveness keys with the next write.
+        """
+        self.registry.forget(nodes)
+        if self.rollup is not None:
+            self.rollup.forget(nodes)
+        if self.publisher is not None:
+            self.publisher.forget(nodes)
+        if self.delta is not None:
+            self.delta.forget(nodes)
+        self.next_liveness = 0
+
+    def write(self, statuses, stats_key=None, stats=None):
+        """
+        Write the status:node:x hashes for all nodes in `statuses` with one redis round trip.
+
+        :param statuses: Dictionary of node ID -> status:node:x hash fields
+        :param stats_key: If not None, key of a hash to write `stats` to in the same round trip
+        :param stats: Dictionary of receiver statistics
+        :return: Number of node hashes written
+        """
+        pipe = self.r.pipeline(transaction=False)
+        self.queue(pipe, statuses, time.time(), stats_key, stats)
+        try:
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            self.forget(statuses.keys())
+            raise
+        return len(statuses)
+
+
+class LatestStatusQueue(object):
+    """
+    Thread-safe hand-off of node statuses from a receive thread to a redis writer thread.
+    Only the latest pending status of each node is kept, so a slow writer coalesces updates
+    instead of stalling the receiver.
+    """
+
+    def __init__(self, max_nodes=1024):
+        """
+        :param max_nodes: Maximum number of nodes with a pending status. Statuses of
+                          further nodes are dropped until the writer catches up.
+        :type max_nodes: Integer
+        """
+        self.max_nodes = max_nodes
+        self.pending = {}
+        self.cond = threading.Condition()
+        # Number of pending statuses replaced by a newer one before being written
+        self.coalesced = 0
+        # Number of statuses discarded because the queue was full
+        self.dropped = 0
+
+    def put_many(self, statuses):
+        """
+        Queue the statuses in the dictionary `statuses` of node ID -> status:node:x hash fields,
+        replacing any pending status of the same node.
+        """
+        if not statuses:
+            return
+        with self.cond:
+            for node, data_dict in statuses.items():
+                if node in self.pending:
+                    self.coalesced += 1
+                elif len(self.pending) >= self.max_nodes:
+                    self.dropped += 1
+                    continue
+                self.pending[node] = data_dict
+            self.cond.notify()
+
+    def requeue(self, statuses):
+        """
+        Return statuses which could not be written to the queue,
+        unless a newer status of the same node is already pending.
+        """
+        with self.cond:
+            for node, data_dict in statuses.items():
+                if node not in self.pending and len(self.pending) < self.max_nodes:
+                    self.pending[node] = data_dict
+            self.cond.notify()
+
+    def take(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for statuses to be pending, then remove and return them all.
+
+        :return: Dictionary of node ID -> status:node:x hash fields. Empty if the wait timed out.
+        """
+        with self.cond:
+            if not self.pending:
+                self.cond.wait(timeout)
+            pending = self.pending
+            self.pending = {}
+        return pending
+
+
+def writer_loop(queue, writer, stats_key, get_stats, stats_interval=10.0, retry_sec=1.0):
+    """
+    Take statuses from `queue` and write them to redis with `writer` until the process exits.
+    Run this in its own thread, so that redis stalls never hold up the receive thread.
+
+    :param queue: LatestStatusQueue instance
+    :param writer: StatusWriter instance
+    :param stats_key: Key of the redis hash receiver statistics are published to.
+                      If None, statistics are not published.
+    :param get_stats: Callable returning a dictionary of receiver statistics
+    :param stats_interval: Time between publishing statistics, in seconds
+    :param retry_sec: Time to wait after a failed redis write, in seconds
+    """
+    next_stats = 0
+    while True:
+        statuses = queue.take(timeout=stats_interval)
+        now = time.time()
+        try:
+            if stats_key is not None and now >= next_stats:
+                writer.write(statuses, stats_key, get_stats())
+                next_stats = now + stats_interval
+            elif statuses:
+                writer.write(statuses)
+        except redis.exceptions.RedisError as e:
+            print('Failed to write %d statuses to redis: %s' % (len(statuses), e), file=sys.stderr)
+            queue.requeue(statuses)
+            time.sleep(retry_sec)
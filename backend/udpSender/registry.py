@@ -0,0 +1,53 @@
+"""
+Index of known nodes, maintained by the receiver so that clients can find the nodes
+without scanning the redis keyspace for status:node:x keys.
+"""
+
+import json
+
+# Hash of node ID -> JSON {"ip": ..., "mac": ...}
+REGISTRY_KEY = "nodes:registry"
+# Sorted set of node IDs, scored by the time, in seconds since the epoch, they last reported status
+LAST_SEEN_KEY = "nodes:last_seen"
+# Counter incremented whenever REGISTRY_KEY changes, so clients know when to reload it
+SERIAL_KEY = "nodes:registry:serial"
+
+
+class RegistryWriter(object):
+    """
+    Queues updates of the node registry alongside the status:node:x writes. A node's registry
+    entry is only rewritten when its address changes, while its last seen time is updated with
+    every status.
+    """
+
+    def __init__(self):
+        # Dictionary of node ID -> registry entry last written by this writer
+        self.known = {}
+
+    def update(self, pipe, statuses, now):
+        """
+        Queue the registry updates for `statuses` on the redis pipeline `pipe`.
+
+        :param statuses: Dictionary of node ID -> status:node:x hash fields
+        :param now: Time the statuses were received, in seconds since the epoch
+        """
+        if not statuses:
+            return
+        changed = False
+        for node, data_dict in statuses.items():
+            entry = json.dumps({"ip": data_dict.get("ip"), "mac": data_dict.get("mac")}, sort_keys=True)
+            if self.known.get(node) != entry:
+                pipe.hset(REGISTRY_KEY, node, entry)
+                self.known[node] = entry
+                changed = True
+        if changed:
+            pipe.incr(SERIAL_KEY)
+        pipe.zadd(LAST_SEEN_KEY, {node: now for node in statuses.keys()})
+
+    def forget(self, nodes):
+        """
+        Forget the entries written for `nodes`, so they are written again with the next update.
+        Call this when the pipeline carrying an update fails.
+        """
+        for node in nodes:
+            self.known.pop(node, None)
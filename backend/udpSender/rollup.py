@@ -0,0 +1,143 @@
+"""
+Downsampled sensor aggregates, kept by the receiver. For each node and resolution, every bucket
+of `resolution` seconds holds the min, max, mean and count of each sensor's samples, so that
+long time ranges can be plotted without reading every raw sample.
+"""
+
+import json
+
+from .packet import SENSOR_FIELDS
+
+# Sorted set of the buckets of a node at one resolution, scored by bucket start time in seconds
+# since the epoch. Members are JSON {"t": start, "<sensor>": [min, max, mean, count], ...}.
+ROLLUP_KEY = "status:rollup:%d:node:%d"
+# Pairs of (resolution, retention), in seconds
+ROLLUP_RESOLUTIONS = (
+    (60, 7 * 86400),
+    (600, 90 * 86400),
+    (3600, 3 * 365 * 86400),
+)
+
+
+class Bucket(object):
+    """
+    Running min, max, mean and count of each sensor over one time bucket.
+    """
+
+    __slots__ = ('start', 'stats', 'written', 'dirty')
+
+    def __init__(self, start):
+        self.start = start
+        # Dictionary of sensor -> [min, max, sum, count]
+        self.stats = {}
+        # Time the bucket was last written to redis, and whether it has samples added since
+        self.written = 0
+        self.dirty = False
+
+    def add(self, sample):
+        for field in SENSOR_FIELDS:
+            v = sample.get(field)
+            if v is None or v == 'None':
+                continue
+            v = float(v)
+            s = self.stats.get(field)
+            if s is None:
+                self.stats[field] = [v, v, v, 1]
+            else:
+                if v < s[0]:
+                    s[0] = v
+                if v > s[1]:
+                    s[1] = v
+                s[2] += v
+                s[3] += 1
+
+    def encode(self):
+        record = {'t': self.start}
+        for field, (vmin, vmax, vsum, count) in self.stats.items():
+            record[field] = [vmin, vmax, round(vsum / count, 3), count]
+        return json.dumps(record, separators=(',', ':'))
+
+
+class RollupWriter(object):
+    """
+    Updates the rollup buckets of each node as its statuses arrive. Only the bucket currently
+    open at each resolution is kept in memory. Each bucket is written to redis when it closes,
+    and while it's open at most every `write_interval` seconds, so queries see it fill up
+    without it being rewritten for every sample. Buckets older than each resolution's retention
+    are trimmed as new buckets open.
+
+    A receiver which restarts part way through a bucket starts that bucket afresh, losing
+    the samples it had aggregated before the restart. The last `write_interval` seconds of
+    samples of a node which stops sending are never written.
+
+    If the pipeline from `add` fails, call `forget` so the affected buckets are written again
+    with the next sample. Closed buckets are kept until the next sample of their node, which
+    shows their final write went through.
+    """
+
+    def __init__(self, resolutions=ROLLUP_RESOLUTIONS, write_interval=10.0):
+        """
+        :param resolutions: Sequence of (resolution, retention) pairs, in seconds
+        :param write_interval: Shortest time between writes of an open bucket, in seconds
+        """
+        self.resolutions = resolutions
+        self.write_interval = write_interval
+        # Dictionary of (node, resolution) -> open Bucket
+        self.buckets = {}
+        # Dictionary of (node, resolution) -> list of closed Buckets whose final write isn't known to have succeeded
+        self.closing = {}
+
+    def _write(self, pipe, key, bucket, now):
+        pipe.zremrangebyscore(key, bucket.start, bucket.start)
+        pipe.zadd(key, {bucket.encode(): bucket.start})
+        bucket.written = now
+        bucket.dirty = False
+
+    def add(self, pipe, statuses, now):
+        """
+        Add a sample of each node in `statuses` to its buckets, and queue the bucket
+        updates on the redis pipeline `pipe`.
+
+        :param statuses: Dictionary of node ID -> status:node:x hash fields
+        :param now: Time of the samples, in seconds since the epoch
+        """
+        for node, data_dict in statuses.items():
+            for resolution, retention in self.resolutions:
+                start = int(now // resolution) * resolution
+                key = ROLLUP_KEY % (resolution, node)
+                # Closed buckets are still dirty only if their final write failed
+                closing = [b for b in self.closing.pop((node, resolution), ()) if b.dirty]
+                for closed in closing:
+                    self._write(pipe, key, closed, now)
+                bucket = self.buckets.get((node, resolution))
+                if bucket is None or bucket.start != start:
+                    if bucket is not None and bucket.dirty:
+                        # Write the samples the closing bucket got since it was last written
+                        self._write(pipe, key, bucket, now)
+                        closing.append(bucket)
+                    bucket = self.buckets[(node, resolution)] = Bucket(start)
+                    pipe.zremrangebyscore(key, '-inf', '(%d' % (start - retention))
+                bucket.add(data_dict)
+                if not bucket.stats:
+                    continue
+                if now >= bucket.written + self.write_interval:
+                    self._write(pipe, key, bucket, now)
+                else:
+                    bucket.dirty = True
+                if closing:
+                    self.closing[(node, resolution)] = closing
+
+    def forget(self, nodes):
+        """
+        Forget that the buckets of `nodes` were written, e.g. because the write failed,
+        so that they're written again with the nodes' next samples.
+        """
+        for node in nodes:
+            for resolution, _ in self.resolutions:
+                buckets = list(self.closing.get((node, resolution), ()))
+                bucket = self.buckets.get((node, resolution))
+                if bucket is not None and bucket.stats:
+                    buckets.append(bucket)
+                for b in buckets:
+                    b.written = 0
+                    b.dirty = True
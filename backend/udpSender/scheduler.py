@@ -0,0 +1,103 @@
+"""
+Non-blocking scheduler which spaces out the commands sent to each node.
+"""
+
+import collections
+import heapq
+import time
+
+
+class CommandScheduler(object):
+    """
+    Runs queued commands so that commands to the same node are at least `min_interval`
+    seconds apart, without ever sleeping. Each node has its own queue of pending commands
+    and the time it is next allowed a command; a heap of those times tells the caller how
+    long it may wait before calling `run_pending` again. Nodes are throttled independently,
+    so commands for different nodes go out together.
+    """
+
+    def __init__(self, min_interval=2.0, clock=time.time):
+        """
+        :param min_interval: Minimum time between commands sent to one node, in seconds
+        :type min_interval: Float
+        :param clock: Function returning the current time, in seconds
+        """
+        self.min_interval = min_interval
+        self.clock = clock
+        # Heap of (ready time, node) for nodes with pending commands
+        self.heap = []
+        # Dictionary of node -> deque of (key, function) pending commands
+        self.queues = {}
+        # Dictionary of node -> time the last command was run
+        self.last_run = {}
+        # Set of (node, key) pairs with a pending command
+        self.pending = set()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def set_last_run(self, node, t):
+        """
+        Record that a command was last sent to `node` at time `t`, e.g. by a previous instance of the caller.
+        """
+        self.last_run[node] = max(self.last_run.get(node, 0), t)
+
+    def ready_time(self, node):
+        """
+        Return the time at which `node` may next be sent a command.
+        """
+        return self.last_run.get(node, 0) + self.min_interval
+
+    def submit(self, node, key, func):
+        """
+        Queue `func` to be called once `node` may be sent another command.
+        If a command with the same `key` is already pending for this node, do nothing.
+
+        :param node: Node ID
+        :param key: Identifier of the command, e.g. the power control name
+        :param func: Function, taking no arguments, which sends the command
+        :return: True if the command was queued, False if it was already pending
+        """
+        if (node, key) in self.pending:
+            return False
+        self.pending.add((node, key))
+        queue = self.queues.get(node)
+        if queue is None:
+            queue = self.queues[node] = collections.deque()
+        queue.append((key, func))
+        if len(queue) == 1:
+            heapq.heappush(self.heap, (self.ready_time(node), node))
+        return True
+
+    def time_until_next(self):
+        """
+        Return the time, in seconds, until the next pending command is due,
+        or None if there are no pending commands.
+        """
+        if not self.heap:
+            return None
+        return max(self.heap[0][0] - self.clock(), 0)
+
+    def run_pending(self):
+        """
+        Run every command which is due, at most one per node.
+
+        :return: Number of commands run
+        """
+        nrun = 0
+        now = self.clock()
+        while self.heap and self.heap[0][0] <= now:
+            _, node = heapq.heappop(self.heap)
+            queue = self.queues[node]
+            key, func = queue.popleft()
+            self.pending.discard((node, key))
+            self.last_run[node] = now
+            try:
+                func()
+            finally:
+                if queue:
+                    heapq.heappush(self.heap, (self.ready_time(node), node))
+                else:
+                    del self.queues[node]
+            nrun += 1
+        return nrun
@@ -0,0 +1,191 @@
+"""
+Per-node logs of the debug messages the Arduinos send to port 8890, written by the
+hera_node_serial script and searched by the hera_node_serial_dump script.
+
+Each source gets its own log file, `serial_node_<id>.log`, or `serial_<ip>.log` for addresses
+not in the node registry, with one line per datagram: `<ISO timestamp> <message>`, where
+newlines in the message are escaped as \\n. Alongside each log, `<log>.idx` is a sparse time
+index of fixed size (time, byte offset) records, one every `index_interval` seconds, so that
+a time window is found with a binary search and a short scan rather than by reading the whole
+log. Logs are rotated once they reach `max_bytes`, keeping `backups` old logs, `<log>.1` being
+the most recent, each with its index.
+"""
+
+import bisect
+import datetime
+import os
+import struct
+
+# Define serialPort for socket creation
+serialPort = 8890
+
+# Hash of message counters of each source, node ID or IP address, published by hera_node_serial
+SERIAL_STATS_KEY = "stats:serial:node:%s"
+# Time index record: time in seconds since the epoch, and byte offset of the first line at or after it
+INDEX_RECORD = struct.Struct('<dQ')
+
+
+def log_name(source):
+    """
+    Return the log file name of `source`, a node ID or, for unknown nodes, an IP address string.
+    """
+    if isinstance(source, int):
+        return 'serial_node_%d.log' % source
+    return 'serial_%s.log' % source
+
+
+def format_line(t, data):
+    """
+    Format the datagram `data`, received at time `t` in seconds since the epoch, as one log line.
+    """
+    text = data.decode('utf-8', 'replace').rstrip('\r\n').replace('\r', '\\r').replace('\n', '\\n')
+    return ('%s %s\n' % (datetime.datetime.fromtimestamp(t).isoformat(), text)).encode()
+
+
+class NodeLog(object):
+    """
+    One source's log file and time index, opened for appending with buffered writes.
+    """
+
+    def __init__(self, path, max_bytes, backups, index_interval):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.index_interval = index_interval
+        self._open()
+
+    def _open(self):
+        self.fh = open(self.path, 'ab', buffering=65536)
+        self.idx = open(self.path + '.idx', 'ab', buffering=4096)
+        self.size = self.fh.tell()
+        self.last_index_time = None
+
+    def write(self, t, line):
+        if self.size > 0 and self.size + len(line) > self.max_bytes:
+            self.rotate()
+        if self.last_index_time is None or t >= self.last_index_time + self.index_interval:
+            self.idx.write(INDEX_RECORD.pack(t, self.size))
+            self.last_index_time = t
+        self.fh.write(line)
+        self.size += len(line)
+
+    def rotate(self):
+        self.close()
+        for i in range(self.backups - 1, 0, -1):
+            for suffix in ('', '.idx'):
+                src = '%s.%d%s' % (self.path, i, suffix)
+                if os.path.exists(src):
+                    os.replace(src, '%s.%d%s' % (self.path, i + 1, suffix))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+            os.replace(self.path + '.idx', self.path + '.1.idx')
+        else:
+            os.remove(self.path)
+            os.remove(self.path + '.idx')
+        self._open()
+
+    def flush(self):
+        # Flush the log first, so the index never points past the end of what's on disk
+        self.fh.flush()
+        self.idx.flush()
+
+    def close(self):
+        self.fh.close()
+        self.idx.close()
+
+
+class SerialLogWriter(object):
+    """
+    Writes each source's datagrams to its own rotated log file, and counts them.
+    """
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, backups=10, index_interval=10.0):
+        """
+        :param directory: Directory to write the log files in
+        :param max_bytes: Size, in bytes, at which a log is rotated
+        :param backups: Number of rotated logs kept per source
+        :param index_interval: Time, in seconds, between time index records
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.index_interval = index_interval
+        # Dictionary of source -> NodeLog
+        self.logs = {}
+        # Dictionary of source -> [messages, bytes, time of last message], since the writer started
+        self.counts = {}
+
+    def write(self, source, t, data):
+        """
+        Log the datagram `data` from `source`, received at time `t` in seconds since the epoch.
+        """
+        log = self.logs.get(source)
+        if log is None:
+            log = self.logs[source] = NodeLog(os.path.join(self.directory, log_name(source)),
+                                              self.max_bytes, self.backups, self.index_interval)
+        log.write(t, format_line(t, data))
+        counts = self.counts.get(source)
+        if counts is None:
+            counts = self.counts[source] = [0, 0, t]
+        counts[0] += 1
+        counts[1] += len(data)
+        counts[2] = t
+
+    def flush(self):
+        for log in self.logs.values():
+            log.flush()
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
+        self.logs = {}
+
+
+def _read_index(path):
+    try:
+        with open(path, 'rb') as fh:
+            data = fh.read()
+    except FileNotFoundError:
+        return [], []
+    records = list(INDEX_RECORD.iter_unpack(data[:len(data) - len(data) % INDEX_RECORD.size]))
+    return [t for t, _ in records], [offset for _, offset in records]
+
+
+def read_messages(directory, source, start=None, end=None, backups=10):
+    """
+    Yield the messages logged from `source` between `start` and `end`, oldest first.
+
+    :param directory: Directory of the log files
+    :param source: Node ID, or IP address string for unknown nodes
+    :param start: Time in seconds since the epoch. Defaults to the start of the oldest log.
+    :param end: Time in seconds since the epoch. Defaults to the end of the current log.
+    :param backups: Number of rotated logs to look in
+    :return: Generator of (datetime, message) tuples
+    """
+    base = os.path.join(directory, log_name(source))
+    paths = ['%s.%d' % (base, i) for i in range(backups, 0, -1)] + [base]
+    start_dt = datetime.datetime.fromtimestamp(start) if start is not None else None
+    end_dt = datetime.datetime.fromtimestamp(end) if end is not None else None
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        times, offsets = _read_index(path + '.idx')
+        offset = 0
+        if start is not None:
+            # Last index record at or before `start`
+            i = bisect.bisect_right(times, start) - 1
+            if i >= 0:
+                offset = offsets[i]
+        with open(path, 'rb') as fh:
+            fh.seek(offset)
+            for line in fh:
+                stamp, _, text = line.decode('utf-8', 'replace').rstrip('\n').partition(' ')
+                try:
+                    t = datetime.datetime.fromisoformat(stamp)
+                except ValueError:
+                    continue
+                if start_dt is not None and t < start_dt:
+                    continue
+                if end_dt is not None and t > end_dt:
+                    return
+                yield t, text
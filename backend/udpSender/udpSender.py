@@ -5,6 +5,9 @@ import redis
 import socket
 import sys
 import smtplib
+import threading
+import concurrent.futures
+from nodeControl.schema import POWER_ON_ORDER, POWER_OFF_ORDER
 
 
 # Define sendPort for socket creation
@@ -12,43 +15,164 @@ sendPort = 8888
 # Define IP address on which to send commands
 serverAddress = '0.0.0.0'
 
-
-class UdpSender():
-    """
-    This class is used for sending UDP commands to Arduino directly.
-    Has ability to turn on/off FEM, PAM, relay and SNAPs. Could also reset the Arduino bootloader. 
+# Power controls, in the order commands for them are handled, keyed by the name used in the
+# commands:node:x redis hash. Values are the UDP payload format, filled in with 'on' or 'off'.
+# The safe orders to turn them on and off are shared with the clients through nodeControl.schema.
+POWER_CONTROLS = POWER_ON_ORDER
+POWER_COMMAND_FORMATS = {
+    'power_snap_relay' : 'snapRelay_%s',
+    'power_snap_0'     : 'snapv2_0_%s',
+    'power_snap_1'     : 'snapv2_1_%s',
+    'power_snap_2'     : 'snapv2_2_%s',
+    'power_snap_3'     : 'snapv2_3_%s',
+    'power_fem'        : 'FEM_%s',
+    'power_pam'        : 'PAM_%s',
+}
+
+# Encoded UDP payload of every power command, keyed by (control, 'on' | 'off')
+COMMAND_PAYLOADS = {(control, command): (fmt % command).encode()
+                    for control, fmt in POWER_COMMAND_FORMATS.items() for command in ('on', 'off')}
+POKE_PAYLOAD = b'poke'
+RESET_PAYLOAD = b'reset'
+
+# Socket shared by every UdpSender and UdpSenderPool in this process
+_shared_socket = None
+_shared_socket_lock = threading.Lock()
+
+def sweep_order(triggered, commands):
     """
+    Return the power controls with triggers set in the order to send them when they weren't
+    queued, e.g. when found by a sweep of the commands:node:x hashes: "off" commands first,
+    in POWER_OFF_ORDER, then "on" commands in POWER_CONTROLS order.
 
-    def __init__(self, arduinoAddress):
-        """
-        Takes in the arduino IP address and sends commands directly, using udp.
-        You have to be on the hera-digi-vm server to use it, otherwise use
-        the nodeControl class to send commands via Redis.
-        """
-
-        self.arduinoAddress = arduinoAddress
-
-        # define socket address for binding; necessary for receiving data from Arduino 
-        self.localSocket = (serverAddress, sendPort)
+    :param triggered: Collection of the names of the power controls with triggers set
+    :param commands: Dictionary of power control name -> 'on' | 'off' command
+    :return: List of power control names
+    """
+    offs = [control for control in POWER_OFF_ORDER if control in triggered and commands.get(control) != 'on']
+    ons = [control for control in POWER_CONTROLS if control in triggered and commands.get(control) == 'on']
+    return offs + ons
 
 
+def shared_socket():
+    """
+    Return the process-wide UDP socket bound to `serverAddress`:`sendPort` that commands are
+    sent from, creating it on first use.
+    """
+    global _shared_socket
+    with _shared_socket_lock:
+        if _shared_socket is not None:
+            return _shared_socket
         # Create a UDP socket
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             # Make sure that specify that we want to reuse the socket address
-            self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             print('Socket created')
         except socket.error as msg:
-            print(('Failed to create socket. Error Code : ' + str(msg[0]) + ' Message ' + str(msg[1])))
+            print(('Failed to create socket. Error Code : ' + str(msg.errno) + ' Message ' + str(msg.strerror)))
             sys.exit()
 
-        # Bind socket to local host and port
+        # Bind socket to local host and port; necessary for receiving data from Arduino
         try:
-            self.client_socket.bind(self.localSocket)
+            sock.bind((serverAddress, sendPort))
             print('Bound socket')
         except socket.error as msg:
-            print(('Bind failed. Error Code : ' + str(msg[0]) + ' Message ' + msg[1]))
+            print(('Bind failed. Error Code : ' + str(msg.errno) + ' Message ' + str(msg.strerror)))
             sys.exit()
+        _shared_socket = sock
+        return sock
+
+
+class UdpSenderPool(object):
+    """
+    Sends commands to any Arduino over one socket. Unlike UdpSender, nothing here sleeps:
+    every method sends its datagram and returns at once, and pacing commands to each
+    node is left to the caller, e.g. with a CommandScheduler (see `submit`).
+    """
+
+    def __init__(self, sock=None):
+        """
+        :param sock: UDP socket to send from. Defaults to the process-wide socket
+                     returned by `shared_socket`.
+        """
+        self.sock = sock if sock is not None else shared_socket()
+
+    def send(self, arduinoAddress, payload):
+        """
+        Send the raw bytes `payload` to the Arduino at IP address `arduinoAddress`.
+        """
+        self.sock.sendto(payload, (arduinoAddress, sendPort))
+
+    def poke(self, arduinoAddress):
+        """
+        Send a keep-alive poke to the Arduino at `arduinoAddress`.
+        """
+        self.sock.sendto(POKE_PAYLOAD, (arduinoAddress, sendPort))
+
+    def command(self, arduinoAddress, control, command):
+        """
+        Send a power command to the Arduino at `arduinoAddress`.
+
+        :param control: Power control name, one of POWER_CONTROLS
+        :param command: 'on' or 'off'
+        """
+        payload = COMMAND_PAYLOADS.get((control, command))
+        if payload is None:
+            payload = (POWER_COMMAND_FORMATS[control] % command).encode()
+        self.sock.sendto(payload, (arduinoAddress, sendPort))
+
+    def reset(self, arduinoAddress):
+        """
+        Reset the bootloader of the Arduino at `arduinoAddress`.
+        """
+        self.sock.sendto(RESET_PAYLOAD, (arduinoAddress, sendPort))
+
+    def submit(self, scheduler, node, arduinoAddress, control, command):
+        """
+        Queue a power command on `scheduler`, a CommandScheduler, to be sent once `node` is
+        allowed another command.
+
+        :return: A concurrent.futures.Future whose result is set to the time the command was sent,
+                 or None if a command for `control` was already pending for this node
+        """
+        future = concurrent.futures.Future()
+
+        def send():
+            try:
+                self.command(arduinoAddress, control, command)
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            future.set_result(time.time())
+
+        if not scheduler.submit(node, control, send):
+            return None
+        return future
+
+
+class UdpSender():
+    """
+    This class is used for sending UDP commands to Arduino directly.
+    Has ability to turn on/off FEM, PAM, relay and SNAPs. Could also reset the Arduino bootloader. 
+    All instances send from the same shared socket.
+    """
+
+    def __init__(self, arduinoAddress, cmd_delay_sec=2):
+        """
+        Takes in the arduino IP address and sends commands directly, using udp.
+        You have to be on the hera-digi-vm server to use it, otherwise use
+        the nodeControl class to send commands via Redis.
+
+        Power and reset methods wait `cmd_delay_sec` seconds after sending their command.
+        Set it to 0 if commands are paced by the caller, e.g. using a CommandScheduler,
+        or use a UdpSenderPool instead.
+        """
+
+        self.arduinoAddress = arduinoAddress
+        self.cmd_delay_sec = cmd_delay_sec
+        self.pool = UdpSenderPool()
+        self.client_socket = self.pool.sock
 
     def poke(self):
         """
@@ -56,8 +180,13 @@ class UdpSender():
         to send keep Arduinos from resetting. 
         """
 
-        arduinoSocket = (self.arduinoAddress, sendPort)
-        self.client_socket.sendto(b'poke', arduinoSocket)
+        self.pool.poke(self.arduinoAddress)
+
+    def _power(self, control, command):
+        self.pool.command(self.arduinoAddress, control, command)
+
+        # Set delay before receiving more data
+        time.sleep(self.cmd_delay_sec)
 
     def power_snap_relay(self, command):
         """
@@ -66,12 +195,7 @@ class UdpSender():
         control over individual SNAPs. 
         """
 
-        # define arduino socket to send requests
-        arduinoSocket = (self.arduinoAddress, sendPort)
-        self.client_socket.sendto(('snapRelay_%s'%command).encode(), arduinoSocket)
-
-        # Set delay before receiving more data
-        time.sleep(2)
+        self._power('power_snap_relay', command)
 
     def power_fem(self, command):
         """
@@ -79,12 +203,7 @@ class UdpSender():
         Controls the power to FEM.
         """
 
-        # define arduino socket to send requests
-        arduinoSocket = (self.arduinoAddress, sendPort)
-        self.client_socket.sendto(('FEM_%s'%command).encode(), arduinoSocket)
-
-        # Set delay before receiving more data
-        time.sleep(2)
+        self._power('power_fem', command)
 
     def power_pam(self, command):
         """
@@ -92,12 +211,7 @@ class UdpSender():
         Controls the power to PAM.
         """
 
-        # define arduino socket to send requests
-        arduinoSocket = (self.arduinoAddress, sendPort)
-        self.client_socket.sendto(('PAM_%s'%command).encode(), arduinoSocket)
-
-        # Set delay before receiving more data
-        time.sleep(2)
+        self._power('power_pam', command)
 
     def power_snap_0(self, command):
         """
@@ -105,12 +219,7 @@ class UdpSender():
         Controls the power to SNAP 0.
         """ 
 
-        # define arduino socket to send requests
-        arduinoSocket = (self.arduinoAddress, sendPort)
-        self.client_socket.sendto(('snapv2_0_%s'%command).encode(), arduinoSocket)
-
-        # Set delay before receiving more data
-        time.sleep(2)
+        self._power('power_snap_0', command)
 
     def power_snap_1(self, command):
         """
@@ -118,12 +227,7 @@ class UdpSender():
         Controls the power to SNAP 1.
         """ 
 
-        # define arduino socket to send requests
-        arduinoSocket = (self.arduinoAddress, sendPort)
-        self.client_socket.sendto(('snapv2_1_%s'%command).encode(), arduinoSocket)
-
-        # Set delay before receiving more data
-        time.sleep(2)
+        self._power('power_snap_1', command)
 
     def power_snap_2(self, command):
         """
@@ -131,12 +235,7 @@ class UdpSender():
         Controls the power to SNAP 2.
         """ 
 
-        # define arduino socket to send requests
-        arduinoSocket = (self.arduinoAddress, sendPort)
-        self.client_socket.sendto(('snapv2_2_%s'%command).encode(), arduinoSocket)
-
-        # Set delay before receiving more data
-        time.sleep(2)
+        self._power('power_snap_2', command)
 
     def power_snap_3(self, command):
         """
@@ -144,22 +243,14 @@ class UdpSender():
         Controls the power to SNAP 3. 
         """ 
 
-        # define arduino socket to send requests
-        arduinoSocket = (self.arduinoAddress, sendPort)
-        self.client_socket.sendto(('snapv2_3_%s'%command).encode(), arduinoSocket)
-
-        # Set delay before receiving more data
-        time.sleep(2)
+        self._power('power_snap_3', command)
 
     def reset(self):
         """
         Resets the Arduino bootloader. 
         """
 
-        # define arduino socket to send requests
-        arduinoSocket = (self.arduinoAddress, sendPort)
-        self.client_socket.sendto(b'reset', arduinoSocket)
+        self.pool.reset(self.arduinoAddress)
 
         # Set delay before receiving more data
-        time.sleep(2)
-
+        time.sleep(self.cmd_delay_sec)
@@ -1,2 +1,8 @@
 from .__version__ import __version__
 from .nodeControl import *
+from .nodeControlArray import NodeControlArray
+from .registry import NodeRegistry
+from .connection import get_redis
+from .cache import StatusCache
+from .archive import StatusArchive, read_archive
+from .orchestrator import PowerSequencer, plan_commands
@@ -0,0 +1,381 @@
+"""
+asyncio counterparts of NodeControl, NodeControlArray and get_valid_nodes, for asyncio
+applications such as the monitoring web service. They use redis.asyncio clients shared
+through nodeControl.connection, and the same decoding as the synchronous classes, so they
+return the same values without blocking the event loop or needing a thread pool.
+"""
+
+import asyncio
+import time
+
+import numpy as np
+
+from .connection import get_async_redis
+from .nodeControl import (_add_commands, _command_record, _power_status, power_commands,
+                          _stream_id, _add_history_page, _history_arrays, _history_covers,
+                          _summary_window, _rollup_resolution, _raw_summary, _rollup_summary,
+                          COMMAND_STATUS_KEY, COMMAND_DONE_KEY, HISTORY_KEY, HISTORY_SENSOR_FIELDS,
+                          HISTORY_POWER_FIELDS, ROLLUP_KEY, STATUS_INTERVAL_SEC)
+from .nodeControlArray import _decode_statuses, _status_ages, SENSOR_FIELDS, POWER_FIELDS
+from .registry import NodeRegistry
+from .schema import NODE_STATUS, SENSORS, WR_STATUS
+from .timestamps import status_epoch, status_time
+from .watch import decode_update, CHANGES_CHANNEL, UPDATES_CHANNEL
+
+# Default maximum number of requests `fan_out` has in flight at once
+MAX_CONCURRENCY = 16
+
+
+def _decode_hash(raw):
+    return {key.decode(): val.decode() for key, val in raw.items()}
+
+
+async def fan_out(func, items, limit=MAX_CONCURRENCY):
+    """
+    Await `func(item)` for every item in `items` concurrently, with at most `limit` in flight.
+
+    :param func: Coroutine function of one argument
+    :param items: Iterable of arguments
+    :param limit: Maximum number of calls in progress at once
+    :return: List of the results, in the order of `items`. The first exception raised by a call
+             is raised once all calls have finished.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def call(item):
+        async with semaphore:
+            return await func(item)
+
+    results = await asyncio.gather(*[call(item) for item in items], return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def get_valid_nodes(serverAddress="redishost", active_within=None):
+    """
+    Return a list of all node IDs which currently have status data in redis, as for
+    `nodeControl.get_valid_nodes`.
+
+    :param active_within: If not None, only return nodes which have reported status in the last
+                          `active_within` seconds
+    """
+    r = get_async_redis(serverAddress)
+    registry = NodeRegistry(redis_conn=r)
+    pipe = r.pipeline(transaction=False)
+    registry._queue_load(pipe)
+    if not registry._apply_load(await pipe.execute()):
+        keys = [key async for key in r.scan_iter("status:node:*")]
+        pipe = r.pipeline(transaction=False)
+        registry._queue_scan(pipe, keys)
+        registry._apply_scan(await pipe.execute())
+    if active_within is None:
+        return list(registry)
+    return registry.active(active_within)
+
+
+async def watch_nodes(redis_conn, nodes, changes_only=False, fields=None, timeout=None):
+    """
+    Asynchronous generator of the status updates of `nodes`, as for `nodeControl.watch.watch_nodes`.
+
+    :param redis_conn: redis.asyncio.StrictRedis instance
+    :return: Asynchronous generator of `(node, timestamp, status)` tuples
+    """
+    channel = CHANGES_CHANNEL if changes_only or fields is not None else UPDATES_CHANNEL
+    fields = None if fields is None else set(fields)
+    pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(*[channel % node for node in nodes])
+    try:
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = 1.0 if deadline is None else deadline - time.time()
+            if wait <= 0:
+                return
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=wait)
+            if message is None or message["type"] != "message":
+                continue
+            node, timestamp, status = decode_update(message["data"])
+            if fields is not None and fields.isdisjoint(status.get("changed", ())):
+                continue
+            if timeout is not None:
+                deadline = time.time() + timeout
+            yield node, timestamp, status
+    finally:
+        await pubsub.aclose()
+
+
+class NodeControl(object):
+    """
+    Asynchronous counterpart of nodeControl.NodeControl. Status methods return the same values,
+    and commands are queued the same way, but every method is a coroutine.
+    """
+
+    def __init__(self, node, serverAddress="redishost", redis_conn=None):
+        """
+        :param node: Node ID
+        :param serverAddress: The hostname, or dotted quad IP address, of the machine running the node
+                              control and monitoring redis server
+        :type serverAddress: String
+        :param redis_conn: redis.asyncio.StrictRedis instance to use instead of the shared client for
+                           `serverAddress`. The shared client is looked up when first needed, so
+                           instances can be created outside the event loop.
+        """
+        self.node = node
+        self.serverAddress = serverAddress
+        self._r = redis_conn
+
+    @property
+    def r(self):
+        if self._r is None:
+            self._r = get_async_redis(self.serverAddress)
+        return self._r
+
+    async def _get_raw_hash(self, key):
+        return _decode_hash(await self.r.hgetall(key))
+
+    async def get_sensors(self):
+        """
+        Get the current node sensor values, as returned by nodeControl.NodeControl.get_sensors.
+        """
+        stats = await self._get_raw_hash("status:node:%d" % self.node)
+        return status_time(stats), SENSORS.decode(stats)
+
+    async def get_power_status(self):
+        """
+        Get the current node power relay states, as returned by nodeControl.NodeControl.get_power_status.
+        """
+        stats = await self._get_raw_hash("status:node:%d" % self.node)
+        return status_time(stats), _power_status(stats)
+
+    async def get_wr_status(self):
+        """
+        Get the current status of this node's White Rabbit endpoint, as returned by
+        nodeControl.NodeControl.get_wr_status. Returns None if there is none.
+        """
+        stats = await self._get_raw_hash("status:wr:heraNode%dwr" % self.node)
+        try:
+            timestamp = status_time(stats)
+        except (KeyError, ValueError, OverflowError):
+            return None
+        return timestamp, WR_STATUS.decode(stats)
+
+    async def age_seconds(self):
+        """
+        Get the time, in seconds, since this node's status was last updated, or None if it has no status.
+        """
+        values = await self.r.hmget("status:node:%d" % self.node, "timestamp_us", "timestamp")
+        t = status_epoch({k: v.decode() for k, v in zip(("timestamp_us", "timestamp"), values) if v is not None})
+        if t is None:
+            return None
+        return time.time() - t
+
+    async def check_exists(self):
+        """
+        Return True if this node has a status hash in redis.
+        """
+        return await self.r.exists("status:node:%d" % self.node) > 0
+
+    async def set_power(self, relay=None, snap=None, fem=None, pam=None):
+        """
+        Set any number of this node's power states at once, as for nodeControl.NodeControl.set_power.
+
+        :return: Dictionary of control (e.g. 'power_pam') -> command ID, to pass to `wait_for`
+        """
+        commands = power_commands(relay, snap, fem, pam)
+        if not commands:
+            return {}
+        pipe = self.r.pipeline(transaction=True)
+        ids = _add_commands(pipe, {self.node: commands})[self.node]
+        await pipe.execute()
+        return {control: cmd_id for (control, _), cmd_id in zip(commands, ids)}
+
+    async def reset(self):
+        """
+        Reset this node's Arduino.
+
+        :return: ID of the command
+        """
+        pipe = self.r.pipeline(transaction=True)
+        cmd_id = _add_commands(pipe, {self.node: [("reset", None)]})[self.node][0]
+        await pipe.execute()
+        return cmd_id
+
+    async def get_command_status(self, command_id):
+        """
+        Return the record of the command with ID `command_id`, as returned by
+        nodeControl.NodeControl.get_command_status, or None if there is no record of it.
+        """
+        return _command_record(await self.r.hgetall(COMMAND_STATUS_KEY % command_id))
+
+    async def wait_for(self, command_id, timeout=30):
+        """
+        Wait for the command with ID `command_id` to be confirmed or given up on, as for
+        nodeControl.NodeControl.wait_for. Other tasks run while waiting.
+        """
+        record = await self.get_command_status(command_id)
+        if record is None or record["state"] in ("acked", "failed", "superseded", "sent"):
+            return record
+        # A BLPOP timeout of 0 would block forever
+        if await self.r.blpop(COMMAND_DONE_KEY % command_id, timeout=max(timeout, 0.01)) is None:
+            return None
+        return await self.get_command_status(command_id)
+
+    async def get_sensor_history(self, start=None, end=None, page_size=10000):
+        """
+        Get this node's status samples between `start` and `end` from its history stream,
+        as returned by nodeControl.NodeControl.get_sensor_history.
+        """
+        key = HISTORY_KEY % self.node
+        first = _stream_id(start, "-")
+        last = _stream_id(end, "+")
+        ids = []
+        columns = {field: [] for field in HISTORY_SENSOR_FIELDS + HISTORY_POWER_FIELDS}
+        while True:
+            page = await self.r.xrange(key, first, last, count=page_size)
+            first = _add_history_page(page, ids, columns)
+            if len(page) < page_size:
+                break
+        return _history_arrays(ids, columns)
+
+    async def get_sensor_summary(self, start=None, end=None, max_points=1000):
+        """
+        Get a summary of this node's sensor values between `start` and `end`, from its raw samples
+        or rollups, as returned by nodeControl.NodeControl.get_sensor_summary.
+        """
+        start, end, span = _summary_window(start, end)
+        if span / STATUS_INTERVAL_SEC <= max_points:
+            oldest = await self.r.xrange(HISTORY_KEY % self.node, "-", "+", count=1)
+            if _history_covers(oldest, start):
+                return _raw_summary(*await self.get_sensor_history(start, end))
+
+        resolution = _rollup_resolution(start, span, max_points)
+        buckets = await self.r.zrangebyscore(ROLLUP_KEY % (resolution, self.node),
+                                             int(start // resolution) * resolution, end)
+        return _rollup_summary(resolution, buckets)
+
+    async def watch(self, changes_only=False, fields=None, timeout=None):
+        """
+        Asynchronous generator of this node's status as the receiver publishes it, yielding
+        `(timestamp, status)` tuples as nodeControl.NodeControl.watch does.
+        """
+        async for _, timestamp, status in watch_nodes(self.r, [self.node], changes_only, fields, timeout):
+            yield timestamp, status
+
+
+class NodeControlArray(object):
+    """
+    Asynchronous counterpart of nodeControl.NodeControlArray. The nodes' hashes are read with
+    pipelines of at most `batch_size` nodes, up to `max_concurrency` of them in flight at once,
+    so a large array is read in parallel over several pooled connections without monopolising
+    any one of them.
+    """
+
+    def __init__(self, nodes, serverAddress="redishost", redis_conn=None, batch_size=64,
+                 max_concurrency=MAX_CONCURRENCY):
+        """
+        :param nodes: Iterable of node IDs, in the order results are returned
+        :param serverAddress: The hostname, or dotted quad IP address, of the machine running the node
+                              control and monitoring redis server
+        :param redis_conn: redis.asyncio.StrictRedis instance to use instead of the shared client
+        :param batch_size: Maximum number of hashes read by each pipeline
+        :param max_concurrency: Maximum number of pipelines in flight at once
+        """
+        self.nodes = np.array(list(nodes), dtype=int)
+        self.serverAddress = serverAddress
+        self._r = redis_conn
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+
+    @property
+    def r(self):
+        if self._r is None:
+            self._r = get_async_redis(self.serverAddress)
+        return self._r
+
+    @classmethod
+    async def from_valid_nodes(cls, serverAddress="redishost", active_within=None, **kwargs):
+        """
+        Return a NodeControlArray of all the nodes which currently have status data in redis,
+        as listed by `get_valid_nodes`, sorted by node ID.
+        """
+        return cls(sorted(await get_valid_nodes(serverAddress, active_within)), serverAddress, **kwargs)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    async def _read_batches(self, keys, command, *args):
+        """
+        Run `command` (e.g. "hgetall") on each of `keys`, in concurrent pipelines of at most `batch_size` keys.
+
+        :return: List of the results, in the order of `keys`
+        """
+        async def read(batch):
+            pipe = self.r.pipeline(transaction=False)
+            for key in batch:
+                getattr(pipe, command)(key, *args)
+            return await pipe.execute()
+
+        batches = [keys[i:i + self.batch_size] for i in range(0, len(keys), self.batch_size)]
+        return [result for results in await fan_out(read, batches, self.max_concurrency) for result in results]
+
+    async def get_status(self):
+        """
+        Get the current status of every node, as returned by nodeControl.NodeControlArray.get_status.
+        """
+        raw = await self._read_batches(["status:node:%d" % node for node in self.nodes], "hgetall")
+        return _decode_statuses(self.nodes, [_decode_hash(stats) for stats in raw], NODE_STATUS)
+
+    async def get_sensors(self):
+        """
+        Get the current sensor values of every node, as returned by nodeControl.NodeControlArray.get_sensors.
+        """
+        status = await self.get_status()
+        return status['timestamp'], {field: status[field] for field in SENSOR_FIELDS + ('cpu_uptime_ms', 'ip', 'mac')}
+
+    async def get_power_status(self):
+        """
+        Get the current power states of every node, as returned by nodeControl.NodeControlArray.get_power_status.
+        """
+        status = await self.get_status()
+        return status['timestamp'], {field: status[field] for field in POWER_FIELDS}
+
+    async def get_wr_status(self):
+        """
+        Get the current status of every node's White Rabbit endpoint, as returned by
+        nodeControl.NodeControlArray.get_wr_status.
+        """
+        raw = await self._read_batches(["status:wr:heraNode%dwr" % node for node in self.nodes], "hgetall")
+        return _decode_statuses(self.nodes, [_decode_hash(stats) for stats in raw], WR_STATUS)
+
+    async def age_seconds(self):
+        """
+        Get the time since each node's status was last updated, as a float array with NaN for
+        nodes with no status.
+        """
+        raw = await self._read_batches(["status:node:%d" % node for node in self.nodes], "hmget",
+                                       "timestamp_us", "timestamp")
+        return _status_ages([{k: v.decode() for k, v in zip(('timestamp_us', 'timestamp'), values) if v is not None}
+                             for values in raw])
+
+    async def set_power(self, relay=None, snap=None, fem=None, pam=None):
+        """
+        Set the power states of every node, as for nodeControl.set_power_many, in one transaction.
+
+        :return: Dictionary of node ID -> dictionary of control -> command ID
+        """
+        commands = power_commands(relay, snap, fem, pam)
+        if not commands or not len(self.nodes):
+            return {}
+        pipe = self.r.pipeline(transaction=True)
+        ids = _add_commands(pipe, {int(node): commands for node in self.nodes})
+        await pipe.execute()
+        return {node: {control: cmd_id for (control, _), cmd_id in zip(commands, node_ids)}
+                for node, node_ids in ids.items()}
+
+    def watch(self, changes_only=False, fields=None, timeout=None):
+        """
+        Asynchronous generator of the status of each node as the receiver publishes it,
+        yielding `(node, timestamp, status)` tuples as nodeControl.NodeControlArray.watch does.
+        """
+        return watch_nodes(self.r, self.nodes.tolist(), changes_only, fields, timeout)
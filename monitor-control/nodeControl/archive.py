@@ -0,0 +1,184 @@
+"""
+Reader of the daily status archive files written by the hera_node_archiver script.
+
+Each `status_YYYYMMDD.npz` file holds one UTC day of samples from all nodes, in chunks of
+typed columns, `chunkNNNNNN/<column>.npy`, with a time index saying which times each chunk
+covers. Only the chunks overlapping the time range asked for are read. Archives written
+with --no-compress are memory-mapped instead of being read into memory; compressed chunks
+have to be decompressed, which can't be done lazily.
+"""
+
+import datetime
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+ARCHIVE_FILE = "status_%Y%m%d.npz"
+CHUNK_MEMBER = "chunk%06d/%s.npy"
+CHUNK_INDEX_PREFIX = "chunk_index/"
+INDEX_MEMBER = "index.npy"
+INDEX_DTYPE = np.dtype([("chunk", "i4"), ("start", "f8"), ("end", "f8"), ("rows", "i8")])
+# Columns in each chunk, besides "time" (seconds since the epoch). Sensors are float32, NaN if not
+# available, "node" is int16, "cpu_uptime_ms" is uint32 and power states are bools.
+ARCHIVE_FIELDS = ("node", "temp_top", "temp_mid", "temp_bot", "temp_humid", "humid", "cpu_uptime_ms",
+                  "power_snap_relay", "power_fem", "power_pam",
+                  "power_snap_0", "power_snap_1", "power_snap_2", "power_snap_3")
+
+# Fixed size part of a zip local file header, and the offset of its name and extra field lengths
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_LENGTHS_OFFSET = 26
+_LOCAL_HEADER_LENGTHS = struct.Struct("<HH")
+
+
+def _seconds(t):
+    if isinstance(t, datetime.datetime):
+        return t.timestamp()
+    return t
+
+
+class StatusArchive(object):
+    """
+    One daily archive file.
+    """
+
+    def __init__(self, path, mmap=True):
+        """
+        :param path: Path of the status_YYYYMMDD.npz file
+        :param mmap: If True, memory-map the chunks of uncompressed archives rather than reading them
+        """
+        self.path = path
+        self.mmap = mmap
+        self.zf = zipfile.ZipFile(path)
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zf.close()
+
+    @property
+    def index(self):
+        """
+        Structured numpy array of the ("chunk", "start", "end", "rows") of each chunk, where
+        "start" and "end" are the times of its first and last samples.
+        """
+        if self._index is None:
+            names = self.zf.namelist()
+            chunk_names = sorted(n for n in names if n.startswith(CHUNK_INDEX_PREFIX))
+            if INDEX_MEMBER in names:
+                with self.zf.open(INDEX_MEMBER) as fh:
+                    self._index = np.lib.format.read_array(fh)
+            if self._index is None or len(self._index) != len(chunk_names):
+                # The archiver is still writing this day; gather the entries of each chunk
+                entries = []
+                for name in chunk_names:
+                    with self.zf.open(name) as fh:
+                        entries.append((int(name[len(CHUNK_INDEX_PREFIX):-4]),) +
+                                       tuple(np.lib.format.read_array(fh)))
+                self._index = np.array(entries, dtype=INDEX_DTYPE)
+        return self._index
+
+    def _column(self, chunk, name):
+        info = self.zf.getinfo(CHUNK_MEMBER % (chunk, name))
+        if not (self.mmap and info.compress_type == zipfile.ZIP_STORED):
+            with self.zf.open(info) as fh:
+                return np.lib.format.read_array(fh)
+        with open(self.path, "rb") as fh:
+            fh.seek(info.header_offset + _LOCAL_HEADER_LENGTHS_OFFSET)
+            name_len, extra_len = _LOCAL_HEADER_LENGTHS.unpack(fh.read(4))
+            fh.seek(info.header_offset + _LOCAL_HEADER_SIZE + name_len + extra_len)
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+            offset = fh.tell()
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=shape,
+                         order="F" if fortran_order else "C")
+
+    def read(self, start=None, end=None, nodes=None, fields=None):
+        """
+        Read the samples between `start` and `end`.
+
+        Returns a tuple `(timestamps, columns)`, where `timestamps` is a numpy datetime64[ms] array
+        of the (UTC) times of the samples, and `columns` is a dictionary of field -> numpy array,
+        with one entry per sample. Samples are in time order, and the "node" column gives
+        the node each one is from.
+
+        :param start: datetime, or time in seconds since the epoch, of the first sample. Defaults to the start of the file.
+        :param end: datetime, or time in seconds since the epoch, of the last sample. Defaults to the end of the file.
+        :param nodes: If not None, list of node IDs to keep the samples of
+        :param fields: List of fields to read, from ARCHIVE_FIELDS. Defaults to all of them.
+        """
+        start, end = _seconds(start), _seconds(end)
+        fields = list(ARCHIVE_FIELDS if fields is None else fields)
+        if nodes is not None and "node" not in fields:
+            fields.append("node")
+        index = self.index
+        keep = np.ones(len(index), dtype=bool)
+        if start is not None:
+            keep &= index["end"] >= start
+        if end is not None:
+            keep &= index["start"] <= end
+
+        times = []
+        columns = {field: [] for field in fields}
+        for chunk, chunk_start, chunk_end in zip(index["chunk"][keep], index["start"][keep], index["end"][keep]):
+            t = self._column(chunk, "time")
+            sel = slice(None)
+            if (start is not None and chunk_start < start) or (end is not None and chunk_end > end) or nodes is not None:
+                sel = np.ones(len(t), dtype=bool)
+                if start is not None:
+                    sel &= t >= start
+                if end is not None:
+                    sel &= t <= end
+                if nodes is not None:
+                    sel &= np.isin(self._column(chunk, "node"), nodes)
+            times.append(t[sel])
+            for field in fields:
+                columns[field].append(self._column(chunk, field)[sel])
+
+        if not times:
+            return np.array([], dtype="datetime64[ms]"), {field: np.array([]) for field in fields}
+        times = np.concatenate(times)
+        columns = {field: np.concatenate(arrays) for field, arrays in columns.items()}
+        return np.round(times * 1000).astype("int64").astype("datetime64[ms]"), columns
+
+
+def read_archive(directory, start, end=None, nodes=None, fields=None, mmap=True):
+    """
+    Read the samples between `start` and `end` from the daily archive files in `directory`.
+    Returns the same as `StatusArchive.read`, across every day in the range. Days with no
+    archive file are skipped.
+
+    :param directory: Directory of the status_YYYYMMDD.npz files
+    :param start: datetime, or time in seconds since the epoch, of the first sample
+    :param end: datetime, or time in seconds since the epoch, of the last sample. Defaults to now.
+    """
+    start = _seconds(start)
+    end = datetime.datetime.now().timestamp() if end is None else _seconds(end)
+    timestamps = []
+    columns = {}
+    day = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).date()
+    last_day = datetime.datetime.fromtimestamp(end, datetime.timezone.utc).date()
+    while day <= last_day:
+        path = os.path.join(directory, day.strftime(ARCHIVE_FILE))
+        day += datetime.timedelta(days=1)
+        if not os.path.exists(path):
+            continue
+        with StatusArchive(path, mmap) as archive:
+            t, c = archive.read(start, end, nodes, fields)
+        timestamps.append(t)
+        for field, values in c.items():
+            columns.setdefault(field, []).append(values)
+    if not timestamps:
+        return np.array([], dtype="datetime64[ms]"), {}
+    return np.concatenate(timestamps), {field: np.concatenate(arrays) for field, arrays in columns.items()}
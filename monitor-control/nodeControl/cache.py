@@ -0,0 +1,183 @@
+"""
+Client-side cache of the status hashes read by NodeControl and NodeControlArray.
+"""
+
+import collections
+import sys
+import threading
+import time
+
+import redis
+
+from .connection import get_redis
+
+
+class StatusCache(object):
+    """
+    Keeps the decoded contents of recently read redis hashes in memory, so that repeated reads
+    of a node's status, e.g. by a monitoring GUI calling get_sensors and get_power_status for
+    many nodes, don't each make a round trip to redis.
+
+    If the redis server publishes keyspace notifications for hash and generic commands
+    (`notify-keyspace-events` including K, h and g, as set in backend/redis.conf), a background
+    thread subscribes to them and drops each hash from the cache as soon as it changes, and
+    entries are kept for up to `max_age_notified` seconds. Otherwise, or if the subscription
+    is lost, entries are only trusted for `max_age` seconds.
+
+    At most `max_entries` hashes are kept, evicting the least recently used. One cache can be
+    shared by any number of NodeControl instances talking to the same server.
+    """
+
+    def __init__(self, serverAddress="redishost", redis_conn=None, max_age=1.0, max_age_notified=60.0,
+                 max_entries=1024, notifications=True):
+        """
+        :param serverAddress: The hostname, or dotted quad IP address, of the machine running the node
+                              control and monitoring redis server
+        :type serverAddress: String
+        :param redis_conn: redis.StrictRedis instance to use instead of connecting to `serverAddress`
+        :param max_age: Time, in seconds, entries are kept without keyspace notifications
+        :param max_age_notified: Time, in seconds, entries are kept while keyspace notifications are received
+        :param max_entries: Maximum number of hashes kept
+        :param notifications: Set to False to never subscribe to keyspace notifications
+        """
+        self.r = redis_conn if redis_conn is not None else get_redis(serverAddress)
+        self.max_age = max_age
+        self.max_age_notified = max_age_notified
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # Ordered dictionary of key -> (time fetched, decoded hash), least recently used first
+        self.entries = collections.OrderedDict()
+        # Dictionary of key -> number of invalidations, so a fetch overtaken by a change isn't cached
+        self.versions = collections.defaultdict(int)
+        self.stats = dict.fromkeys(("hits", "misses", "invalidations", "evictions"), 0)
+        self.pubsub = None
+        self.thread = None
+        if notifications:
+            self._subscribe()
+
+    def _subscribe(self):
+        try:
+            events = self.r.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+        except redis.exceptions.RedisError:
+            return
+        if isinstance(events, bytes):
+            events = events.decode()
+        if "K" not in events or not ("A" in events or ("h" in events and "g" in events)):
+            return
+        db = self.r.connection_pool.connection_kwargs.get("db", 0)
+        self.pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.psubscribe(**{"__keyspace@%d__:status:*" % db: self._on_notification})
+        self.thread = self.pubsub.run_in_thread(sleep_time=1.0, daemon=True,
+                                                exception_handler=self._on_subscription_error)
+
+    def _on_notification(self, message):
+        key = message["channel"].decode().split(":", 1)[1]
+        with self.lock:
+            self.versions[key] += 1
+            if self.entries.pop(key, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def _on_subscription_error(self, e, pubsub, thread):
+        print("Lost keyspace notifications, falling back to max_age: %s" % e, file=sys.stderr)
+        thread.stop()
+        with self.lock:
+            self.thread = None
+            # Changes may have been missed
+            self.entries.clear()
+
+    @property
+    def notified(self):
+        """
+        True if entries are being invalidated by keyspace notifications.
+        """
+        return self.thread is not None
+
+    def close(self):
+        """
+        Stop listening for keyspace notifications.
+        """
+        if self.thread is not None:
+            self.thread.stop()
+            self.thread = None
+        if self.pubsub is not None:
+            self.pubsub.close()
+            self.pubsub = None
+
+    def _lookup(self, key, now):
+        entry = self.entries.get(key)
+        max_age = self.max_age_notified if self.thread is not None else self.max_age
+        if entry is None or now - entry[0] > max_age:
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def _store(self, key, value, fetched, version):
+        if self.versions[key] != version:
+            # Changed while it was being fetched
+            return
+        self.entries[key] = (fetched, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, key):
+        """
+        Return the contents of the hash `key`, from the cache if possible.
+
+        :return: Dictionary of decoded field -> value. Empty if the hash doesn't exist.
+        """
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        """
+        Return the contents of each hash in `keys`, fetching the ones not in the cache with one pipeline.
+
+        :return: List of dictionaries of decoded field -> value, in the order of `keys`
+        """
+        now = time.time()
+        results = [None] * len(keys)
+        missing = []
+        with self.lock:
+            for i, key in enumerate(keys):
+                value = self._lookup(key, now)
+                if value is None:
+                    missing.append((i, key, self.versions[key]))
+                else:
+                    results[i] = dict(value)
+        if missing:
+            pipe = self.r.pipeline(transaction=False)
+            for _, key, _ in missing:
+                pipe.hgetall(key)
+            fetched = pipe.execute()
+            with self.lock:
+                for (i, key, version), raw in zip(missing, fetched):
+                    value = {k.decode(): v.decode() for k, v in raw.items()}
+                    self._store(key, value, now, version)
+                    results[i] = dict(value)
+        return results
+
+    def invalidate(self, key=None):
+        """
+        Drop `key`, or every entry if `key` is None, from the cache.
+        """
+        with self.lock:
+            if key is None:
+                for k in self.entries:
+                    self.versions[k] += 1
+                self.entries.clear()
+            else:
+                self.versions[key] += 1
+                self.entries.pop(key, None)
+
+    def get_stats(self):
+        """
+        Return a dictionary of the cache's 'hits', 'misses', 'invalidations' (by keyspace notification)
+        and 'evictions' (to stay within max_entries) since it was created, and its current 'size'.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+        return stats
@@ -0,0 +1,119 @@
+"""
+Redis connections shared by everything in nodeControl.
+
+Each server address gets one connection pool and one redis client, created the first time the
+address is used, and shared by every NodeControl, NodeControlArray, NodeRegistry, StatusCache
+and helper function talking to it. Creating the client doesn't connect; connections are opened
+when a command needs one, and returned to the pool afterwards. A script which builds a
+NodeControl for every node therefore uses one connection for its sequential commands, plus
+one for each blocking call (e.g. `wait_for`) or subscription in progress. The asyncio
+clients used by nodeControl.aio are shared the same way, with separate pools for each event loop.
+
+`serverAddress` may be a hostname or IP address, optionally with a port ("redishost:6380"),
+the path of a unix socket ("/var/run/redis/redis.sock"), or a redis URL ("redis://..." or
+"unix://...").
+"""
+
+import asyncio
+import threading
+import weakref
+
+import redis
+import redis.asyncio
+
+# Time, in seconds, a pooled connection may be idle before it's checked with a PING before use,
+# so connections dropped by the server or a firewall while idle are replaced instead of failing
+HEALTH_CHECK_INTERVAL = 30
+
+_lock = threading.Lock()
+# Dictionary of server address -> dictionary of connection pool options set with `configure`
+_options = {}
+# Dictionary of server address -> shared redis.StrictRedis instance
+_clients = {}
+# Dictionary of event loop -> dictionary of server address -> shared redis.asyncio.StrictRedis instance.
+# asyncio connections can only be used by the loop they were made in, so each loop has its own pools.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _make_pool(serverAddress, options, module=redis):
+    """
+    Return a connection pool for `serverAddress`, from `module`, redis or redis.asyncio.
+    """
+    options = dict(options)
+    options.setdefault("health_check_interval", HEALTH_CHECK_INTERVAL)
+    if "://" in serverAddress:
+        return module.ConnectionPool.from_url(serverAddress, **options)
+    if serverAddress.startswith("/"):
+        return module.ConnectionPool(connection_class=module.UnixDomainSocketConnection,
+                                     path=serverAddress, **options)
+    host, _, port = serverAddress.partition(":")
+    if port:
+        options.setdefault("port", int(port))
+    return module.ConnectionPool(host=host, **options)
+
+
+def configure(serverAddress="redishost", **options):
+    """
+    Set the connection pool options used for `serverAddress`, e.g. `max_connections`,
+    `health_check_interval`, `socket_timeout` or `password`. Takes effect immediately: a pool
+    already created for the address is disconnected and replaced.
+
+    :param serverAddress: Server address, as described in the module documentation
+    :param options: Keyword arguments of redis.ConnectionPool
+    """
+    with _lock:
+        _options[serverAddress] = options
+        client = _clients.pop(serverAddress, None)
+        for clients in _async_clients.values():
+            # Left to be garbage collected, as disconnecting them needs their event loop
+            clients.pop(serverAddress, None)
+    if client is not None:
+        client.connection_pool.disconnect()
+
+
+def get_redis(serverAddress="redishost"):
+    """
+    Return the shared redis client for `serverAddress`, creating it, but not connecting,
+    on first use.
+
+    :param serverAddress: Server address, as described in the module documentation
+    :return: redis.StrictRedis instance
+    """
+    client = _clients.get(serverAddress)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(serverAddress)
+        if client is None:
+            pool = _make_pool(serverAddress, _options.get(serverAddress, {}))
+            client = _clients[serverAddress] = redis.StrictRedis(connection_pool=pool)
+    return client
+
+
+def get_async_redis(serverAddress="redishost"):
+    """
+    Return the shared redis.asyncio client for `serverAddress` in the running event loop,
+    creating it, but not connecting, on first use. Must be called from a coroutine.
+
+    :param serverAddress: Server address, as described in the module documentation
+    :return: redis.asyncio.StrictRedis instance
+    """
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(serverAddress)
+        if client is None:
+            pool = _make_pool(serverAddress, _options.get(serverAddress, {}), redis.asyncio)
+            client = clients[serverAddress] = redis.asyncio.StrictRedis(connection_pool=pool)
+    return client
+
+
+def disconnect_all():
+    """
+    Close every pooled connection. Clients are kept, and reconnect when next used.
+    Connections of asyncio clients are closed when their event loop is.
+    """
+    with _lock:
+        clients = list(_clients.values())
+    for client in clients:
+        client.connection_pool.disconnect()
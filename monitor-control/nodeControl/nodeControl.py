@@ -1,17 +1,265 @@
-import redis
 import time
-import dateutil.parser
 import datetime
 import json
+import uuid
+import numpy as np
+
+from .connection import get_redis
+from .registry import NodeRegistry
+from .watch import watch_nodes
+from .timestamps import status_epoch, status_time
+from .schema import str2bool, SENSORS, WR_STATUS, POWER_ON_ORDER, POWER_OFF_ORDER
+
+# Commands are pushed onto this per-node list, as well as being flagged in the commands:node:x hash
+COMMAND_QUEUE_KEY = "commands:queue:node:%d"
+# Time, in seconds, after which unconsumed commands are discarded
+COMMAND_QUEUE_TTL = 3600
+# Hash describing each command, updated by the command checker as the command is sent and confirmed
+COMMAND_STATUS_KEY = "commands:status:%s"
+# List the command checker pushes to once a command is confirmed or given up on
+COMMAND_DONE_KEY = "commands:done:%s"
+# Stream of status samples of each node, written by the receiver
+HISTORY_KEY = "status:history:node:%d"
+# Sensor fields stored in the history streams, returned as floats
+HISTORY_SENSOR_FIELDS = ("temp_top", "temp_mid", "temp_bot", "temp_humid", "humid", "cpu_uptime_ms")
+# Power state fields stored in the history streams, returned as bools
+HISTORY_POWER_FIELDS = ("power_snap_relay", "power_snap_0", "power_snap_1", "power_snap_2", "power_snap_3",
+                        "power_fem", "power_pam")
+# Sorted set of the sensor rollup buckets of each node, at each resolution, written by the receiver
+ROLLUP_KEY = "status:rollup:%d:node:%d"
+# Pairs of (resolution, retention), in seconds, of the rollups kept by the receiver
+ROLLUP_RESOLUTIONS = ((60, 7 * 86400), (600, 90 * 86400), (3600, 3 * 365 * 86400))
+# Rollup statistics returned for each sensor
+ROLLUP_STATS = ("min", "max", "mean", "count")
+# Approximate time, in seconds, between status samples from a node
+STATUS_INTERVAL_SEC = 1.0
+
+def _stream_id(t, default):
+    """
+    Convert `t`, a datetime, a time in seconds since the epoch, or None, into a redis stream ID.
+    """
+    if t is None:
+        return default
+    if isinstance(t, datetime.datetime):
+        t = t.timestamp()
+    return "%d" % int(t * 1000)
+
+def _add_history_page(page, ids, columns):
+    """
+    Append the samples in `page`, a list of XRANGE entries, to `ids`, the list of sample times
+    in ms, and `columns`, the dictionary of field -> list of raw values.
+    Return the stream ID following the last sample, or None if `page` is empty.
+    """
+    for entry_id, sample in page:
+        ids.append(int(entry_id.split(b"-")[0]))
+        for field, column in columns.items():
+            column.append(sample.get(field.encode()))
+    if not page:
+        return None
+    ms, seq = page[-1][0].decode().split("-")
+    return "%s-%d" % (ms, int(seq) + 1)
+
+def _history_float(v):
+    """
+    Convert the raw history value `v` into a float, NaN if it is missing or not a number.
+    """
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _history_arrays(ids, columns):
+    """
+    Convert the sample times and raw columns collected by `_add_history_page` into the
+    `(timestamps, history)` tuple returned by NodeControl.get_sensor_history.
+    """
+    history = {}
+    for field in HISTORY_SENSOR_FIELDS:
+        history[field] = np.array([_history_float(v) for v in columns[field]], dtype=float)
+    for field in HISTORY_POWER_FIELDS:
+        history[field] = np.array([v == b"1" for v in columns[field]], dtype=bool)
+    return np.array(ids, dtype="datetime64[ms]"), history
+
+def _history_covers(oldest, start):
+    """
+    Return True if `oldest`, the result of an XRANGE of a history stream with count 1, shows
+    that the stream exists and goes back to `start`, in seconds since the epoch.
+    """
+    return bool(oldest) and int(oldest[0][0].split(b"-")[0]) <= start * 1000
+
+def _summary_window(start, end):
+    """
+    Convert the `start` and `end` arguments of NodeControl.get_sensor_summary into seconds
+    since the epoch, applying their defaults. Return `(start, end, span)`.
+    """
+    if isinstance(end, datetime.datetime):
+        end = end.timestamp()
+    if isinstance(start, datetime.datetime):
+        start = start.timestamp()
+    end = time.time() if end is None else end
+    start = end - 3600 if start is None else start
+    return start, end, max(end - start, 0)
+
+def _rollup_resolution(start, span, max_points):
+    """
+    Return the finest rollup resolution which keeps `span` seconds within `max_points` points
+    and whose retention covers `start`, or the coarsest resolution if none does.
+    """
+    for res, retention in ROLLUP_RESOLUTIONS:
+        if span / res <= max_points and start >= time.time() - retention:
+            return res
+    return ROLLUP_RESOLUTIONS[-1][0]
+
+def _raw_summary(timestamps, history):
+    """
+    Convert the result of NodeControl.get_sensor_history into the result of NodeControl.get_sensor_summary.
+    """
+    summary = {}
+    for field in HISTORY_SENSOR_FIELDS[:-1]:
+        values = history[field]
+        summary[field] = {"min": values, "max": values, "mean": values,
+                          "count": (~np.isnan(values)).astype(int)}
+    return 0, timestamps, summary
+
+def _rollup_summary(resolution, buckets):
+    """
+    Convert `buckets`, the JSON encoded rollup buckets at `resolution`, into the result of
+    NodeControl.get_sensor_summary.
+    """
+    buckets = [json.loads(b) for b in buckets]
+    summary = {}
+    for field in HISTORY_SENSOR_FIELDS[:-1]:
+        stats = [b.get(field, (np.nan, np.nan, np.nan, 0)) for b in buckets]
+        summary[field] = {name: np.array([s[i] for s in stats], dtype=int if name == "count" else float)
+                          for i, name in enumerate(ROLLUP_STATS)}
+    return resolution, np.array([b["t"] for b in buckets], dtype="datetime64[s]"), summary
+
+def _power_command(state):
+    """
+    Convert `state`, 'on', 'off' or a bool, into a power command, 'on' or 'off'.
+    """
+    if state in ("on", "off"):
+        return state
+    return "on" if state else "off"
+
+def power_commands(relay=None, snap=None, fem=None, pam=None):
+    """
+    Return the commands which set the requested power states, in a safe order: everything
+    being turned off first, SNAPs before the SNAP relay, then everything being turned on,
+    the SNAP relay before the SNAPs. Controls whose state is None are left alone.
+
+    :param relay: State of the SNAP relay: 'on', 'off', a bool, or None
+    :param snap: State of all four SNAPs, or a sequence of the states of SNAPs 0 to 3
+    :param fem: State of the FEM
+    :param pam: State of the PAM
+    :return: List of (control, 'on' | 'off') tuples
+    """
+    if snap is None or isinstance(snap, (str, bool)):
+        snap = [snap] * 4
+    if len(snap) != 4:
+        raise ValueError("Expected the states of 4 SNAPs, got %d" % len(snap))
+    states = dict(zip(POWER_ON_ORDER, [relay] + list(snap) + [fem, pam]))
+    commands = {control: _power_command(state) for control, state in states.items() if state is not None}
+    return ([(control, "off") for control in POWER_OFF_ORDER if commands.get(control) == "off"] +
+            [(control, "on") for control in POWER_ON_ORDER if commands.get(control) == "on"])
+
+def queue_commands(redis_conn, commands):
+    """
+    Queue power commands for many nodes in one round trip, as a single MULTI/EXEC transaction.
+
+    Each node's triggers and command values are written with one HSET of its commands:node:x
+    hash, so the command checker never sees a trigger without its command. Its commands are
+    pushed onto its command queue, in the given order, with one RPUSH, and each command's
+    commands:status:<id> record is created.
+
+    :param redis_conn: redis.StrictRedis instance
+    :param commands: Dictionary of node ID -> list of (control, 'on' | 'off') tuples. A control
+                     of "reset" (with any command) resets the node's Arduino.
+    :return: Dictionary of node ID -> list of command IDs, to pass to `NodeControl.wait_for`,
+             in the order of the node's commands
+    """
+    pipe = redis_conn.pipeline(transaction=True)
+    ids = _add_commands(pipe, commands)
+    if ids:
+        pipe.execute()
+    return ids
 
-def str2bool(x):
+def _add_commands(pipe, commands):
     """
-    Convert the string `x` to a boolean.
-    :return: bool(x == '1')
+    Queue the writes of `queue_commands` on the transaction pipeline `pipe`, which may be a
+    redis.asyncio pipeline.
+
+    :return: Dictionary of node ID -> list of command IDs
+    """
+    ids = {}
+    now = time.time()
+    for node, node_commands in commands.items():
+        if not node_commands:
+            continue
+        triggers = {}
+        entries = []
+        ids[node] = []
+        for control, command in node_commands:
+            cmd_id = uuid.uuid4().hex
+            status_key = COMMAND_STATUS_KEY % cmd_id
+            if control == "reset":
+                triggers["reset"] = "True"
+                entries.append(json.dumps({"id": cmd_id, "cmd": control, "time": now}))
+                pipe.hset(status_key, mapping={"node": node, "cmd": control, "state": "queued",
+                                               "queued_time": now})
+            else:
+                triggers["%s_ctrl_trig" % control] = "True"
+                triggers["%s_cmd" % control] = command
+                entries.append(json.dumps({"id": cmd_id, "cmd": control, "value": command, "time": now}))
+                pipe.hset(status_key, mapping={"node": node, "cmd": control, "value": command,
+                                               "state": "queued", "queued_time": now})
+            pipe.expire(status_key, COMMAND_QUEUE_TTL)
+            ids[node].append(cmd_id)
+        pipe.hset("commands:node:%d" % node, mapping=triggers)
+        pipe.rpush(COMMAND_QUEUE_KEY % node, *entries)
+        pipe.expire(COMMAND_QUEUE_KEY % node, COMMAND_QUEUE_TTL)
+    return ids
+
+def set_power_many(nodes, serverAddress = "redishost", relay = None, snap = None, fem = None, pam = None):
     """
-    return x == "1"
+    Set the power states of many nodes, queueing the commands for all of them in one round trip.
+    The states are as for `NodeControl.set_power`.
 
-def get_valid_nodes(serverAddress = "redishost"):
+    :param nodes: Iterable of node IDs
+    :param serverAddress: The hostname, or dotted quad IP address, of the machine running the node
+                          control and monitoring redis server
+    :type serverAddress: String
+    :return: Dictionary of node ID -> dictionary of control -> command ID
+    """
+    commands = power_commands(relay, snap, fem, pam)
+    if not commands:
+        return {}
+    ids = queue_commands(get_redis(serverAddress), {node: commands for node in nodes})
+    return {node: {control: cmd_id for (control, _), cmd_id in zip(commands, node_ids)}
+            for node, node_ids in ids.items()}
+
+def _power_status(stats):
+    """
+    Return the power states in the decoded status hash `stats`, as returned by `NodeControl.get_power_status`.
+    """
+    return {key: str2bool(val) for key, val in stats.items() if key.startswith("power")}
+
+def _command_record(record):
+    """
+    Decode the raw commands:status:<id> hash `record` into the dictionary returned by
+    `NodeControl.get_command_status`, or None if it's empty.
+    """
+    if not record:
+        return None
+    record = {key.decode(): val.decode() for key, val in record.items()}
+    for key in list(record.keys()):
+        if key.endswith("_time") or key == "latency_sec":
+            record[key] = float(record[key])
+        elif key in ("attempts", "node"):
+            record[key] = int(record[key])
+    return record
+
+def get_valid_nodes(serverAddress = "redishost", active_within = None):
     """
     Return a list of all node IDs which currently have status data
     stored in the redis database hosted on `redishost`.
@@ -19,14 +267,18 @@ def get_valid_nodes(serverAddress = "redishost"):
     :param serverAddress: The hostname, or dotted quad IP address, of the machine running the node
                           control and monitoring redis server
     :type serverAddress: String
-    :return: List of integers representing the nodes whose status is currently available. Presence
-             of a node in this list just means that this node has is an associated `status:node` key in
-             redis. It does not mean the node is actively reporting.
+    :param active_within: If not None, only return nodes which have reported status in the last
+                          `active_within` seconds
+    :type active_within: Float
+    :return: List of integers representing the nodes whose status is currently available. Without
+             `active_within`, presence of a node in this list just means that this node has is an
+             associated `status:node` key in redis. It does not mean the node is actively reporting.
     """
-    valid_nodes = []
-    for key in list(redis.StrictRedis(serverAddress).scan_iter("status:node:*")):
-        valid_nodes += [int(key.decode().split(":")[2])]
-    return valid_nodes
+    # The node registry kept by the receiver lists the nodes without scanning the keyspace
+    registry = NodeRegistry(serverAddress).load()
+    if active_within is None:
+        return list(registry)
+    return registry.active(active_within)
 
 
 
@@ -36,7 +288,7 @@ class NodeControl():
     through a Redis database running on the correlator head node.
     """
 
-    def __init__(self, node, serverAddress = "redishost"):
+    def __init__(self, node, serverAddress = "redishost", cache = None):
         """
         Create a NodeControl class instance to control a single node via the redis datastore
         hosted at `serverAddress`.
@@ -46,11 +298,16 @@ class NodeControl():
         :param serverAddress: The hostname, or dotted quad IP address, of the machine running the node
                               control and monitoring redis server
         :type serverAddress: String
+        :param cache: If not None, StatusCache to read the status hashes through, which may be shared
+                      with other NodeControl instances
+        :type cache: StatusCache
         :return: NodeControl instance
         """
 
         self.node = node
-        self.r = redis.StrictRedis(serverAddress)
+        # Shared with every other instance talking to the same server, and only connected when first used
+        self.r = get_redis(serverAddress)
+        self.cache = cache
 
     def _conv_float(self, v):
         """
@@ -61,6 +318,14 @@ class NodeControl():
         except ValueError:
             return None
 
+    def _get_raw_hash(self, key):
+        """
+        Return the decoded content of the redis hash `key`, from the cache if there is one.
+        """
+        if self.cache is not None:
+            return self.cache.get(key)
+        return {k.decode(): v.decode() for k, v in self.r.hgetall(key).items()}
+
     def _get_raw_node_status(self):
         """
         Return the raw content of a node status hash in redis,
@@ -70,7 +335,7 @@ class NodeControl():
 
         :returns: Whatever key-value pairs exist for this node's `status:node` hash
         """
-        return {key.decode(): val.decode() for key, val in self.r.hgetall("status:node:%s" % self.node).items()}
+        return self._get_raw_hash("status:node:%s" % self.node)
 
     def get_sensors(self):
         """
@@ -92,26 +357,9 @@ class NodeControl():
             'mac'            (str)   : MAC address of this node controller module, e.g. "02:03:04:05:06:07"
         """
 
-        stats = {key.decode(): val.decode() for key, val in self.r.hgetall("status:node:%d"%self.node).items()}
-        timestamp = dateutil.parser.parse(stats["timestamp"])
-        conv_methods = {
-            "temp_bot"       : float,
-            "temp_mid"       : float,
-            "temp_top"       : float,
-            "temp_humid"     : float,
-            "humid"          : float,
-            "ip"             : str,
-            "mac"            : str,
-            "cpu_uptime_ms"  : int,
-        }
-        sensors = {}
-        for key, convfunc in conv_methods.items():
-            try:
-                sensors[key] = convfunc(stats[key])
-            except:
-                sensors[key] = None
-
-        return timestamp, sensors
+        stats = self._get_raw_node_status()
+        timestamp = status_time(stats)
+        return timestamp, SENSORS.decode(stats)
 
 
     def get_power_status(self):
@@ -134,13 +382,7 @@ class NodeControl():
         """
 
         statii = self._get_raw_node_status()
-        timestamp = dateutil.parser.parse(statii["timestamp"])
-        for key in list(statii.keys()):
-            if key.startswith("power"):
-                statii[key] = str2bool(statii[key])
-            else:
-                statii.pop(key)
-        return timestamp, statii
+        return status_time(statii), _power_status(statii)
 
     def get_wr_status(self):
         """
@@ -202,74 +444,105 @@ class NodeControl():
             'wr[0|1]_sec'   (int)  : Current TAI time in seconds from UNIX epoch
         """
 
-        stats = {key.decode(): val.decode() for key, val in self.r.hgetall("status:wr:heraNode%dwr" % self.node).items()}
+        stats = self._get_raw_hash("status:wr:heraNode%dwr" % self.node)
         try:
-            timestamp = dateutil.parser.parse(stats["timestamp"])
-        except:
+            timestamp = status_time(stats)
+        except (KeyError, ValueError, OverflowError):
             return None
+        return timestamp, WR_STATUS.decode(stats)
 
-        conv_methods = {
-            'board_info_str' : str,
-            'aliases'        : json.loads,
-            'ip'             : str,
-            'mode'           : str,
-            'serial'         : str,
-            'temp'           : float,
-            'sw_build_date'  : dateutil.parser.parse,
-            'wr_gw_date'     : lambda x : dateutil.parser.parse('20' + x), #hack!
-            'wr_gw_version'  : str,
-            'wr_gw_id'       : str,
-            'wr_build'       : str,
-            'wr_fru_custom'  : str,
-            'wr_fru_device'  : str,
-            'wr_fru_fid'     : dateutil.parser.parse,
-            'wr_fru_partnum' : str,
-            'wr_fru_serial'  : str,
-            'wr_fru_vendor'  : str,
-            '_ad'          : int,
-            '_asym'        : int,
-            '_aux'         : int,
-            '_cko'         : int,
-            '_crtt'        : int,
-            '_dms'         : int,
-            '_drxm'        : int,
-            '_drxs'        : int,
-            '_dtxm'        : int,
-            '_dtxs'        : int,
-            '_hd'          : int,
-            '_lnk'         : bool,
-            '_lock'        : bool,
-            '_md'          : int,
-            '_mu'          : int,
-            '_nsec'        : int,
-            '_rx'          : int,
-            '_setp'        : int,
-            '_ss'          : str,
-            '_sv'          : int,
-            '_syncs'       : str,
-            '_tx'          : int,
-            '_ucnt'        : int,
-            '_sec'         : int,
-        }
-
-        stats_formatted = {}
-
-        for key, convfunc in conv_methods.items():
-            if key.startswith('_'):
-                for i in range(2):
-                    port_key = ('wr%d' % i) + key
-                    try:
-                        stats_formatted[port_key] = convfunc(stats[port_key])
-                    except:
-                        stats_formatted[port_key] = None
-            else:
-                try:
-                    stats_formatted[key] = convfunc(stats[key])
-                except:
-                    stats_formatted[key] = None
+    def age_seconds(self):
+        """
+        Get the time since this node's status was last updated, reading only its timestamp
+        rather than the whole status hash.
 
-        return timestamp, stats_formatted
+        :return: Age of the status, in seconds, or None if the node has no status
+        """
+        if self.cache is not None:
+            stats = self._get_raw_node_status()
+        else:
+            values = self.r.hmget("status:node:%s" % self.node, "timestamp_us", "timestamp")
+            stats = {k: v.decode() for k, v in zip(("timestamp_us", "timestamp"), values) if v is not None}
+        t = status_epoch(stats)
+        if t is None:
+            return None
+        return time.time() - t
 
+    def watch(self, changes_only=False, fields=None, timeout=None):
+        """
+        Yield this node's status as the receiver publishes it, instead of polling `get_sensors`
+        and `get_power_status`. Updates arrive within milliseconds of the receiver writing them.
+
+        Yields tuples `(timestamp, status)`, where `timestamp` is a python `datetime` object of when the
+        status was received, and `status` is a dictionary of the sensor values (floats, `None` if not
+        available), power states (bools), 'cpu_uptime_ms', 'ip' and 'mac'. With `changes_only` or
+        `fields`, `status` also has a 'changed' entry listing the fields which changed.
+
+        :param changes_only: If True, only yield statuses which differ from the previous one, ignoring
+                             the timestamp and uptime
+        :param fields: If not None, only yield statuses in which one of these fields changed, e.g.
+                       `["power_pam", "power_fem"]`
+        :param timeout: If not None, stop after `timeout` seconds without an update
+        """
+        for _, timestamp, status in watch_nodes(self.r, [self.node], changes_only, fields, timeout):
+            yield timestamp, status
+
+    def get_sensor_history(self, start=None, end=None, page_size=10000):
+        """
+        Get this node's status samples between `start` and `end` from its history stream,
+        fetched `page_size` samples per request.
+
+        Returns a tuple `(timestamps, history)`, where `timestamps` is a numpy datetime64[ms] array
+        of the (UTC) times the samples were recorded, and `history` is a dictionary of numpy arrays
+        with one entry per sample. Sensor values ('temp_top', 'temp_mid', 'temp_bot', 'temp_humid',
+        'humid' and 'cpu_uptime_ms') are floats, NaN if not available. Power states
+        ('power_snap_relay', 'power_snap_0', etc.) are bools.
+
+        :param start: datetime, or time in seconds since the epoch, of the first sample. Defaults to the oldest sample.
+        :param end: datetime, or time in seconds since the epoch, of the last sample. Defaults to the newest sample.
+        :param page_size: Number of samples fetched per XRANGE request
+        """
+        key = HISTORY_KEY % self.node
+        first = _stream_id(start, "-")
+        last = _stream_id(end, "+")
+        ids = []
+        columns = {field: [] for field in HISTORY_SENSOR_FIELDS + HISTORY_POWER_FIELDS}
+        while True:
+            page = self.r.xrange(key, first, last, count=page_size)
+            # Continue from the ID after the last one read
+            first = _add_history_page(page, ids, columns)
+            if len(page) < page_size:
+                break
+        return _history_arrays(ids, columns)
+
+    def get_sensor_summary(self, start=None, end=None, max_points=1000):
+        """
+        Get a summary of this node's sensor values between `start` and `end`, with at most
+        about `max_points` points per sensor. Raw samples are used if there are few enough and
+        the node's history stream, which the receiver only keeps if asked to, goes back to `start`.
+        Otherwise the finest rollup resolution (1 minute, 10 minutes or 1 hour) which keeps
+        within `max_points` and whose retention covers `start` is used.
+
+        Returns a tuple `(resolution, timestamps, summary)`, where `resolution` is the width of each
+        point in seconds (0 for raw samples), `timestamps` is a numpy datetime64 array of the start
+        of each point, and `summary` is a dictionary of sensor name -> dictionary of 'min', 'max',
+        'mean' and 'count' -> numpy array, with NaN (or count 0) where a sensor has no samples.
+        Sensors are 'temp_top', 'temp_mid', 'temp_bot', 'temp_humid' and 'humid'.
+
+        :param start: datetime, or time in seconds since the epoch. Defaults to an hour before `end`.
+        :param end: datetime, or time in seconds since the epoch. Defaults to now.
+        :param max_points: Maximum number of points wanted
+        """
+        start, end, span = _summary_window(start, end)
+        if span / STATUS_INTERVAL_SEC <= max_points:
+            oldest = self.r.xrange(HISTORY_KEY % self.node, "-", "+", count=1)
+            if _history_covers(oldest, start):
+                return _raw_summary(*self.get_sensor_history(start, end))
+
+        resolution = _rollup_resolution(start, span, max_points)
+        buckets = self.r.zrangebyscore(ROLLUP_KEY % (resolution, self.node),
+                                       int(start // resolution) * resolution, end)
+        return _rollup_summary(resolution, buckets)
 
     def check_exists(self):
         """
@@ -278,6 +551,67 @@ class NodeControl():
         """
         return self.r.exists("status:node:%d" % self.node) > 0
 
+    def _send_command(self, control, command=None):
+        """
+        Flag a command for the command checker, both by setting its trigger in the commands:node:x
+        hash and by pushing it onto the node's command queue. Both are written in one transaction,
+        along with the command's commands:status:<id> record.
+
+        :param control: Name of the power control (e.g. "power_pam"), or "reset"
+        :param command: 'on' or 'off'. Not used for "reset".
+        :return: ID of the command, to pass to `wait_for`
+        """
+        return queue_commands(self.r, {self.node: [(control, command)]})[self.node][0]
+
+    def set_power(self, relay=None, snap=None, fem=None, pam=None):
+        """
+        Set any number of this node's power states at once. All the commands are written in a
+        single transaction, in one round trip, and queued in a safe order: the SNAPs are turned
+        off before and on after the SNAP relay. States left as None are not changed.
+
+        Turning on a SNAP doesn't turn on the SNAP relay; pass `relay=True` as well.
+
+        :param relay: State of the SNAP relay: 'on', 'off', True or False
+        :param snap: State of all four SNAPs, or a list of the states of SNAPs 0 to 3, e.g.
+                     `[True, None, None, True]` to turn on SNAPs 0 and 3 only
+        :param fem: State of the FEM
+        :param pam: State of the PAM
+        :return: Dictionary of control (e.g. 'power_pam') -> command ID, to pass to `wait_for`
+        """
+        commands = power_commands(relay, snap, fem, pam)
+        if not commands:
+            return {}
+        ids = queue_commands(self.r, {self.node: commands})[self.node]
+        return {control: cmd_id for (control, _), cmd_id in zip(commands, ids)}
+
+    def get_command_status(self, command_id):
+        """
+        Return the record of the command with ID `command_id`, as a dictionary which includes
+        'state' ('queued', 'pending', 'acked', 'failed', 'superseded' or, for resets, 'sent'),
+        'attempts' and, once acked, 'latency_sec', the time from queueing the command
+        to the node reporting it. Returns None if there is no record of the command.
+        """
+        return _command_record(self.r.hgetall(COMMAND_STATUS_KEY % command_id))
+
+    def wait_for(self, command_id, timeout=30):
+        """
+        Wait for the command with ID `command_id`, as returned by the power_* methods, to be
+        confirmed by the node's status, or given up on by the command checker.
+
+        :param command_id: Command ID
+        :param timeout: Maximum time to wait, in seconds
+        :return: The command's record, as returned by `get_command_status`, or None if the
+                 command is still unconfirmed after `timeout` seconds. Its 'state' is 'acked'
+                 if the node confirmed the command.
+        """
+        record = self.get_command_status(command_id)
+        if record is None or record["state"] in ("acked", "failed", "superseded", "sent"):
+            return record
+        # A BLPOP timeout of 0 would block forever
+        if self.r.blpop(COMMAND_DONE_KEY % command_id, timeout=max(timeout, 0.01)) is None:
+            return None
+        return self.get_command_status(command_id)
+
     def power_snap_relay(self, command):
         """
         Takes in a string value of 'on' or 'off'.
@@ -285,9 +619,9 @@ class NodeControl():
         has to be turn on before sending commands to individual SNAPs.
         """
 
-        self.r.hset("commands:node:%d"%self.node,"power_snap_relay_ctrl_trig","True")
-        self.r.hset("commands:node:%d"%self.node,"power_snap_relay_cmd",command)
+        cmd_id = self._send_command("power_snap_relay", command)
         print(("SNAP relay power is %s"%command))
+        return cmd_id
 
 
     def power_snap_0(self, command):
@@ -296,9 +630,9 @@ class NodeControl():
         Controls the power to SNAP 0.
         """
 
-        self.r.hset("commands:node:%d"%self.node,"power_snap_0_ctrl_trig","True")
-        self.r.hset("commands:node:%d"%self.node,"power_snap_0_cmd",command)
+        cmd_id = self._send_command("power_snap_0", command)
         print(("SNAP 0 power is %s"%command))
+        return cmd_id
 
 
     def power_snap_1(self, command):
@@ -307,9 +641,9 @@ class NodeControl():
         Controls the power to SNAP 1.
         """
 
-        self.r.hset("commands:node:%d"%self.node,"power_snap_1_ctrl_trig","True")
-        self.r.hset("commands:node:%d"%self.node,"power_snap_1_cmd",command)
+        cmd_id = self._send_command("power_snap_1", command)
         print(("SNAP 1 power is %s"%command))
+        return cmd_id
 
 
     def power_snap_2(self, command):
@@ -318,9 +652,9 @@ class NodeControl():
         Controls the power to SNAP 2.
         """
 
-        self.r.hset("commands:node:%d"%self.node,"power_snap_2_ctrl_trig","True")
-        self.r.hset("commands:node:%d"%self.node,"power_snap_2_cmd",command)
+        cmd_id = self._send_command("power_snap_2", command)
         print(("SNAP 2 power is %s"%command))
+        return cmd_id
 
 
     def power_snap_3(self, command):
@@ -329,9 +663,9 @@ class NodeControl():
         Controls the power to SNAP 3.
         """
 
-        self.r.hset("commands:node:%d"%self.node,"power_snap_3_ctrl_trig","True")
-        self.r.hset("commands:node:%d"%self.node,"power_snap_3_cmd",command)
+        cmd_id = self._send_command("power_snap_3", command)
         print(("SNAP 3 power is %s"%command))
+        return cmd_id
 
 
     def power_fem(self, command):
@@ -340,9 +674,9 @@ class NodeControl():
         Controls the power to FEM.
         """
 
-        self.r.hset("commands:node:%d"%self.node,"power_fem_ctrl_trig","True")
-        self.r.hset("commands:node:%d"%self.node,"power_fem_cmd",command)
+        cmd_id = self._send_command("power_fem", command)
         print(("FEM power is %s"%command))
+        return cmd_id
 
 
     def power_pam(self, command):
@@ -351,9 +685,9 @@ class NodeControl():
         Controls the power to PAM.
         """
 
-        self.r.hset("commands:node:%d"%self.node,"power_pam_ctrl_trig","True")
-        self.r.hset("commands:node:%d"%self.node,"power_pam_cmd",command)
+        cmd_id = self._send_command("power_pam", command)
         print(("PAM power is %s"%command))
+        return cmd_id
 
 
     def reset(self):
@@ -361,7 +695,8 @@ class NodeControl():
         Sends the reset command to Arduino which restarts the bootloader.
         """
 
-        self.r.hset("commands:node:%d"%self.node,"reset","True")
+        cmd_id = self._send_command("reset")
         print("Arduino is resetting...")
+        return cmd_id
 
 
@@ -0,0 +1,226 @@
+"""
+Status of many nodes at once, read with one redis pipeline and returned as numpy arrays.
+"""
+
+import time
+
+import numpy as np
+
+from .connection import get_redis
+from .nodeControl import get_valid_nodes
+from .schema import NODE_STATUS, WR_STATUS
+from .timestamps import parse_time
+from .watch import watch_nodes
+
+# Sensor fields, returned as float arrays with NaN where the value isn't available
+SENSOR_FIELDS = ('temp_top', 'temp_mid', 'temp_bot', 'temp_humid', 'humid')
+# Power fields, returned as bool arrays which are False where the state isn't available
+POWER_FIELDS = ('power_snap_relay', 'power_snap_0', 'power_snap_1', 'power_snap_2',
+                'power_snap_3', 'power_fem', 'power_pam')
+
+
+def _status_times(statuses):
+    """
+    Return the times the status hashes `statuses` were written, as integer microseconds since the epoch.
+
+    Hashes written by older receivers, without a `timestamp_us` field, have their local time
+    `timestamp` string parsed by numpy instead. Hashes with neither are the minimum int64, i.e. NaT.
+    """
+    times = np.full(len(statuses), np.iinfo(np.int64).min, dtype=np.int64)
+    for i, stats in enumerate(statuses):
+        us = stats.get('timestamp_us')
+        if us is not None:
+            times[i] = int(us)
+        elif 'timestamp' in stats:
+            try:
+                # numpy parses the ISO format timestamps itself, much faster than dateutil
+                local = np.datetime64(stats['timestamp'].replace(' ', 'T'), 'us').astype(np.int64)
+                times[i] = local - time.localtime(local // 1000000).tm_gmtoff * 1000000
+            except ValueError:
+                times[i] = int(parse_time(stats['timestamp']).timestamp() * 1000000)
+    return times
+
+
+def _local_datetimes(times):
+    """
+    Convert the integer microseconds since the epoch `times`, as returned by `_status_times`,
+    to datetime64[us] local times, as NodeControl returns naive local datetimes.
+    """
+    valid = times != np.iinfo(np.int64).min
+    offsets = {}
+    local = times.copy()
+    for i in np.flatnonzero(valid):
+        # UTC offsets only differ across daylight saving changes, so look up each hour once
+        hour = times[i] // 3600000000
+        if hour not in offsets:
+            offsets[hour] = time.localtime(hour * 3600).tm_gmtoff * 1000000
+        local[i] += offsets[hour]
+    return local.view('datetime64[us]')
+
+
+def _decode_statuses(nodes, statuses, schema):
+    """
+    Decode the raw status hashes `statuses` of `nodes` into the arrays returned by
+    `NodeControlArray.get_status` (for the NODE_STATUS schema) or `get_wr_status` (for WR_STATUS).
+    """
+    status = {
+        'node': np.array(nodes, dtype=int),
+        'exists': np.array([len(stats) > 0 for stats in statuses], dtype=bool),
+        'timestamp': _local_datetimes(_status_times(statuses)),
+    }
+    status.update(schema.decode_columns(statuses))
+    return status
+
+
+def _status_ages(statuses):
+    """
+    Return the ages, in seconds, of the raw status hashes `statuses`, NaN where unknown.
+    Only their timestamp fields are needed, e.g. as read by `HMGET key timestamp_us timestamp`.
+    """
+    times = _status_times(statuses)
+    ages = time.time() - times / 1e6
+    ages[times == np.iinfo(np.int64).min] = np.nan
+    return ages
+
+
+class NodeControlArray(object):
+    """
+    Read-only view of the status of many nodes. Where NodeControl makes one or more round trips
+    to redis per node, NodeControlArray fetches the status hashes of all its nodes in a single
+    pipeline and returns each field as an array with one entry per node, in the order of `nodes`.
+    """
+
+    def __init__(self, nodes, serverAddress="redishost", cache=None):
+        """
+        :param nodes: Iterable of node IDs, in the order results are returned
+        :param serverAddress: The hostname, or dotted quad IP address, of the machine running the node
+                              control and monitoring redis server
+        :type serverAddress: String
+        :param cache: If not None, StatusCache to read the status hashes through
+        """
+        self.nodes = np.array(list(nodes), dtype=int)
+        self.serverAddress = serverAddress
+        self.r = get_redis(serverAddress)
+        self.cache = cache
+
+    @classmethod
+    def from_valid_nodes(cls, serverAddress="redishost", active_within=None, cache=None):
+        """
+        Return a NodeControlArray of all the nodes which currently have status data in redis,
+        as listed by `get_valid_nodes`, sorted by node ID.
+
+        :param active_within: If not None, only include nodes which have reported status in the
+                              last `active_within` seconds
+        :param cache: If not None, StatusCache to read the status hashes through
+        """
+        return cls(sorted(get_valid_nodes(serverAddress, active_within)), serverAddress, cache)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _get_raw_node_statuses(self):
+        """
+        Return the raw content of every node's status hash, fetched with one pipeline.
+
+        :return: List with a dictionary of decoded field -> value for each node. Dictionaries
+                 of nodes with no status hash are empty.
+        """
+        if self.cache is not None:
+            return self.cache.get_many(["status:node:%d" % node for node in self.nodes])
+        pipe = self.r.pipeline(transaction=False)
+        for node in self.nodes:
+            pipe.hgetall("status:node:%d" % node)
+        return [{key.decode(): val.decode() for key, val in stats.items()} for stats in pipe.execute()]
+
+    def get_status(self):
+        """
+        Get the current status of every node.
+
+        Returns a dictionary of numpy arrays, each with one entry per node:
+            'node'          (int)            : Node ID
+            'exists'        (bool)           : True if the node has a status hash in redis
+            'timestamp'     (datetime64[us]) : Time the node's status was last updated, NaT if unknown
+            'temp_top', 'temp_mid', 'temp_bot', 'temp_humid', 'humid'
+                            (float)          : Sensor values, as described in NodeControl.get_sensors.
+                                               NaN if not available.
+            'cpu_uptime_ms' (float)          : Uptime of the node control module, in milliseconds. NaN if unknown.
+            'power_snap_relay', 'power_snap_0', 'power_snap_1', 'power_snap_2', 'power_snap_3',
+            'power_fem', 'power_pam'
+                            (bool)           : Power states, as described in NodeControl.get_power_status.
+                                               False if not available.
+            'ip', 'mac'     (str)            : Addresses of the node control module. Empty if unknown.
+        """
+        return _decode_statuses(self.nodes, self._get_raw_node_statuses(), NODE_STATUS)
+
+    def get_sensors(self):
+        """
+        Get the current sensor values of every node.
+
+        :return: Tuple `(timestamps, sensors)`, where `timestamps` is an array of the times the nodes'
+                 status was last updated, and `sensors` is a dictionary of arrays, as returned by
+                 `get_status`, for the fields returned by NodeControl.get_sensors
+        """
+        status = self.get_status()
+        return status['timestamp'], {field: status[field] for field in SENSOR_FIELDS + ('cpu_uptime_ms', 'ip', 'mac')}
+
+    def get_power_status(self):
+        """
+        Get the current power states of every node.
+
+        :return: Tuple `(timestamps, statii)`, where `timestamps` is an array of the times the nodes'
+                 status was last updated, and `statii` is a dictionary of bool arrays, as returned by
+                 `get_status`, for the fields returned by NodeControl.get_power_status
+        """
+        status = self.get_status()
+        return status['timestamp'], {field: status[field] for field in POWER_FIELDS}
+
+    def get_wr_status(self):
+        """
+        Get the current status of every node's White Rabbit endpoint.
+
+        Returns a dictionary of numpy arrays, each with one entry per node: 'node', 'exists' (True
+        if the endpoint has a status hash in redis), 'timestamp' (datetime64[us], NaT if unknown),
+        and the fields described in NodeControl.get_wr_status. Numeric fields are float arrays,
+        NaN if not available, link and lock states are bool arrays, and the rest are object arrays,
+        None if not available.
+        """
+        keys = ["status:wr:heraNode%dwr" % node for node in self.nodes]
+        if self.cache is not None:
+            statuses = self.cache.get_many(keys)
+        else:
+            pipe = self.r.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            statuses = [{key.decode(): val.decode() for key, val in stats.items()} for stats in pipe.execute()]
+        return _decode_statuses(self.nodes, statuses, WR_STATUS)
+
+    def age_seconds(self):
+        """
+        Get the time since each node's status was last updated, reading only the timestamps
+        rather than the whole status hashes.
+
+        :return: Float array of the ages, in seconds, NaN for nodes with no status
+        """
+        if self.cache is not None:
+            statuses = self._get_raw_node_statuses()
+        else:
+            pipe = self.r.pipeline(transaction=False)
+            for node in self.nodes:
+                pipe.hmget("status:node:%d" % node, "timestamp_us", "timestamp")
+            statuses = [{k: v.decode() for k, v in zip(('timestamp_us', 'timestamp'), values) if v is not None}
+                        for values in pipe.execute()]
+        return _status_ages(statuses)
+
+    def watch(self, changes_only=False, fields=None, timeout=None):
+        """
+        Yield the status of each node as the receiver publishes it. Only this array's nodes
+        are subscribed to, so other nodes' updates never reach the client.
+
+        :param changes_only: If True, only yield statuses which differ from the node's previous one,
+                             ignoring the timestamp and uptime
+        :param fields: If not None, only yield statuses in which one of these fields changed
+        :param timeout: If not None, stop after `timeout` seconds without an update
+        :return: Generator of tuples `(node, timestamp, status)`, with `timestamp` and `status` as
+                 yielded by NodeControl.watch
+        """
+        return watch_nodes(self.r, self.nodes.tolist(), changes_only, fields, timeout)
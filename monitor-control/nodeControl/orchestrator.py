@@ -0,0 +1,213 @@
+"""
+Array-wide power sequencing. Works out the commands needed to bring a set of nodes to a
+target power state and sends them in waves of nodes, confirming each step before moving on.
+"""
+
+import sys
+import time
+
+from .nodeControl import NodeControl, str2bool, queue_commands, COMMAND_STATUS_KEY
+from .nodeControlArray import NodeControlArray
+from .schema import SNAP_CONTROLS, POWER_ON_ORDER, POWER_OFF_ORDER
+
+# Time, in seconds, to wait for a node to confirm a command. The command checker waits 5, 10 and
+# 20 seconds for each of its three attempts, and up to 2 seconds of throttle before each retry,
+# so this leaves time for it to report the command failed before the sequencer gives up on it.
+STEP_TIMEOUT_SEC = 60.0
+
+
+def plan_commands(current, target):
+    """
+    Work out the commands which take a node from its current power state to the target state.
+    Controls missing from `target` are left as they are, except that turning on a SNAP
+    implies turning on the SNAP relay, and turning off the SNAP relay implies turning off the SNAPs.
+
+    :param current: Dictionary of power control name -> bool, as returned by NodeControl.get_power_status
+    :param target: Dictionary of power control name -> bool
+    :return: List of (control, 'on' | 'off') tuples, in the order they must be sent
+    """
+    final = dict(current)
+    final.update(target)
+    if target.get('power_snap_relay') is False:
+        if any(target.get(snap) for snap in SNAP_CONTROLS):
+            raise ValueError("Can't turn SNAPs on with the SNAP relay off")
+        for snap in SNAP_CONTROLS:
+            final[snap] = False
+    elif any(target.get(snap) for snap in SNAP_CONTROLS):
+        final['power_snap_relay'] = True
+
+    commands = []
+    for control in POWER_OFF_ORDER:
+        if control in final and not final[control] and current.get(control, True):
+            commands.append((control, 'off'))
+    for control in POWER_ON_ORDER:
+        if final.get(control) and not current.get(control, False):
+            commands.append((control, 'on'))
+    return commands
+
+
+class NodeProgress(object):
+    """
+    Progress of one node through its planned commands.
+    """
+
+    __slots__ = ('node', 'commands', 'step', 'step_start', 'command_id', 'failed', 'done_time')
+
+    def __init__(self, node, commands):
+        self.node = node
+        self.commands = commands
+        self.step = 0
+        self.step_start = None
+        self.command_id = None
+        self.failed = False
+        self.done_time = None
+
+    @property
+    def done(self):
+        return self.failed or self.step >= len(self.commands)
+
+
+class PowerSequencer(object):
+    """
+    Brings a set of nodes to a target power state. Nodes are handled in waves of at most
+    `max_concurrent` nodes, limiting how many nodes are switching (and drawing inrush current)
+    at once. Each node's commands are sent in a safe order, and the next one is sent as soon as
+    the command checker reports the previous one confirmed by the node's status. The nodes'
+    reported power states are also checked directly, in case the command checker doesn't
+    track commands.
+    """
+
+    def __init__(self, nodes, target, serverAddress="redishost", max_concurrent=10,
+                 step_timeout=STEP_TIMEOUT_SEC, poll_sec=0.5, report=None):
+        """
+        :param nodes: Iterable of node IDs
+        :param target: Dictionary of power control name (e.g. 'power_pam') -> bool
+        :param serverAddress: The hostname, or dotted quad IP address, of the machine running the node
+                              control and monitoring redis server
+        :param max_concurrent: Maximum number of nodes in a wave
+        :param step_timeout: Time, in seconds, to wait for a node to confirm a command before giving up on it,
+                             for command checkers which don't track commands. The node fails as soon as
+                             the command checker gives up on the command, or it's superseded by another.
+        :param poll_sec: Time, in seconds, between checks of the nodes' power states
+        :param report: Function called with a progress message string. Defaults to printing to stderr.
+        """
+        self.nodes = sorted(nodes)
+        self.target = target
+        self.serverAddress = serverAddress
+        self.max_concurrent = max_concurrent
+        self.step_timeout = step_timeout
+        self.poll_sec = poll_sec
+        self.report = report or (lambda msg: print(msg, file=sys.stderr))
+        self.controls = {node: NodeControl(node, serverAddress) for node in self.nodes}
+        self.progress = {}
+        # Nodes with no status in redis
+        self.missing = []
+
+    def plan(self):
+        """
+        Read the current power state of every node and plan its commands.
+
+        :return: Dictionary of node ID -> list of (control, 'on' | 'off') commands
+        """
+        self.progress = {}
+        self.missing = []
+        status = NodeControlArray(self.nodes, self.serverAddress).get_status()
+        for i, node in enumerate(status['node']):
+            node = int(node)
+            if not status['exists'][i]:
+                self.missing.append(node)
+                continue
+            current = {control: bool(status[control][i]) for control in POWER_ON_ORDER}
+            self.progress[node] = NodeProgress(node, plan_commands(current, self.target))
+        return {node: p.commands for node, p in self.progress.items()}
+
+    def _read_progress(self, active, controls):
+        """
+        Read the power state of `controls` and the state of the current command
+        for each of the NodeProgress instances `active`, with one pipeline.
+
+        :return: List with a tuple `(power, state)` for each node, where `power` is a dictionary of
+                 control -> bool and `state` is the command's state, or None if it has no record
+        """
+        pipe = self.controls[active[0].node].r.pipeline(transaction=False)
+        for p in active:
+            pipe.hmget("status:node:%d" % p.node, controls)
+            pipe.hget(COMMAND_STATUS_KEY % p.command_id, "state")
+        results = pipe.execute()
+        return [({c: v is not None and str2bool(v.decode()) for c, v in zip(controls, vals)},
+                 None if state is None else state.decode())
+                for vals, state in zip(results[::2], results[1::2])]
+
+    def _send_next(self, ready):
+        """
+        Send the next command of each of the NodeProgress instances `ready`, all in one round trip.
+        """
+        if not ready:
+            return
+        ids = queue_commands(self.controls[ready[0].node].r, {p.node: [p.commands[p.step]] for p in ready})
+        now = time.time()
+        for p in ready:
+            p.command_id = ids[p.node][0]
+            p.step_start = now
+
+    def run_wave(self, wave):
+        """
+        Take the nodes in the list of NodeProgress instances `wave` through their commands.
+        """
+        self._send_next([p for p in wave if not p.done])
+        while True:
+            active = [p for p in wave if not p.done]
+            if not active:
+                return
+            time.sleep(self.poll_sec)
+            states = self._read_progress(active, list(POWER_ON_ORDER))
+            now = time.time()
+            ready = []
+            for p, (power, state) in zip(active, states):
+                control, command = p.commands[p.step]
+                if state == 'acked' or power[control] == (command == 'on'):
+                    p.step += 1
+                    if p.done:
+                        p.done_time = now
+                        self.report("Node %d done" % p.node)
+                    else:
+                        ready.append(p)
+                elif state == 'failed':
+                    p.failed = True
+                    p.done_time = now
+                    self.report("Node %d failed: %s %s not confirmed after retries" % (p.node, control, command))
+                elif state == 'superseded':
+                    p.failed = True
+                    p.done_time = now
+                    self.report("Node %d failed: %s %s superseded by another command" % (p.node, control, command))
+                elif now - p.step_start > self.step_timeout:
+                    p.failed = True
+                    p.done_time = now
+                    self.report("Node %d failed: %s %s not confirmed after %.0f s" % (p.node, control, command, self.step_timeout))
+            self._send_next(ready)
+
+    def run(self):
+        """
+        Plan and send the commands for all nodes, wave by wave, reporting progress as it goes.
+
+        :return: Tuple of lists `(succeeded, failed, missing)` of node IDs
+        """
+        if not self.progress:
+            self.plan()
+        for node in self.missing:
+            self.report("Node %d has no status in redis, skipping" % node)
+        todo = [p for p in self.progress.values() if p.commands]
+        waves = [todo[i:i + self.max_concurrent] for i in range(0, len(todo), self.max_concurrent)]
+        self.report("%d nodes need %d commands, in %d waves" %
+                    (len(todo), sum(len(p.commands) for p in todo), len(waves)))
+        start = time.time()
+        for i, wave in enumerate(waves):
+            self.run_wave(wave)
+            elapsed = time.time() - start
+            eta = elapsed / (i + 1) * (len(waves) - i - 1)
+            ndone = sum(len(w) for w in waves[:i + 1])
+            self.report("Wave %d/%d done: %d/%d nodes in %.0f s, ETA %.0f s" %
+                        (i + 1, len(waves), ndone, len(todo), elapsed, eta))
+        failed = sorted(p.node for p in self.progress.values() if p.failed)
+        succeeded = sorted(node for node, p in self.progress.items() if not p.failed)
+        return succeeded, failed, list(self.missing)
@@ -0,0 +1,175 @@
+"""
+Client for the node registry maintained by the receiver: a `nodes:registry` hash of each
+node's addresses and a `nodes:last_seen` sorted set of the time each node last reported.
+"""
+
+import json
+import time
+
+from .connection import get_redis
+from .timestamps import status_epoch
+
+# Hash of node ID -> JSON {"ip": ..., "mac": ...}
+REGISTRY_KEY = "nodes:registry"
+# Sorted set of node IDs, scored by the time, in seconds since the epoch, they last reported status
+LAST_SEEN_KEY = "nodes:last_seen"
+# Counter incremented by the receiver whenever REGISTRY_KEY changes
+SERIAL_KEY = "nodes:registry:serial"
+
+
+class NodeRegistry(object):
+    """
+    In-memory copy of the node registry. `load` reads the whole registry in one round trip;
+    `refresh` then only fetches last seen times which have changed since, and reloads the
+    addresses only when the receiver has changed them.
+
+    If the registry is empty, e.g. because the receiver predates it, the nodes are found by
+    scanning for status:node:x keys instead, on every `load` and `refresh`.
+    """
+
+    def __init__(self, serverAddress="redishost", redis_conn=None):
+        """
+        :param serverAddress: The hostname, or dotted quad IP address, of the machine running the node
+                              control and monitoring redis server
+        :type serverAddress: String
+        :param redis_conn: redis.StrictRedis instance to use instead of connecting to `serverAddress`
+        """
+        self.r = redis_conn if redis_conn is not None else get_redis(serverAddress)
+        # Dictionary of node ID -> {"ip": ..., "mac": ...}
+        self.addresses = {}
+        # Dictionary of node ID -> time last seen, in seconds since the epoch
+        self.last_seen = {}
+        self.serial = None
+        # Latest last seen time read, so refreshes only fetch newer ones
+        self.latest = 0
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def __iter__(self):
+        return iter(sorted(self.last_seen.keys()))
+
+    def __contains__(self, node):
+        return node in self.last_seen
+
+    def ip(self, node):
+        """
+        Return the IP address of `node`, or None if it isn't known.
+        """
+        return self.addresses.get(node, {}).get("ip")
+
+    def mac(self, node):
+        """
+        Return the MAC address of `node`, or None if it isn't known.
+        """
+        return self.addresses.get(node, {}).get("mac")
+
+    def _set_addresses(self, raw):
+        addresses = {}
+        for node, entry in raw.items():
+            try:
+                addresses[int(node)] = json.loads(entry)
+            except ValueError:
+                continue
+        self.addresses = addresses
+
+    def _set_last_seen(self, pairs):
+        for node, t in pairs:
+            try:
+                self.last_seen[int(node)] = t
+            except ValueError:
+                continue
+            self.latest = max(self.latest, t)
+
+    @staticmethod
+    def _queue_scan(pipe, keys):
+        for key in keys:
+            pipe.hmget(key, "node_ID", "ip", "mac", "timestamp_us", "timestamp")
+
+    def _apply_scan(self, results):
+        self.addresses = {}
+        self.last_seen = {}
+        for node_id, ip, mac, timestamp_us, timestamp in results:
+            try:
+                node = int(node_id)
+            except (TypeError, ValueError):
+                continue
+            self.addresses[node] = {"ip": None if ip is None else ip.decode(),
+                                    "mac": None if mac is None else mac.decode()}
+            stats = {k: v.decode() for k, v in (("timestamp_us", timestamp_us), ("timestamp", timestamp))
+                     if v is not None}
+            self.last_seen[node] = status_epoch(stats) or 0
+
+    def _scan_status(self):
+        """
+        Fill the registry from the status:node:x hashes, when there is no registry in redis.
+        """
+        keys = list(self.r.scan_iter("status:node:*"))
+        pipe = self.r.pipeline(transaction=False)
+        self._queue_scan(pipe, keys)
+        self._apply_scan(pipe.execute())
+
+    @staticmethod
+    def _queue_load(pipe):
+        pipe.get(SERIAL_KEY)
+        pipe.hgetall(REGISTRY_KEY)
+        pipe.zrange(LAST_SEEN_KEY, 0, -1, withscores=True)
+
+    def _apply_load(self, results):
+        """
+        Fill the registry from the results of the commands queued by `_queue_load`.
+
+        :return: False if there is no registry in redis, so the status hashes must be scanned instead
+        """
+        self.serial, raw, last_seen = results
+        self.latest = 0
+        if not raw:
+            return False
+        self._set_addresses(raw)
+        self.last_seen = {}
+        self._set_last_seen(last_seen)
+        return True
+
+    def load(self):
+        """
+        Read the whole registry with one pipeline.
+
+        :return: self
+        """
+        pipe = self.r.pipeline(transaction=False)
+        self._queue_load(pipe)
+        if not self._apply_load(pipe.execute()):
+            self._scan_status()
+        return self
+
+    def refresh(self):
+        """
+        Apply changes to the registry since the last `load` or `refresh`, with one pipeline
+        (two if node addresses have changed).
+
+        :return: Set of node IDs which were added or whose addresses changed
+        """
+        if self.serial is None:
+            # No registry when last read, so scan again
+            old = self.addresses
+            self.load()
+            return set(node for node, entry in self.addresses.items() if old.get(node) != entry)
+        pipe = self.r.pipeline(transaction=False)
+        pipe.get(SERIAL_KEY)
+        pipe.zrangebyscore(LAST_SEEN_KEY, self.latest, "+inf", withscores=True)
+        serial, last_seen = pipe.execute()
+        new_nodes = set(int(node) for node, _ in last_seen) - set(self.last_seen.keys())
+        self._set_last_seen(last_seen)
+        if serial == self.serial and not new_nodes:
+            return set()
+        self.serial = serial
+        old = self.addresses
+        self._set_addresses(self.r.hgetall(REGISTRY_KEY))
+        return set(node for node, entry in self.addresses.items() if old.get(node) != entry)
+
+    def active(self, within):
+        """
+        Return a sorted list of the nodes which reported status in the last `within` seconds.
+        """
+        cutoff = time.time() - within
+        return sorted(node for node, t in self.last_seen.items() if t >= cutoff)
@@ -0,0 +1,226 @@
+"""
+Declarative schemas of the node and White Rabbit status hashes.
+
+Each schema is a tuple of `(field, conversion, column dtype)` specs, compiled once at import
+into a dictionary decoder, a record class and a columnar decoder. NodeControl returns plain
+dictionaries. Records are read-only mappings which keep the stored strings and only convert a
+field the first time it's read, for callers which only look at a few fields. NodeControlArray
+decodes the same fields into one numpy array per field for many nodes at once.
+"""
+
+import collections.abc
+import json
+
+import numpy as np
+
+from .timestamps import parse_time
+
+
+def str2bool(x):
+    """
+    Convert the string `x` to a boolean.
+    :return: bool(x == '1')
+    """
+    return x == "1"
+
+
+def _wr_gw_date(x):
+    # The gateware date has a 2 digit year. Hack!
+    return parse_time('20' + x)
+
+
+# Values of fields which are missing or fail to convert, by column dtype. Records always use None.
+MISSING_VALUES = {float: np.nan, bool: False, str: '', object: None}
+
+SENSOR_SCHEMA = (
+    ('temp_top', float, float),
+    ('temp_mid', float, float),
+    ('temp_bot', float, float),
+    ('temp_humid', float, float),
+    ('humid', float, float),
+    ('cpu_uptime_ms', int, float),
+    ('ip', str, str),
+    ('mac', str, str),
+)
+
+SNAP_CONTROLS = ('power_snap_0', 'power_snap_1', 'power_snap_2', 'power_snap_3')
+# Power controls in the safe order to turn them on: the SNAP relay before the SNAPs
+POWER_ON_ORDER = ('power_snap_relay',) + SNAP_CONTROLS + ('power_fem', 'power_pam')
+# Safe order to turn them off: the SNAPs before the SNAP relay
+POWER_OFF_ORDER = tuple(reversed(POWER_ON_ORDER))
+
+POWER_SCHEMA = tuple((field, str2bool, bool) for field in (
+    'power_snap_relay', 'power_snap_0', 'power_snap_1', 'power_snap_2', 'power_snap_3',
+    'power_fem', 'power_pam'))
+
+# Fields of the status:wr:heraNode<node>wr hashes, other than those of each WR-LEN port
+WR_BOARD_SCHEMA = (
+    ('board_info_str', str, object),
+    ('aliases', json.loads, object),
+    ('ip', str, object),
+    ('mode', str, object),
+    ('serial', str, object),
+    ('temp', float, float),
+    ('sw_build_date', parse_time, object),
+    ('wr_gw_date', _wr_gw_date, object),
+    ('wr_gw_version', str, object),
+    ('wr_gw_id', str, object),
+    ('wr_build', str, object),
+    ('wr_fru_custom', str, object),
+    ('wr_fru_device', str, object),
+    ('wr_fru_fid', parse_time, object),
+    ('wr_fru_partnum', str, object),
+    ('wr_fru_serial', str, object),
+    ('wr_fru_vendor', str, object),
+)
+
+# Fields of each WR-LEN port, stored prefixed with wr0 and wr1
+WR_PORT_SCHEMA = (
+    ('_ad', int, float),
+    ('_asym', int, float),
+    ('_aux', int, float),
+    ('_cko', int, float),
+    ('_crtt', int, float),
+    ('_dms', int, float),
+    ('_drxm', int, float),
+    ('_drxs', int, float),
+    ('_dtxm', int, float),
+    ('_dtxs', int, float),
+    ('_hd', int, float),
+    ('_lnk', bool, bool),
+    ('_lock', bool, bool),
+    ('_md', int, float),
+    ('_mu', int, float),
+    ('_nsec', int, float),
+    ('_rx', int, float),
+    ('_setp', int, float),
+    ('_ss', str, object),
+    ('_sv', int, float),
+    ('_syncs', str, object),
+    ('_tx', int, float),
+    ('_ucnt', int, float),
+    ('_sec', int, float),
+)
+
+WR_SCHEMA = WR_BOARD_SCHEMA + tuple(('wr%d%s' % (port, suffix), conv, dtype)
+                                    for suffix, conv, dtype in WR_PORT_SCHEMA for port in range(2))
+
+
+def _convert(conv, raw, missing=None):
+    if raw is None:
+        return missing
+    try:
+        return conv(raw)
+    except (TypeError, ValueError, OverflowError):
+        return missing
+
+
+class StatusRecord(collections.abc.Mapping):
+    """
+    Base class of the records compiled from a schema. A record is a read-only mapping of field
+    -> converted value, whose fields can also be read as attributes. Each field is converted
+    the first time it's read and stored in its slot. Fields which are missing or fail to convert
+    are None.
+    """
+
+    __slots__ = ('_raw',)
+    # Set on each compiled record class
+    _fields = ()
+    _index = {}
+    _converters = ()
+
+    def __init__(self, stats):
+        """
+        :param stats: Dictionary of decoded hash field -> stored string
+        """
+        self._raw = tuple(map(stats.get, self._fields))
+
+    def __getattr__(self, field):
+        # Only called while the field's slot is empty, i.e. the first time it's read
+        try:
+            i = self._index[field]
+        except KeyError:
+            raise AttributeError(field)
+        value = _convert(self._converters[i], self._raw[i])
+        setattr(self, field, value)
+        return value
+
+    def __getitem__(self, field):
+        if field not in self._index:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __contains__(self, field):
+        return field in self._index
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % item for item in self.items()))
+
+
+class Schema(object):
+    """
+    A status hash schema compiled from its field specs.
+    """
+
+    def __init__(self, name, specs):
+        """
+        :param name: Name of the record class
+        :param specs: Tuple of `(field, conversion, column dtype)` tuples
+        """
+        self.specs = specs
+        self.fields = tuple(field for field, _, _ in specs)
+        self.conversions = tuple((field, conv) for field, conv, _ in specs)
+        self.record = type(name, (StatusRecord,), {
+            '__slots__': self.fields,
+            '_fields': self.fields,
+            '_index': {field: i for i, field in enumerate(self.fields)},
+            '_converters': tuple(conv for _, conv, _ in specs),
+        })
+
+    def decode(self, stats):
+        """
+        Decode the status hash `stats`, a dictionary of field -> stored string.
+
+        :return: Dictionary of field -> converted value, None for fields which are missing or fail to convert
+        """
+        return {field: _convert(conv, stats.get(field)) for field, conv in self.conversions}
+
+    def decode_record(self, stats):
+        """
+        Return the record of the status hash `stats`, a dictionary of field -> stored string,
+        whose fields are converted when first read.
+        """
+        return self.record(stats)
+
+    def decode_columns(self, statuses):
+        """
+        Decode many status hashes into columns.
+
+        :param statuses: List of dictionaries of decoded hash field -> stored string
+        :return: Dictionary of field -> numpy array with one entry per status, of the field's column
+                 dtype. Missing values are NaN in float columns, False in bool columns, empty in
+                 str columns and None in object columns.
+        """
+        columns = {}
+        for field, conv, dtype in self.specs:
+            missing = MISSING_VALUES[dtype]
+            values = [_convert(conv, stats.get(field), missing) for stats in statuses]
+            if dtype is object:
+                # Filled element by element, so that lists (e.g. aliases) stay single entries
+                columns[field] = np.empty(len(values), dtype=object)
+                for i, value in enumerate(values):
+                    columns[field][i] = value
+            else:
+                columns[field] = np.array(values, dtype=dtype)
+        return columns
+
+
+SENSORS = Schema('SensorStatus', SENSOR_SCHEMA)
+NODE_STATUS = Schema('NodeStatus', SENSOR_SCHEMA + POWER_SCHEMA)
+WR_STATUS = Schema('WrStatus', WR_SCHEMA)
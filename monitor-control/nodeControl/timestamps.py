@@ -0,0 +1,62 @@
+"""
+Decoding of the times status hashes were written.
+
+The receiver stores each status's arrival time twice: `timestamp_us`, integer microseconds since
+the epoch, and `timestamp`, the local time as a string, kept for older clients. Readers use
+`timestamp_us` when it's there and only parse the string for hashes written by older receivers.
+"""
+
+import datetime
+import functools
+
+import dateutil.parser
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_time(s):
+    """
+    Parse the date and time string `s`, with `datetime.fromisoformat` if it's in ISO format,
+    as written by the receiver and the WR-LEN monitor, and dateutil otherwise.
+    Results are cached, since the same strings (e.g. build dates) are read over and over.
+
+    :return: datetime
+    """
+    try:
+        return datetime.datetime.fromisoformat(s)
+    except ValueError:
+        return dateutil.parser.parse(s)
+
+
+def status_epoch(stats):
+    """
+    Return the time the status hash `stats` was written, in seconds since the epoch.
+
+    :param stats: Dictionary of decoded status hash fields
+    :return: Float, or None if the hash has no valid timestamp
+    """
+    us = stats.get("timestamp_us")
+    if us is not None:
+        try:
+            return int(us) / 1e6
+        except ValueError:
+            pass
+    try:
+        return parse_time(stats["timestamp"]).timestamp()
+    except (KeyError, TypeError, ValueError, OverflowError):
+        return None
+
+
+def status_time(stats):
+    """
+    Return the time the status hash `stats` was written, as a naive local datetime.
+
+    :param stats: Dictionary of decoded status hash fields
+    :raises KeyError: If the hash has no timestamp
+    """
+    us = stats.get("timestamp_us")
+    if us is not None:
+        try:
+            return datetime.datetime.fromtimestamp(int(us) / 1e6)
+        except ValueError:
+            pass
+    return parse_time(stats["timestamp"])
@@ -0,0 +1,87 @@
+"""
+Status updates pushed by the receiver over redis pub/sub, used by NodeControl.watch and
+NodeControlArray.watch.
+"""
+
+import json
+import time
+
+from .timestamps import status_time
+
+# Channel the receiver publishes every status of a node to
+UPDATES_CHANNEL = "status:updates:node:%d"
+# Channel the receiver publishes a node's status to when it differs from the last one
+CHANGES_CHANNEL = "status:changes:node:%d"
+
+SENSOR_FIELDS = ("temp_top", "temp_mid", "temp_bot", "temp_humid", "humid")
+POWER_FIELDS = ("power_snap_relay", "power_snap_0", "power_snap_1", "power_snap_2", "power_snap_3",
+                "power_fem", "power_pam")
+
+
+def _to_float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def decode_update(payload):
+    """
+    Decode a message published by the receiver.
+
+    :return: Tuple `(node, timestamp, status)`, where `timestamp` is a datetime, and `status`
+             is a dictionary of sensor values (floats, None if not available), power states (bools),
+             'cpu_uptime_ms' (int), 'ip' and 'mac' (strings) and, for messages from the changes
+             channel, 'changed', the list of fields which changed.
+    """
+    message = json.loads(payload)
+    status = {}
+    for field in SENSOR_FIELDS:
+        status[field] = _to_float(message.get(field))
+    for field in POWER_FIELDS:
+        status[field] = str(message.get(field)) in ("1", "True")
+    status["cpu_uptime_ms"] = int(message.get("cpu_uptime_ms", 0))
+    status["ip"] = message.get("ip")
+    status["mac"] = message.get("mac")
+    if "changed" in message:
+        status["changed"] = message["changed"]
+    return message["node"], status_time(message), status
+
+
+def watch_nodes(redis_conn, nodes, changes_only=False, fields=None, timeout=None):
+    """
+    Yield the status updates of `nodes` as the receiver publishes them.
+
+    Only the channels of `nodes` are subscribed to, so updates from other nodes never reach
+    the client. With `changes_only`, only statuses which differ from the node's previous one
+    are sent.
+
+    :param redis_conn: redis.StrictRedis instance
+    :param nodes: Iterable of node IDs
+    :param changes_only: If True, only yield statuses in which a field other than the timestamp
+                         and uptime changed
+    :param fields: If not None, only yield statuses in which one of these fields changed. Implies `changes_only`.
+    :param timeout: If not None, stop after `timeout` seconds without an update
+    :return: Generator of `(node, timestamp, status)` tuples, as returned by `decode_update`
+    """
+    channel = CHANGES_CHANNEL if changes_only or fields is not None else UPDATES_CHANNEL
+    fields = None if fields is None else set(fields)
+    pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*[channel % node for node in nodes])
+    try:
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = 1.0 if deadline is None else deadline - time.time()
+            if wait <= 0:
+                return
+            message = pubsub.get_message(timeout=wait)
+            if message is None or message["type"] != "message":
+                continue
+            node, timestamp, status = decode_update(message["data"])
+            if fields is not None and fields.isdisjoint(status.get("changed", ())):
+                continue
+            if timeout is not None:
+                deadline = time.time() + timeout
+            yield node, timestamp, status
+    finally:
+        pubsub.close()
@@ -0,0 +1,72 @@
+import sys
+import argparse
+import nodeControl
+
+parser = argparse.ArgumentParser(description = 'Bring many nodes to a target power state, a wave of nodes at a time',
+			formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('nodes', action = 'store', type = int, nargs = '*',
+			help = 'Node IDs to sequence. Use --all for every node with a status in redis')
+parser.add_argument('--all', dest = 'all_nodes', action = 'store_true', default = False,
+			help = 'Sequence every node with a status in redis')
+parser.add_argument('--off', dest = 'state', action = 'store_const', const = False, default = True,
+			help = 'Turn the selected things off rather than on')
+parser.add_argument('-r', dest = 'snapRelay', action = 'store_true', default = False,
+			help = 'Use this flag to switch the snapRelay')
+parser.add_argument('-s', dest = 'snaps', action = 'store_true', default = False,
+			help = 'Use this flag to switch all the snaps')
+parser.add_argument('-s0', dest = 'snap0', action = 'store_true', default = False,
+			help = 'Use this flag to switch SNAP 0')
+parser.add_argument('-s1', dest = 'snap1', action = 'store_true', default = False,
+			help = 'Use this flag to switch SNAP 1')
+parser.add_argument('-s2', dest = 'snap2', action = 'store_true', default = False,
+			help = 'Use this flag to switch SNAP 2')
+parser.add_argument('-s3', dest = 'snap3', action = 'store_true', default = False,
+			help = 'Use this flag to switch SNAP 3')
+parser.add_argument('-p', dest = 'pam', action = 'store_true', default = False,
+			help = 'Use this flag to switch the PAM')
+parser.add_argument('-f', dest = 'fem', action = 'store_true', default = False,
+			help = 'Use this flag to switch the FEM')
+parser.add_argument('--max-concurrent', dest = 'max_concurrent', type = int, default = 10,
+			help = 'Maximum number of nodes switching at once')
+parser.add_argument('--timeout', type = float, default = nodeControl.orchestrator.STEP_TIMEOUT_SEC,
+			help = 'Time, in seconds, to wait for a node to confirm each command, longer than the command '
+			       'checker takes to retry it')
+parser.add_argument('--redishost', type = str, default = 'redishost',
+			help = 'IP or hostname string of host running the monitor redis server')
+parser.add_argument('--dry-run', dest = 'dry_run', action = 'store_true', default = False,
+			help = 'Print the planned commands without sending them')
+args = parser.parse_args()
+
+target = {}
+if args.snapRelay:
+    target['power_snap_relay'] = args.state
+for i, flag in enumerate([args.snap0, args.snap1, args.snap2, args.snap3]):
+    if flag or args.snaps:
+        target['power_snap_%d' % i] = args.state
+if args.fem:
+    target['power_fem'] = args.state
+if args.pam:
+    target['power_pam'] = args.state
+if not target:
+    parser.error('Nothing to switch; use -r, -s, -s0..-s3, -f or -p')
+
+nodes = args.nodes
+if args.all_nodes:
+    nodes = nodeControl.get_valid_nodes(args.redishost)
+if not nodes:
+    parser.error('No nodes given')
+
+sequencer = nodeControl.PowerSequencer(nodes, target, serverAddress = args.redishost,
+                                       max_concurrent = args.max_concurrent, step_timeout = args.timeout)
+plan = sequencer.plan()
+if args.dry_run:
+    for node, commands in sorted(plan.items()):
+        print("Node %d: %s" % (node, ', '.join('%s %s' % c for c in commands) or 'nothing to do'))
+    for node in sequencer.missing:
+        print("Node %d: no status in redis" % node)
+    sys.exit(0)
+
+succeeded, failed, missing = sequencer.run()
+print("%d nodes succeeded, %d failed %s, %d missing %s" % (len(succeeded), len(failed), failed, len(missing), missing))
+if failed or missing:
+    sys.exit(1)
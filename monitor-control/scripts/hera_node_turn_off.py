@@ -31,38 +31,16 @@ args = parser.parse_args()
 
 # Instantiate a udpSenderClass object to send commands to Arduino
 n = nodeControl.NodeControl(int(args.node))
-if args.snaps:
-    n.power_snap_0('off')
-    n.power_snap_1('off')
-    n.power_snap_2('off')
-    n.power_snap_3('off')
-    n.power_snap_relay('off')
-
-if args.snapRelay:
-    n.power_snap_0('off')
-    n.power_snap_1('off')
-    n.power_snap_2('off')
-    n.power_snap_3('off')
-    n.power_snap_relay('off')
-
-if args.snap0:
-    n.power_snap_0('off')
-
-if args.snap1:
-    n.power_snap_1('off')
-
-if args.snap2:
-    n.power_snap_2('off')
-
-if args.snap3:
-    n.power_snap_3('off')
-
-if args.pam:
-    n.power_pam('off')
-
-if args.fem:
-    n.power_fem('off')
+# Turning off the SNAP relay turns off all the SNAPs first
+all_snaps = args.snaps or args.snapRelay
+snaps = [all_snaps or flag for flag in (args.snap0, args.snap1, args.snap2, args.snap3)]
+# All the commands are written to redis at once
+commands = n.set_power(relay = False if all_snaps else None,
+                       snap = [False if flag else None for flag in snaps],
+                       fem = False if args.fem else None,
+                       pam = False if args.pam else None)
+for control in commands:
+    print("%s is off" % control)
 
 if args.reset:
     n.reset()
-
@@ -29,40 +29,17 @@ args = parser.parse_args()
 
 # Instantiate a udpSenderClass object to send commands to Arduino
 n = nodeControl.NodeControl(int(args.node))
-if args.snaps:
-    n.power_snap_relay('on')
-    n.power_snap_0('on')
-    n.power_snap_1('on')
-    n.power_snap_2('on')
-    n.power_snap_3('on')
-
-if args.snapRelay:
-    #print("Turning SNAP relay on")
-    n.power_snap_relay('on')
-
-if args.snap0:
-    n.power_snap_relay('on')
-    n.power_snap_0('on')
-
-if args.snap1:
-    n.power_snap_relay('on')
-    n.power_snap_1('on')
-
-if args.snap2:
-    n.power_snap_relay('on')
-    n.power_snap_2('on')
-
-if args.snap3:
-    n.power_snap_relay('on')
-    n.power_snap_3('on')
-
-if args.pam:
-    n.power_pam('on')
-
-if args.fem:
-    n.power_fem('on')
+snaps = [args.snaps or flag for flag in (args.snap0, args.snap1, args.snap2, args.snap3)]
+# Turning on any SNAP needs the SNAP relay on first
+relay = args.snapRelay or any(snaps)
+# All the commands are written to redis at once
+commands = n.set_power(relay = True if relay else None,
+                       snap = [True if flag else None for flag in snaps],
+                       fem = True if args.fem else None,
+                       pam = True if args.pam else None)
+for control in commands:
+    print("%s is on" % control)
 
 if args.reset:
     print("Resetting Arduino/Turning everything off at once")
     n.reset()
-
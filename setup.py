@@ -26,13 +26,16 @@ setup(
     url = 'https://github.com/reeveress/monitor-control.git',
     long_description = open('README.md').read(),
     package_dir = {'nodeControl':'monitor-control/nodeControl', 'udpSender':'backend/udpSender'},
-    packages = ['nodeControl','udpSender'],
+    packages = ['nodeControl','udpSender','udpSender.aio'],
     #scripts = [glob.glob('monitor-control/scripts/*'),glob.glob('backend/scripts/*')],
     scripts = [
                 'monitor-control/scripts/hera_node_data_dump.py',
                 'monitor-control/scripts/hera_node_get_status.py',
+                'monitor-control/scripts/hera_node_power_sequence.py',
                 'monitor-control/scripts/hera_node_turn_off.py',
                 'monitor-control/scripts/hera_node_turn_on.py',
+                'backend/scripts/hera_node_archiver.py',
+                'backend/scripts/hera_node_backend.py',
                 'backend/scripts/hera_node_cmd_check.py',
                 'backend/scripts/hera_node_keep_alive.py',
                 'backend/scripts/hera_node_receiver.py',